@@ -144,13 +144,19 @@ def s3fs_mount_inputs(inputs, staging_dir):
     return get_local_input_path(inputs)
 
 
-def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path, repetition):
-    """Execute one repetition of a test. Return the time it took to complete."""
+def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path, repetition,
+                        variant=None, variant_args=()):
+    """Execute one repetition of a test. Return the time it took to complete.
+
+    variant_args are extra arguments for the test command, from the variants
+    in the test.yaml.
+    """
 
     # Try to clear the pagecache.
     drop_caches()
 
-    output_path = os.path.join(test_dir, "output_{}".format(repetition))
+    run_name = "{}_{}".format(variant, repetition) if variant else str(repetition)
+    output_path = os.path.join(test_dir, "output_{}".format(run_name))
     ensure_dir(output_path)
     file_monitor = FileSizeMonitor(output_path)
 
@@ -159,6 +165,7 @@ def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path
     test_cmd.extend(input_paths)
     test_cmd.append("--output-path")
     test_cmd.append(output_path)
+    test_cmd.extend(str(a) for a in variant_args)
 
     start_time = time.perf_counter()
     DOCKER_CLIENT.containers.run(
@@ -172,7 +179,7 @@ def run_test_repetition(docker_image_name, test_dir, input_paths, test_yaml_path
     test_time = end_time - start_time
 
     # Write the timing results to a file
-    results_log_path = os.path.join(test_dir, "timing_results_{}.log".format(repetition))
+    results_log_path = os.path.join(test_dir, "timing_results_{}.log".format(run_name))
     with open(results_log_path, "w") as results_log:
         results_log.write(str(test_time) + "\n")
         for size in file_monitor.file_sizes:
@@ -237,17 +244,34 @@ def run_test(test_path, data_yaml_path, repetitions=10, local_staging_dir=None):
                 inputs = s3fs_mount_inputs(inputs, test_instance_dir)
             print("Done localizing to", test_instance_dir)
 
-            # Build the image that runs the test
+            # Build the image that runs the test. Tests that share code with
+            # other tests set a build_context that contains both.
+            build_context = os.path.normpath(
+                os.path.join(test_path, test_config.get("build_context", ".")))
             image, _ = DOCKER_CLIENT.images.build(
-                path=test_path, tag="matrix_benchmark_{}_{}".format(source, format_).lower())
+                path=build_context,
+                dockerfile=os.path.relpath(os.path.join(test_path, "Dockerfile"), build_context),
+                tag="matrix_benchmark_{}_{}".format(source, format_).lower())
             image_name = image.tags[0]
             print("Built", image_name)
 
-            running_times = [
-                run_test_repetition(image_name, test_instance_dir, inputs,
-                                    os.path.join(test_path, "test.yaml"), r)
-                for r in range(repetitions)]
-            test_running_times[source][format_] = running_times
+            # A test can define variants that pass extra arguments to the test
+            # command, e.g. a serial and a parallel run. Each one is timed
+            # separately.
+            variants = test_config.get("variants")
+            if not variants:
+                test_running_times[source][format_] = [
+                    run_test_repetition(image_name, test_instance_dir, inputs,
+                                        os.path.join(test_path, "test.yaml"), r)
+                    for r in range(repetitions)]
+                continue
+
+            for variant, variant_args in variants.items():
+                test_running_times[source]["{}/{}".format(format_, variant)] = [
+                    run_test_repetition(image_name, test_instance_dir, inputs,
+                                        os.path.join(test_path, "test.yaml"), r,
+                                        variant, variant_args)
+                    for r in range(repetitions)]
 
     return test_running_times
 
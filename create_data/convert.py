@@ -1,12 +1,13 @@
 import argparse
+import collections
 import numpy
 import os
 import pathlib
-import shutil
 import urllib.request
 import yaml
 
 import converters
+import manifest
 
 
 def main():
@@ -14,6 +15,11 @@ def main():
     parser.add_argument("--data-yaml", help="YAML file describing data inputs and outputs.",
                         required=True)
     parser.add_argument("--data-path", help="Path to put files.", required=True)
+    parser.add_argument("--manifest",
+                        help=("Manifest of matrices that have already been created. "
+                              "Defaults to <data-path>/manifest.json."))
+    parser.add_argument("--force", action="store_true",
+                        help="Regenerate everything, even if the manifest says it's current.")
     args = parser.parse_args()
 
     data_dict = yaml.load(open(args.data_yaml))
@@ -21,20 +27,40 @@ def main():
     sources = data_dict["sources"]
     outputs = data_dict["outputs"]
 
-    for source in sources:
-
-        # Get the remote file and put it in data/sources/<name>
-        url = sources[source]["url"]
+    data_manifest = manifest.Manifest(
+        args.manifest or os.path.join(args.data_path, "manifest.json"))
 
-        source_path = os.path.join(
-            args.data_path,
-            "sources",
-            source,
-            os.path.basename(url)
-        )
+    bytes_written = collections.Counter()
+    for source in sources:
 
-        pathlib.Path(os.path.dirname(source_path)).mkdir(parents=True)
-        urllib.request.urlretrieve(url, filename=source_path)
+        if not args.force and data_manifest.source_is_current(source, sources[source], outputs):
+            print("All matrices for", source, "are up to date.")
+            continue
+
+        # Get the remote file and put it in data/sources/<name>. Sources
+        # without a url, like synthetic ones, just get a directory.
+        url = sources[source].get("url")
+
+        if url:
+            source_path = os.path.join(
+                args.data_path,
+                "sources",
+                source,
+                os.path.basename(url)
+            )
+            pathlib.Path(os.path.dirname(source_path)).mkdir(parents=True, exist_ok=True)
+        else:
+            source_path = os.path.join(args.data_path, "sources", source)
+            pathlib.Path(source_path).mkdir(parents=True, exist_ok=True)
+
+        if url and (args.force or not data_manifest.source_file_is_current(
+                source, sources[source], source_path)):
+            # Download next to the final path so an interrupted download is
+            # never mistaken for a complete one
+            urllib.request.urlretrieve(url, filename=source_path + ".part")
+            os.replace(source_path + ".part", source_path)
+        data_manifest.record_source_file(source, sources[source], source_path)
+        data_manifest.save()
 
         # Get the method to convert this file to dataframes
         convertfrom_method = getattr(converters, "convert_from_" + sources[source]["type"])
@@ -45,27 +71,43 @@ def main():
 
             # Iterate over expected output formats
             for output in outputs:
-                convertto_method = getattr(converters, "convert_to_" + outputs[output]["format"])
+                params = manifest.matrix_params(sources[source], outputs[output])
+                if not args.force and data_manifest.matrix_is_current(
+                        source, output, df_counter, params):
+                    continue
 
-                # The convertto_method returns a path to a matrix file or
-                # directory, we'll want to move that to the data_path
-                tmp_matrix_path = convertto_method(
-                    dataframe,
-                    **outputs[output].get("args", {}))
-                ext = os.path.splitext(tmp_matrix_path)[1]
+                convertto_method = getattr(converters, "convert_to_" + outputs[output]["format"])
 
-                matrix_path = os.path.join(
+                # The convertto_method writes straight to the final location
+                # and adds the extension for its format to the path
+                matrix_base_path = os.path.join(
                     args.data_path,
                     "matrices",
                     output,
                     source,
                     str(df_counter) if sources[source]["multiple_matrices"] else "",
-                    "{}_{}{}".format(output, source, ext)
+                    "{}_{}".format(output, source)
                 )
+                pathlib.Path(os.path.dirname(matrix_base_path)).mkdir(parents=True, exist_ok=True)
+
+                matrix_path = convertto_method(
+                    dataframe,
+                    matrix_base_path,
+                    **outputs[output].get("args", {}))
+                entry = data_manifest.record_matrix(
+                    source, output, df_counter, params, matrix_path)
+                bytes_written[output] += entry["size"]
 
-                pathlib.Path(os.path.dirname(matrix_path)).mkdir(parents=True)
-                shutil.move(tmp_matrix_path, matrix_path)
+            # Save after every dataframe so a crash loses at most one of them
+            data_manifest.save()
             df_counter += 1
 
+        data_manifest.record_source_complete(source, df_counter)
+        data_manifest.save()
+
+    print("Bytes written per output format:")
+    for output in outputs:
+        print("  {}: {}".format(output, bytes_written[output]))
+
 if __name__ == "__main__":
     main()
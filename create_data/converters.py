@@ -1,10 +1,13 @@
-import tempfile
+import contextlib
 import os
+import shutil
+import tempfile
 
 import anndata
 import h5py
 import h5sparse
 import loompy
+import numcodecs
 import numpy
 import pandas
 import pyarrow
@@ -12,10 +15,18 @@ import pyarrow.parquet
 import scanpy.api as sc
 import scipy.io
 import scipy.sparse
+import yaml
 import zarr
 
+import synthetic
+import transpose
+import zarr_stores
+
 NUM_QC_VALUES = 100
 
+# Candidate dtypes for integer counts, smallest first
+COUNT_DTYPES = ("uint16", "uint32")
+
 def fake_qc_values(qc_val_count, index, seed=0):
 
     numpy.random.seed(int(seed))
@@ -48,146 +59,280 @@ def convert_from_geocsv(path, split=False, num_to_keep=100):
     else:
         yield data
 
-
-def _get_temp_path(suffix=None):
-    temp_dir = tempfile.mkdtemp()
-    temp_path = os.path.join(temp_dir, "matrix")
-    if suffix:
-        temp_path += suffix
-
-    return temp_path
-
-def convert_to_hdf5(df, chunks, compression):
-    """Convert a dataframe of expression values to an hdf5 file."""
-    path = _get_temp_path(".h5")
-    f = h5py.File(path, 'w', libver='latest')
-
-    adj_chunks = (min(df.shape[0], chunks[0]), min(df.shape[1], chunks[1]))
-    f.create_dataset("data", data=df.as_matrix(), chunks=adj_chunks, compression=compression)
-    dt = h5py.special_dtype(vlen=bytes)
-    f.create_dataset("gene_names", data=df.columns.values, dtype=dt)
-    f.create_dataset("cell_names", data=df.index.values, dtype=dt)
-
-    f.attrs["hdf5_version"] = h5py.version.hdf5_version
-    f.attrs["h5py_version"] = h5py.version.version
-
-    qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
-    qc_chunks = (min(qcs.shape[0], chunks[0]), min(qcs.shape[1], chunks[1]))
-    f.create_dataset("qc_values", data=qcs.as_matrix(), chunks=qc_chunks, compression=compression)
-    f.create_dataset("qc_names", data=qcs.index.values, dtype=dt)
-
-    f.close()
+def convert_from_synthetic(path, n_cells, n_genes, num_files=1, **kwargs):
+    """Generate a synthetic source, split into num_files matrices.
+
+    synthetic.py generates genes x cells counts, which are yielded as cells x
+    genes dataframes like those of every other source. Nothing is downloaded.
+    The expected shape, sum and non-zero count of the merged matrix are
+    counted from the files as they are generated and written to
+    expected_output.yaml in path.
+    """
+
+    gene_names = ["gene_{}".format(i) for i in range(n_genes)]
+    first_cell = 0
+    total = 0
+    non_zero_count = 0
+    for counts in synthetic.generate_files(n_cells, n_genes, num_files=num_files, **kwargs):
+        n_file_cells = counts.shape[1]
+        cell_names = ["cell_{}".format(i) for i in range(first_cell, first_cell + n_file_cells)]
+        first_cell += n_file_cells
+        total += int(counts.sum(dtype=numpy.int64))
+        non_zero_count += int(numpy.count_nonzero(counts))
+        yield pandas.DataFrame(counts.T, index=cell_names, columns=gene_names)
+
+    expected = {
+        "shape": [n_genes, n_cells],
+        "sum": total,
+        "non_zero_count": non_zero_count
+    }
+    with open(os.path.join(path, "expected_output.yaml"), "w") as expected_yaml:
+        yaml.dump({"expected_output": expected}, expected_yaml, default_flow_style=None)
+
+
+def _count_dtype(values, dtype="auto"):
+    """The dtype to store a matrix of counts with.
+
+    With dtype="auto", non-negative whole numbers get the smallest of
+    COUNT_DTYPES that holds them and anything else keeps its dtype. Any other
+    dtype, e.g. from the output args in data.yaml, is used as is.
+    """
+
+    if dtype != "auto":
+        return numpy.dtype(dtype)
+    if values.size == 0 or values.dtype.kind not in "iuf":
+        return values.dtype
+    if values.dtype.kind == "f" and not numpy.array_equal(values, numpy.trunc(values)):
+        return values.dtype
+    if values.min() < 0:
+        return values.dtype
+    max_value = values.max()
+    for candidate in COUNT_DTYPES:
+        if max_value <= numpy.iinfo(candidate).max:
+            return numpy.dtype(candidate)
+    return values.dtype
+
+def _count_matrix(df, dtype="auto"):
+    """The values of a dataframe of counts, cast according to the dtype policy."""
+
+    values = df.values
+    return values.astype(_count_dtype(values, dtype), copy=False)
+
+def _count_frame(df, dtype="auto"):
+    """A dataframe of counts, cast according to the dtype policy."""
+
+    return pandas.DataFrame(_count_matrix(df, dtype), index=df.index, columns=df.columns)
+
+def _remove_path(path):
+    """Remove a file or directory, if it exists."""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+@contextlib.contextmanager
+def _atomic_path(path):
+    """Yield a temporary path next to path, and rename it to path on success.
+
+    The temporary path is in a sibling directory on the same filesystem, so the
+    final rename is cheap, and an interrupted write never leaves a partial
+    matrix at path. A file replaces the old matrix atomically. A directory,
+    like a zarr DirectoryStore, can't be renamed over an existing path, so the
+    old matrix is renamed aside first and only deleted once the new one is in
+    place.
+    """
+
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(path) or ".",
+                                prefix="." + os.path.basename(path) + ".")
+    temp_path = os.path.join(temp_dir, os.path.basename(path))
+    try:
+        yield temp_path
+        if os.path.exists(path) and (os.path.isdir(path) or os.path.isdir(temp_path)):
+            os.replace(path, temp_path + ".old")
+        os.replace(temp_path, path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def convert_to_hdf5(df, path, chunks, compression, compression_opts=None, shuffle=False,
+                    dtype="auto", gene_major=False):
+    """Convert a dataframe of expression values to an hdf5 file.
+
+    compression is passed to h5py, so it can be a gzip level or a filter name
+    like "gzip" or "lzf", in which case compression_opts sets its level. With
+    gene_major, a transposed copy is added by transpose.py.
+    """
+    path += ".h5"
+    filters = {"compression": compression, "shuffle": shuffle}
+    if compression_opts is not None:
+        filters["compression_opts"] = compression_opts
+
+    with _atomic_path(path) as temp_path:
+        f = h5py.File(temp_path, 'w', libver='latest')
+
+        adj_chunks = (min(df.shape[0], chunks[0]), min(df.shape[1], chunks[1]))
+        f.create_dataset("data", data=_count_matrix(df, dtype), chunks=adj_chunks, **filters)
+        dt = h5py.special_dtype(vlen=bytes)
+        f.create_dataset("gene_names", data=df.columns.values, dtype=dt)
+        f.create_dataset("cell_names", data=df.index.values, dtype=dt)
+
+        f.attrs["hdf5_version"] = h5py.version.hdf5_version
+        f.attrs["h5py_version"] = h5py.version.version
+
+        qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
+        qc_chunks = (min(qcs.shape[0], chunks[0]), min(qcs.shape[1], chunks[1]))
+        f.create_dataset("qc_values", data=qcs.as_matrix(), chunks=qc_chunks, **filters)
+        f.create_dataset("qc_names", data=qcs.index.values, dtype=dt)
+
+        f.close()
+        if gene_major:
+            transpose.transpose_hdf5(temp_path)
 
     return path
 
-def convert_to_sparse_hdf5(df, major="csc"):
-    """Convert a dataframe to a sparse represenation in an hdf5 file."""
+def convert_to_sparse_hdf5(df, path, major="csc", dtype="auto", gene_major=False):
+    """Convert a dataframe to a sparse represenation in an hdf5 file.
+
+    With gene_major the file also gets the other major format, see transpose.py.
+    """
 
-    path = _get_temp_path(".h5")
+    path += ".h5"
     matrix_class = getattr(scipy.sparse, major + "_matrix")
-    sparse_matrix = matrix_class(df.as_matrix())
-    f = h5sparse.File(path, 'w', libver='latest')
-    f.create_dataset("data", data=sparse_matrix)
+    sparse_matrix = matrix_class(_count_matrix(df, dtype))
+    with _atomic_path(path) as temp_path:
+        f = h5sparse.File(temp_path, 'w', libver='latest')
+        f.create_dataset("data", data=sparse_matrix)
 
-    f.h5f.attrs["hdf5_version"] = h5py.version.hdf5_version
-    f.h5f.attrs["h5py_version"] = h5py.version.version
+        f.h5f.attrs["hdf5_version"] = h5py.version.hdf5_version
+        f.h5f.attrs["h5py_version"] = h5py.version.version
 
-    qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
-    dt = h5py.special_dtype(vlen=bytes)
-    f.h5f.create_dataset("qc_values", data=qcs.as_matrix())
-    f.h5f.create_dataset("qc_names", data=qcs.index.values, dtype=dt)
+        qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
+        dt = h5py.special_dtype(vlen=bytes)
+        f.h5f.create_dataset("qc_values", data=qcs.as_matrix())
+        f.h5f.create_dataset("qc_names", data=qcs.index.values, dtype=dt)
 
-    f.h5f.close()
+        f.h5f.close()
+        if gene_major:
+            transpose.transpose_sparse_hdf5(temp_path)
 
     return path
 
-def convert_to_loom(df):
+def convert_to_loom(df, path, dtype="auto"):
     """Convert a dataframe of expression values to a loom file."""
 
-    path = _get_temp_path(".loom")
+    path += ".loom"
     qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
     row_attrs = qcs.to_dict(orient='list')
     row_attrs["cell_name"] = df.index.values
 
-    loompy.create(path, df.as_matrix(), row_attrs,
-                  {"gene_name": df.columns.values})
+    with _atomic_path(path) as temp_path:
+        loompy.create(temp_path, _count_matrix(df, dtype), row_attrs,
+                      {"gene_name": df.columns.values})
     return path
 
-def convert_to_parquet(df, row_group_size, compression):
+def convert_to_parquet(df, path, row_group_size, compression, dtype="auto"):
     """Convert a dataframe of expression values to a parquet file."""
 
-    path = _get_temp_path(".parquet")
+    path += ".parquet"
     qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
-    full_df = pandas.concat([df, qcs], axis=1)
+    full_df = pandas.concat([_count_frame(df, dtype), qcs], axis=1)
     table = pyarrow.Table.from_pandas(full_df)
-    pyarrow.parquet.write_table(table, path, row_group_size=row_group_size,
-                                compression=compression)
+    with _atomic_path(path) as temp_path:
+        pyarrow.parquet.write_table(table, temp_path, row_group_size=row_group_size,
+                                    compression=compression)
 
     return path
 
-def convert_to_feather(df):
+def convert_to_feather(df, path, dtype="auto"):
     """Convert a dataframe of expression values to a feather file."""
 
-    path = _get_temp_path(".feather")
+    path += ".feather"
     qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
-    full_df = pandas.concat([df, qcs], axis=1)
-    full_df.reset_index().to_feather(path)
+    full_df = pandas.concat([_count_frame(df, dtype), qcs], axis=1)
+    with _atomic_path(path) as temp_path:
+        full_df.reset_index().to_feather(temp_path)
     return path
 
-def convert_to_anndata(df):
+def convert_to_anndata(df, path, dtype="auto"):
     """Convert a dataframe of expression values to a scanpy anndata file."""
 
     qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
     cell_attrs = qcs.to_dict(orient='list')
     cell_attrs["cell_name"] = df.index.values
 
+    matrix = _count_matrix(df, dtype)
     adata = anndata.AnnData(
-        df.as_matrix(),
+        matrix,
         cell_attrs,
-        {"gene_name": df.columns.values}
+        {"gene_name": df.columns.values},
+        dtype=matrix.dtype
     )
 
-    path = _get_temp_path(".h5ad")
-    adata.write(path)
+    path += ".h5ad"
+    with _atomic_path(path) as temp_path:
+        adata.write(temp_path)
     return path
 
-def convert_to_npy(df):
+def convert_to_npy(df, path, dtype="auto"):
     """Convert a dataframe of expression values to a binary numpy file."""
 
-    path = _get_temp_path(".npy")
-    numpy.save(path, df.as_matrix())
+    path += ".npy"
+    with _atomic_path(path) as temp_path:
+        numpy.save(temp_path, _count_matrix(df, dtype))
     return path
 
 
-def convert_to_zarr(df, store_type, chunks):
-    """Anything is possible with ZARR"""
-
-    path = _get_temp_path(".zarr")
-    adj_chunks = (min(df.shape[0], chunks[0]), min(df.shape[1], chunks[1]))
-
-    store = getattr(zarr, store_type)(path)
-    root = zarr.group(store=store)
+def convert_to_zarr(df, path, store_type, chunks, compressor=None, dtype="auto",
+                    gene_major=False):
+    """Anything is possible with ZARR
 
-    root.create_dataset("data", data=df.as_matrix(), chunks=adj_chunks, dtype='f4')
-    root.create_dataset("cell_name", data=df.index.tolist())
-    root.create_dataset("gene_name", data=df.columns.tolist())
+    compressor is a numcodecs codec config, e.g.
+    {"id": "blosc", "cname": "zstd", "clevel": 5, "shuffle": 1}. The zarr
+    default is used if it isn't given. gene_major adds a transposed copy.
+    store_type is a zarr store class in zarr_stores.SUFFIXES, which also
+    gives the extension of the path.
+    """
 
-    qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
-    qc_chunks = (min(qcs.shape[0], chunks[0]), min(qcs.shape[1], chunks[1]))
-    root.create_dataset("qc_values", data=qcs, chunks=qc_chunks)
-    root.create_dataset("qc_names", data=qcs.columns.tolist())
+    path += zarr_stores.SUFFIXES[store_type]
+    adj_chunks = (min(df.shape[0], chunks[0]), min(df.shape[1], chunks[1]))
+    if compressor:
+        compressor = numcodecs.get_codec(dict(compressor))
+    else:
+        compressor = zarr.storage.default_compressor
+
+    with _atomic_path(path) as temp_path:
+        store = zarr_stores.open_store(temp_path, store_type, mode="w")
+        try:
+            root = zarr.group(store=store)
+
+            matrix = _count_matrix(df, dtype)
+            root.create_dataset("data", data=matrix, chunks=adj_chunks, dtype=matrix.dtype,
+                                compressor=compressor)
+            root.create_dataset("cell_name", data=df.index.tolist())
+            root.create_dataset("gene_name", data=df.columns.tolist())
+
+            qcs = fake_qc_values(NUM_QC_VALUES, df.index, seed=df.values.sum())
+            qc_chunks = (min(qcs.shape[0], chunks[0]), min(qcs.shape[1], chunks[1]))
+            root.create_dataset("qc_values", data=qcs, chunks=qc_chunks)
+            root.create_dataset("qc_names", data=qcs.columns.tolist())
+        finally:
+            zarr_stores.close_store(store)
+        if gene_major:
+            transpose.transpose_zarr(temp_path, store_type)
 
     return path
 
-def convert_to_csv(df):
+def convert_to_csv(df, path, dtype="auto"):
 
-    path = _get_temp_path(".csv.gz")
-    df.to_csv(path, compression="gzip")
+    path += ".csv.gz"
+    with _atomic_path(path) as temp_path:
+        _count_frame(df, dtype).to_csv(temp_path, compression="gzip")
     return path
 
-def convert_to_mtx(df):
+def convert_to_mtx(df, path, dtype="auto"):
 
-    path = _get_temp_path(".mtx")
-    sparse_mat = scipy.sparse.coo_matrix(df.values)
-    scipy.io.mmwrite(path, sparse_mat)
+    path += ".mtx"
+    sparse_mat = scipy.sparse.coo_matrix(_count_matrix(df, dtype))
+    with _atomic_path(path) as temp_path:
+        scipy.io.mmwrite(temp_path, sparse_mat)
     return path
@@ -0,0 +1,151 @@
+"""Record what has already been generated so data creation can be resumed.
+
+The manifest is a JSON file that sits next to the generated data. For every
+(source, output, index) it stores the parameters that produced the matrix, a
+content hash and the size on disk. When convert.py is rerun, only the entries
+whose source or output parameters changed, or whose files went missing or no
+longer match their size and hash, are regenerated.
+"""
+
+import copy
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+
+def matrix_paths(path):
+    """List the files that make up a matrix, which may be a file or a directory."""
+
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        os.path.join(dirpath, filename)
+        for dirpath, dirnames, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+def matrix_size(path):
+    """Total size in bytes of a matrix file or directory."""
+
+    return sum(os.path.getsize(p) for p in matrix_paths(path))
+
+def matrix_digest(path, block_size=1 << 20):
+    """sha256 of a matrix file or directory.
+
+    For directories (e.g. zarr) the relative path of each file is hashed along
+    with its contents, so renaming a chunk changes the digest.
+    """
+
+    digest = hashlib.sha256()
+    for file_path in matrix_paths(path):
+        if file_path != path:
+            digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+        with open(file_path, "rb") as file_:
+            for block in iter(lambda: file_.read(block_size), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """The set of sources and matrices that have been generated so far."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        self.matrices = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                contents = json.load(manifest_file)
+            if contents.get("version") == MANIFEST_VERSION:
+                self.sources = contents["sources"]
+                self.matrices = contents["matrices"]
+
+    def save(self):
+        """Write the manifest, atomically so a crash can't leave it half written."""
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump({"version": MANIFEST_VERSION,
+                       "sources": self.sources,
+                       "matrices": self.matrices},
+                      manifest_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _matrix_key(source, output, index):
+        return "/".join([source, output, str(index)])
+
+    def source_file_is_current(self, source, source_config, source_path):
+        """Whether the downloaded source file can be reused."""
+
+        entry = self.sources.get(source)
+        return (entry is not None
+                and entry["url"] == source_config.get("url")
+                and os.path.isfile(source_path)
+                and os.path.getsize(source_path) == entry["size"])
+
+    def record_source_file(self, source, source_config, source_path):
+        """Note that the source file was downloaded (or regenerated)."""
+
+        previous = self.sources.get(source, {})
+        self.sources[source] = {
+            "url": source_config.get("url"),
+            "params": copy.deepcopy(source_config),
+            "size": matrix_size(source_path) if os.path.exists(source_path) else 0,
+            "num_matrices": (previous.get("num_matrices")
+                             if previous.get("params") == source_config else None)
+        }
+
+    def record_source_complete(self, source, num_matrices):
+        """Note how many matrices the source produced, once it's been fully read."""
+
+        self.sources[source]["num_matrices"] = num_matrices
+
+    def matrix_is_current(self, source, output, index, params):
+        """Whether the matrix for (source, output, index) was made with params
+        and is still on disk as it was written. The size is compared first, so
+        only matrices of the right size are hashed.
+        """
+
+        entry = self.matrices.get(self._matrix_key(source, output, index))
+        return (entry is not None
+                and entry["params"] == params
+                and os.path.exists(entry["path"])
+                and matrix_size(entry["path"]) == entry["size"]
+                and matrix_digest(entry["path"]) == entry["sha256"])
+
+    def record_matrix(self, source, output, index, params, path):
+        """Note that a matrix was written to path, hashing it in the process."""
+
+        entry = {
+            "params": copy.deepcopy(params),
+            "path": path,
+            "size": matrix_size(path),
+            "sha256": matrix_digest(path)
+        }
+        self.matrices[self._matrix_key(source, output, index)] = entry
+        return entry
+
+    def source_is_current(self, source, source_config, outputs):
+        """Whether every matrix from this source is up to date, so the source
+        doesn't even need to be read.
+        """
+
+        entry = self.sources.get(source)
+        if (entry is None or entry["params"] != source_config
+                or entry["num_matrices"] is None):
+            return False
+        return all(
+            self.matrix_is_current(source, output, index,
+                                   matrix_params(source_config, outputs[output]))
+            for output in outputs
+            for index in range(entry["num_matrices"])
+        )
+
+
+def matrix_params(source_config, output_config):
+    """The parameters that determine the contents of one output matrix."""
+
+    return {"source": source_config, "output": output_config}
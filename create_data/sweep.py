@@ -0,0 +1,248 @@
+"""Sweep chunk shapes and compressors for the zarr and hdf5 outputs.
+
+Every combination in the grid of a sweep yaml (see sweep.yaml) is written with
+the convert_to_zarr and convert_to_hdf5 writers from converters.py. A set of
+access patterns is then timed against each variant, and the variants are
+ranked by the geometric mean of their access times, with their size on disk
+and throughput alongside.
+
+Variants written with gene_major also have the transposed copy of
+transpose.py. Each pattern is timed against both layouts and the faster one
+counts, so the grid shows what the second copy buys for its size.
+"""
+
+import argparse
+import contextlib
+import itertools
+import os
+import pathlib
+import time
+
+import h5py
+import numpy
+import yaml
+import zarr
+
+import converters
+import manifest
+import transpose
+import zarr_stores
+
+ACCESS_PATTERNS = {}
+
+
+def access_pattern(func):
+    """Register an access pattern under its function name."""
+
+    ACCESS_PATTERNS[func.__name__] = func
+    return func
+
+@access_pattern
+def full(array, rng):
+    """Read the whole matrix, which is what the merge tasks do."""
+    return array[:]
+
+@access_pattern
+def cell_slice(array, rng, n_cells=1000):
+    """Read all genes for a contiguous range of cells."""
+    start = rng.randint(0, max(1, array.shape[0] - n_cells + 1))
+    return array[start:start + n_cells, :]
+
+@access_pattern
+def gene_slice(array, rng, n_genes=100):
+    """Read a contiguous range of genes for all cells."""
+    start = rng.randint(0, max(1, array.shape[1] - n_genes + 1))
+    return array[:, start:start + n_genes]
+
+
+def expand_grid(grid):
+    """Yield (format, args) for every combination of options in the grid.
+
+    Options named "filters" are lists of dicts that are merged into the args,
+    for settings that only make sense together, like a codec and its level.
+    """
+
+    for format_, options in grid.items():
+        names = sorted(options)
+        for values in itertools.product(*(options[name] for name in names)):
+            args = {}
+            for name, value in zip(names, values):
+                if name == "filters":
+                    args.update(value)
+                else:
+                    args[name] = value
+            yield format_, args
+
+def variant_name(format_, args):
+    """A readable, filesystem safe name for one variant."""
+
+    parts = [format_]
+    for name in sorted(args):
+        value = args[name]
+        if isinstance(value, dict):
+            value = "-".join(str(value[k]) for k in sorted(value))
+        elif isinstance(value, (list, tuple)):
+            value = "x".join(str(v) for v in value)
+        parts.append("{}-{}".format(name, value))
+    return "_".join(parts).replace("/", "-")
+
+class GeneMajorView(object):
+    """A gene-major copy indexed as cells x genes, like "data", so the access
+    patterns read the same values from either layout.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape[::-1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        return self.array[key[::-1]].T
+
+@contextlib.contextmanager
+def open_layouts(format_, path, args):
+    """Open the expression matrix of a variant for reading, in each of its
+    layouts, and close the file or store when done.
+    """
+
+    if format_ == "hdf5":
+        group = h5py.File(path, "r")
+    else:
+        store = zarr_stores.open_store(path, args.get("store_type", "DirectoryStore"), mode="r")
+        group = zarr.open_group(store=store, mode="r")
+    try:
+        layouts = {"data": group["data"]}
+        if transpose.GENE_MAJOR in group:
+            layouts[transpose.GENE_MAJOR] = GeneMajorView(group[transpose.GENE_MAJOR])
+        yield layouts
+    finally:
+        if format_ == "hdf5":
+            group.close()
+        else:
+            zarr_stores.close_store(store)
+
+def time_patterns(array, patterns, repetitions, seed=0):
+    """Median time in seconds and bytes read for each access pattern."""
+
+    results = {}
+    for pattern in patterns:
+        rng = numpy.random.RandomState(seed)
+        times = []
+        for _ in range(repetitions):
+            start_time = time.perf_counter()
+            values = ACCESS_PATTERNS[pattern](array, rng)
+            times.append(time.perf_counter() - start_time)
+        seconds = float(numpy.median(times))
+        results[pattern] = {
+            "seconds": seconds,
+            "megabytes_per_second": values.nbytes / seconds / 1e6
+        }
+    return results
+
+def fastest_layout(results_by_layout):
+    """The fastest layout's result for each pattern, naming the layout."""
+
+    fastest = {}
+    for layout, results in sorted(results_by_layout.items()):
+        for pattern, result in results.items():
+            if pattern not in fastest or result["seconds"] < fastest[pattern]["seconds"]:
+                fastest[pattern] = dict(result, layout=layout)
+    return fastest
+
+def rank(results, patterns):
+    """Sort results, fastest first, by the geometric mean of pattern times."""
+
+    for result in results:
+        result["score"] = float(numpy.exp(numpy.mean(
+            [numpy.log(result["patterns"][p]["seconds"]) for p in patterns])))
+    return sorted(results, key=lambda r: (r["score"], r["size"]))
+
+def load_dataframe(data_yaml_path, source, source_path, work_dir):
+    """Get the first dataframe of a source from the data yaml."""
+
+    source_config = yaml.load(open(data_yaml_path))["sources"][source]
+    if source_path is None:
+        if source_config.get("url"):
+            raise ValueError("--source-path is required for downloaded sources")
+        source_path = os.path.join(work_dir, "source")
+        pathlib.Path(source_path).mkdir(parents=True, exist_ok=True)
+    convertfrom_method = getattr(converters, "convert_from_" + source_config["type"])
+    return next(convertfrom_method(source_path, **source_config.get("args", {})))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep-yaml", required=True,
+                        help="YAML file with the grid and access patterns to sweep.")
+    parser.add_argument("--data-yaml", required=True,
+                        help="YAML file describing data sources.")
+    parser.add_argument("--source", required=True,
+                        help="Source in the data yaml whose first matrix is swept.")
+    parser.add_argument("--source-path",
+                        help="Local copy of the source file, for sources with a url.")
+    parser.add_argument("--output-dir", required=True,
+                        help="Where to write the variants and sweep_results.yaml.")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep each variant on disk after it has been timed.")
+    args = parser.parse_args()
+
+    sweep = yaml.load(open(args.sweep_yaml))
+    patterns = sweep.get("access_patterns", sorted(ACCESS_PATTERNS))
+    repetitions = sweep.get("repetitions", 3)
+
+    pathlib.Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    df = load_dataframe(args.data_yaml, args.source, args.source_path, args.output_dir)
+    print("Sweeping over a", df.shape, "matrix from", args.source)
+
+    results = []
+    for format_, format_args in expand_grid(sweep["grid"]):
+        name = variant_name(format_, format_args)
+        convertto_method = getattr(converters, "convert_to_" + format_)
+
+        start_time = time.perf_counter()
+        path = convertto_method(df, os.path.join(args.output_dir, name), **format_args)
+        write_seconds = time.perf_counter() - start_time
+
+        with open_layouts(format_, path, format_args) as layouts:
+            timings = {layout: time_patterns(array, patterns, repetitions)
+                       for layout, array in layouts.items()}
+        results.append({
+            "name": name,
+            "format": format_,
+            "args": format_args,
+            "size": manifest.matrix_size(path),
+            "layout_sizes": transpose.layout_sizes(
+                path, format_, format_args.get("store_type", "DirectoryStore")),
+            "write_seconds": write_seconds,
+            "patterns": fastest_layout(timings)
+        })
+        print(name, results[-1]["size"], results[-1]["patterns"])
+
+        if not args.keep:
+            converters._remove_path(path)
+
+    ranked = rank(results, patterns)
+
+    header = ["rank", "variant", "size (MB)"] + ["{} (MB/s)".format(p) for p in patterns]
+    print("\t".join(header))
+    for position, result in enumerate(ranked, 1):
+        row = [str(position), result["name"], "{:.1f}".format(result["size"] / 1e6)]
+        row.extend("{:.1f}".format(result["patterns"][p]["megabytes_per_second"])
+                   for p in patterns)
+        print("\t".join(row))
+
+    recommendation = {}
+    for result in ranked:
+        recommendation.setdefault(result["format"], {
+            "format": result["format"],
+            "args": result["args"]
+        })
+    print("Recommended:")
+    print(yaml.dump(recommendation, default_flow_style=None))
+
+    with open(os.path.join(args.output_dir, "sweep_results.yaml"), "w") as results_yaml:
+        yaml.dump({"recommendation": recommendation, "ranked": ranked},
+                  results_yaml, default_flow_style=None)
+
+if __name__ == "__main__":
+    main()
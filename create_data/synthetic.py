@@ -0,0 +1,136 @@
+"""Generate synthetic expression matrices.
+
+The matrices are genes x cells, like the inputs the merge tasks concatenate
+column-wise. They are generated deterministically in fixed blocks of cells,
+each from its own random seed, so the same parameters always produce the same
+values no matter how the cells are split into files. That means the expected
+shape, sum and non-zero count of a synthetic source can be computed without
+running the conversion, and written into a test.yaml.
+
+Run as a script to print, or write into test.yaml files, the expected output
+for a synthetic source defined in data.yaml.
+"""
+
+import argparse
+import re
+
+import numpy
+import yaml
+
+DISTRIBUTIONS = ("negative_binomial", "zero_inflated")
+
+# Upper bound on the number of values generated at once
+BLOCK_VALUES = 1 << 22
+
+
+def _block_size(n_genes, block_size=None):
+    return block_size or max(1, BLOCK_VALUES // n_genes)
+
+def gene_means(n_genes, mean, seed):
+    """Per-gene mean expression, drawn from a lognormal around mean."""
+
+    rng = numpy.random.RandomState([seed, 0])
+    return rng.lognormal(numpy.log(mean), 1.0, n_genes)
+
+def generate_blocks(n_cells, n_genes, density=0.1, distribution="zero_inflated",
+                    mean=2.0, dispersion=0.5, block_size=None, seed=0, dtype="int32"):
+    """Yield (genes, cells) blocks of synthetic counts, covering all n_cells.
+
+    Counts are negative binomial with a per-gene mean and the given
+    dispersion. For the "zero_inflated" distribution, each count is then kept
+    with probability density, so at most that fraction of values is non-zero.
+    The "negative_binomial" distribution only has the zeros the negative
+    binomial produces itself, and ignores density.
+    """
+
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError("Unknown distribution {}, expected one of {}".format(
+            distribution, DISTRIBUTIONS))
+
+    block_size = _block_size(n_genes, block_size)
+    size = 1.0 / dispersion
+    prob = size / (size + gene_means(n_genes, mean, seed))
+
+    for block_index, start in enumerate(range(0, n_cells, block_size)):
+        rng = numpy.random.RandomState([seed, block_index + 1])
+        n_block_cells = min(block_size, n_cells - start)
+        counts = rng.negative_binomial(size, prob, size=(n_block_cells, n_genes))
+        if distribution == "zero_inflated":
+            counts[rng.random_sample(counts.shape) >= density] = 0
+        yield numpy.ascontiguousarray(counts.T, dtype=dtype)
+
+def generate_files(n_cells, n_genes, num_files=1, **kwargs):
+    """Yield num_files (genes, cells) arrays that split the n_cells between them.
+
+    Only one block and one file are held in memory at a time.
+    """
+
+    file_sizes = [len(a) for a in numpy.array_split(numpy.arange(n_cells), num_files)]
+    file_index = 0
+    pending = []
+    pending_cells = 0
+    for block in generate_blocks(n_cells, n_genes, **kwargs):
+        while block.shape[1]:
+            needed = file_sizes[file_index] - pending_cells
+            pending.append(block[:, :needed])
+            pending_cells += pending[-1].shape[1]
+            block = block[:, needed:]
+            if pending_cells == file_sizes[file_index]:
+                yield numpy.concatenate(pending, axis=1)
+                file_index += 1
+                pending = []
+                pending_cells = 0
+
+def expected_output(n_cells, n_genes, num_files=1, **kwargs):
+    """The expected_output entry of a test.yaml that merges this source.
+
+    Shape is (genes, cells), like the files and the merge tasks.
+    """
+
+    total = 0
+    non_zero_count = 0
+    for block in generate_blocks(n_cells, n_genes, **kwargs):
+        total += int(block.sum(dtype=numpy.int64))
+        non_zero_count += int(numpy.count_nonzero(block))
+
+    return {
+        "shape": [n_genes, n_cells],
+        "sum": total,
+        "non_zero_count": non_zero_count
+    }
+
+def write_expected_output(test_yaml_path, expected):
+    """Replace the expected_output section of a test.yaml, keeping its comments."""
+
+    with open(test_yaml_path) as test_yaml:
+        contents = test_yaml.read()
+    section = yaml.dump({"expected_output": expected}, default_flow_style=None)
+    match = re.search(r"^expected_output:.*?(?=^\S|\Z)", contents, re.M | re.S)
+    if match:
+        contents = contents[:match.start()] + section + contents[match.end():]
+    else:
+        contents = contents.rstrip("\n") + "\n" + section
+    with open(test_yaml_path, "w") as test_yaml:
+        test_yaml.write(contents)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-yaml", required=True,
+                        help="YAML file describing data inputs and outputs.")
+    parser.add_argument("--source", required=True,
+                        help="Name of a source of type synthetic in the data yaml.")
+    parser.add_argument("--test-yaml", nargs="*", default=[],
+                        help="test.yaml files whose expected_output should be updated.")
+    args = parser.parse_args()
+
+    source = yaml.load(open(args.data_yaml))["sources"][args.source]
+    if source["type"] != "synthetic":
+        raise ValueError("{} is not a synthetic source".format(args.source))
+
+    expected = expected_output(**source.get("args", {}))
+    print(yaml.dump({"expected_output": expected}, default_flow_style=None))
+    for test_yaml_path in args.test_yaml:
+        write_expected_output(test_yaml_path, expected)
+
+if __name__ == "__main__":
+    main()
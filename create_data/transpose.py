@@ -0,0 +1,239 @@
+"""Add a gene-major copy of the expression matrix to hdf5, zarr and sparse hdf5 files.
+
+The converters write "data" cell-major: cells are rows, genes are columns and
+the chunks are (cells, genes). Reading a few genes for every cell, or a genes x
+cells block like the merge tasks build, then touches every chunk. The gene-major
+copy is the transpose, genes x cells, stored next to it as "data_gene_major":
+
+- hdf5 and zarr get a dataset with the transposed chunk shape and the same
+  compression, so a chunk of the copy holds the values of a chunk of "data".
+- sparse hdf5 gets an h5sparse group in the same format as "data", so the file
+  holds both the csr and the csc arrays of the matrix.
+
+The copy has a TRANSPOSE_OF attribute naming "data", which readers check,
+along with the shape, before they use it instead of "data".
+
+Either way the transpose is done out of core, in blocks bounded by memory_mb,
+so it works on matrices that don't fit in memory. Readers can then pick the
+layout that suits their access pattern, at the cost of storing the values
+twice.
+
+Run as a script to add the copy to existing files and print the time it took
+and the size of each layout.
+"""
+
+import argparse
+import os
+import time
+
+import h5py
+import numpy
+
+import zarr_stores
+
+GENE_MAJOR = "data_gene_major"
+# Attribute of the gene-major copy naming the dataset it is the transpose of
+TRANSPOSE_OF = "transpose_of"
+
+FORMATS = ("hdf5", "zarr", "sparse_hdf5")
+
+
+def _block_length(n_values, itemsize, memory_mb, multiple=1):
+    """How many rows of n_values to handle at once to stay within memory_mb.
+
+    Blocks are rounded down to a multiple of multiple, e.g. the chunk length,
+    and a block and its transpose are both held, hence the factor of two.
+    """
+
+    length = (memory_mb << 20) // max(1, 2 * n_values * itemsize)
+    return max(multiple, length // multiple * multiple)
+
+def transpose_dense(source, target, memory_mb=256):
+    """Write the transpose of source into target, a block of source rows at a time.
+
+    source and target are h5py datasets or zarr arrays. The blocks are whole
+    chunk columns of target, so no chunk is written twice.
+    """
+
+    n_rows, n_columns = source.shape
+    chunk_columns = target.chunks[1] if target.chunks else 1
+    block_rows = _block_length(n_columns, source.dtype.itemsize, memory_mb, chunk_columns)
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        target[:, start:stop] = source[start:stop, :].T
+
+def _transposed_chunks(chunks, shape):
+    if chunks is None:
+        return None
+    return (min(max(shape[1], 1), chunks[1]), min(max(shape[0], 1), chunks[0]))
+
+def transpose_hdf5(path, memory_mb=256):
+    """Add a gene-major copy of "data", with its filters, to an hdf5 file."""
+
+    with h5py.File(path, "r+") as hdf5_file:
+        source = hdf5_file["data"]
+        if GENE_MAJOR in hdf5_file:
+            del hdf5_file[GENE_MAJOR]
+        target = hdf5_file.create_dataset(
+            GENE_MAJOR, source.shape[::-1], dtype=source.dtype,
+            chunks=_transposed_chunks(source.chunks, source.shape),
+            compression=source.compression, compression_opts=source.compression_opts,
+            shuffle=source.shuffle)
+        transpose_dense(source, target, memory_mb)
+        target.attrs[TRANSPOSE_OF] = "data"
+
+def transpose_zarr(path, store_type="DirectoryStore", memory_mb=256):
+    """Add a gene-major copy of "data", with its compressor, to a zarr group."""
+
+    import zarr
+    store = zarr_stores.open_store(path, store_type)
+    try:
+        root = zarr.open_group(store=store, mode="r+")
+        source = root["data"]
+        target = root.create_dataset(
+            GENE_MAJOR, shape=source.shape[::-1], dtype=source.dtype,
+            chunks=_transposed_chunks(source.chunks, source.shape),
+            compressor=source.compressor, overwrite=True)
+        transpose_dense(source, target, memory_mb)
+        target.attrs[TRANSPOSE_OF] = "data"
+    finally:
+        zarr_stores.close_store(store)
+
+def _recompress(source, target, n_major, n_minor, memory_mb):
+    """Write the arrays of source, compressed along the other axis, into target.
+
+    source and target are h5sparse groups of data, indices and indptr. A csr
+    matrix becomes the csc arrays of the same matrix and the other way round,
+    which is also the same format of its transpose. The number of values per
+    minor index is counted in one pass, then each range of minor indices whose
+    values fit in memory is collected from a pass over all the values, sorted
+    and written in one piece. The values of a minor index stay in major order,
+    because the passes read them in that order and the sort is stable.
+    """
+
+    indptr = source["indptr"][:]
+    nnz = int(indptr[-1])
+    data = source["data"]
+    indices = source["indices"]
+    block = _block_length(1, data.dtype.itemsize + 16, memory_mb)
+
+    counts = numpy.zeros(n_minor, dtype=numpy.int64)
+    for start in range(0, nnz, block):
+        counts += numpy.bincount(indices[start:start + block], minlength=n_minor)
+    target_indptr = numpy.zeros(n_minor + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=target_indptr[1:])
+
+    target.create_dataset("indptr", data=target_indptr)
+    target_data = target.create_dataset("data", (nnz,), dtype=data.dtype)
+    target_indices = target.create_dataset(
+        "indices", (nnz,), dtype=numpy.promote_types(
+            indices.dtype, numpy.min_scalar_type(max(n_major - 1, 0))))
+
+    minor_start = 0
+    while minor_start < n_minor:
+        # As many minor indices as fit in a block, and at least one
+        minor_stop = max(minor_start + 1, int(numpy.searchsorted(
+            target_indptr, target_indptr[minor_start] + block, side="right")) - 1)
+        minor_stop = min(minor_stop, n_minor)
+        pieces = []
+        for start in range(0, nnz, block):
+            stop = min(start + block, nnz)
+            block_indices = indices[start:stop]
+            selected = numpy.flatnonzero(
+                (block_indices >= minor_start) & (block_indices < minor_stop))
+            if not len(selected):
+                continue
+            major = numpy.searchsorted(indptr, start + selected, side="right") - 1
+            pieces.append((block_indices[selected], major, data[start:stop][selected]))
+        if pieces:
+            minor, major, values = (numpy.concatenate(p) for p in zip(*pieces))
+            order = numpy.argsort(minor, kind="mergesort")
+            first, last = target_indptr[minor_start], target_indptr[minor_stop]
+            target_data[first:last] = values[order]
+            target_indices[first:last] = major[order]
+        minor_start = minor_stop
+
+def transpose_sparse_hdf5(path, memory_mb=256):
+    """Add the transpose of an h5sparse "data" group, in the same format.
+
+    A csc file gains the csr arrays of its matrix and a csr file the csc ones,
+    so each file has the pair.
+    """
+
+    with h5py.File(path, "r+") as hdf5_file:
+        source = hdf5_file["data"]
+        format_str = source.attrs["h5sparse_format"]
+        if isinstance(format_str, bytes):
+            format_str = format_str.decode("ascii")
+        n_rows, n_columns = (int(n) for n in source.attrs["h5sparse_shape"])
+        n_major, n_minor = (n_rows, n_columns) if format_str == "csr" else (n_columns, n_rows)
+
+        if GENE_MAJOR in hdf5_file:
+            del hdf5_file[GENE_MAJOR]
+        target = hdf5_file.create_group(GENE_MAJOR)
+        target.attrs["h5sparse_format"] = format_str
+        target.attrs["h5sparse_shape"] = (n_columns, n_rows)
+        _recompress(source, target, n_major, n_minor, memory_mb)
+        target.attrs[TRANSPOSE_OF] = "data"
+
+def add_gene_major(path, format_, store_type="DirectoryStore", memory_mb=256):
+    """Add the gene-major copy to a matrix written by convert_to_<format_>."""
+
+    if format_ == "hdf5":
+        transpose_hdf5(path, memory_mb)
+    elif format_ == "zarr":
+        transpose_zarr(path, store_type, memory_mb)
+    elif format_ == "sparse_hdf5":
+        transpose_sparse_hdf5(path, memory_mb)
+    else:
+        raise ValueError("No gene-major layout for {}".format(format_))
+
+def layout_sizes(path, format_, store_type="DirectoryStore"):
+    """Bytes stored for "data" and the gene-major copy, if it exists."""
+
+    sizes = {}
+    if format_ == "zarr":
+        import zarr
+        store = zarr_stores.open_store(path, store_type, mode="r")
+        try:
+            root = zarr.open_group(store=store, mode="r")
+            for name in ("data", GENE_MAJOR):
+                if name in root:
+                    sizes[name] = root[name].nbytes_stored
+        finally:
+            zarr_stores.close_store(store)
+        return sizes
+
+    with h5py.File(path, "r") as hdf5_file:
+        for name in ("data", GENE_MAJOR):
+            if name not in hdf5_file:
+                continue
+            node = hdf5_file[name]
+            if isinstance(node, h5py.Group):
+                sizes[name] = sum(node[d].id.get_storage_size() for d in node)
+            else:
+                sizes[name] = node.id.get_storage_size()
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", required=True, choices=FORMATS,
+                        help="convert_to_<format> that wrote the matrices.")
+    parser.add_argument("--store-type", default="DirectoryStore",
+                        help="zarr store the matrices were written with.")
+    parser.add_argument("--memory-mb", type=int, default=256,
+                        help="Bound on the memory used for the blocks of the transpose.")
+    parser.add_argument("paths", nargs="+", help="Matrices to add a gene-major copy to.")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        start_time = time.perf_counter()
+        add_gene_major(path, args.format, args.store_type, args.memory_mb)
+        seconds = time.perf_counter() - start_time
+        sizes = layout_sizes(path, args.format, args.store_type)
+        print("{}: {:.2f} s, data {} bytes, {} {} bytes".format(
+            os.path.basename(path), seconds, sizes.get("data"), GENE_MAJOR,
+            sizes.get(GENE_MAJOR)))
+
+if __name__ == "__main__":
+    main()
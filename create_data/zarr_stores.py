@@ -0,0 +1,46 @@
+"""The zarr stores convert_to_zarr can write, and how to open them.
+
+A DirectoryStore keeps every chunk in its own file, which for a split source
+means thousands of tiny files per matrix. The other stores keep a whole matrix
+in one zip file, LMDB environment, SQLite database or gdbm file. Each gets its
+own suffix after .zarr, which the merge tasks use to pick the store to read.
+"""
+
+SUFFIXES = {
+    "DirectoryStore": ".zarr",
+    "ZipStore": ".zarr.zip",
+    "LMDBStore": ".zarr.lmdb",
+    "SQLiteStore": ".zarr.sqlite",
+    "DBMStore": ".zarr.dbm",
+}
+
+
+def open_store(path, store_type="DirectoryStore", mode="a"):
+    """Open a store for reading ("r"), writing from scratch ("w") or both ("a").
+
+    Stores other than DirectoryStore have to be closed for their writes to
+    reach the disk. DBMStore uses gdbm, which keeps the matrix in one file,
+    rather than whichever dbm module the dbm package finds first.
+    """
+
+    import zarr
+    if store_type not in SUFFIXES:
+        raise ValueError("Unknown zarr store {}, expected one of {}".format(
+            store_type, ", ".join(sorted(SUFFIXES))))
+    if store_type == "ZipStore":
+        return zarr.ZipStore(path, mode=mode)
+    if store_type == "LMDBStore":
+        if mode == "r":
+            return zarr.LMDBStore(path, readonly=True, lock=False)
+        return zarr.LMDBStore(path)
+    if store_type == "DBMStore":
+        import dbm.gnu
+        return zarr.DBMStore(path, flag={"r": "r", "w": "n", "a": "c"}[mode],
+                             open=dbm.gnu.open)
+    return getattr(zarr, store_type)(path)
+
+def close_store(store):
+    """Close a store, if it's a kind that needs it."""
+
+    if hasattr(store, "close"):
+        store.close()
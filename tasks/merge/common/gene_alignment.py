@@ -0,0 +1,96 @@
+"""Align matrices whose rows are different sets of genes.
+
+The merge tasks assume every input has the same genes in the same order. When
+they don't, a GeneIndex builds the union of their genes, with one output row
+per gene name, and gives each input the output row of each of its rows. The
+values of an input can then be placed with one numpy assignment,
+
+    merged[gene_index.add(gene_names), start:stop] = values
+
+instead of reindexing a dataframe per input. The rows for a gene list are
+cached under its length and first and last names, and a cached list is only
+used after one numpy comparison with the new one. Inputs with a layout that
+has been seen before, which is nearly all of them, cost that comparison, which
+is cheaper than hashing every name would be.
+"""
+
+import numpy
+
+
+def _decode(name):
+    if isinstance(name, bytes):
+        return name.decode("utf-8")
+    return name
+
+def gene_list_key(gene_names):
+    """A cheap key for a list of gene names: its length, first and last name.
+
+    Different lists can share a key, so the lists themselves are compared
+    before a cached layout is used.
+    """
+
+    if not len(gene_names):
+        return (0,)
+    return (len(gene_names), _decode(gene_names[0]), _decode(gene_names[-1]))
+
+
+class GeneIndex(object):
+    """The union of the genes of several inputs, in the order they were seen."""
+
+    def __init__(self, gene_names=()):
+        self.rows = {}
+        self.names = []
+        self._layouts = {}
+        if len(gene_names):
+            self.add(gene_names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, gene_names):
+        """Add the genes of one input, and return where its rows go.
+
+        The result indexes the output rows: a slice when the input's genes are
+        the first genes of the index in the same order, so values can be
+        copied without fancy indexing, or else an array with the output row
+        of each input row.
+        """
+
+        key = gene_list_key(gene_names)
+        gene_array = numpy.asarray(gene_names)
+        candidates = self._layouts.setdefault(key, [])
+        for cached_names, layout in candidates:
+            if cached_names is gene_array or numpy.array_equal(cached_names, gene_array):
+                return layout
+
+        positions = numpy.empty(len(gene_names), dtype=numpy.int64)
+        for i, name in enumerate(gene_names):
+            name = _decode(name)
+            row = self.rows.get(name)
+            if row is None:
+                row = self.rows[name] = len(self.names)
+                self.names.append(name)
+            positions[i] = row
+
+        if len(numpy.unique(positions)) != len(positions):
+            raise ValueError("Gene names of an input aren't unique, so its rows "
+                             "can't be aligned by name")
+        if numpy.array_equal(positions, numpy.arange(len(positions))):
+            layout = slice(0, len(positions))
+        else:
+            layout = positions
+        candidates.append((gene_array, layout))
+        return layout
+
+    @property
+    def n_layouts(self):
+        """How many distinct gene lists have been added."""
+        return sum(len(candidates) for candidates in self._layouts.values())
+
+
+def build_gene_index(gene_lists):
+    """Build the union index of several gene lists, and the layout of each."""
+
+    gene_index = GeneIndex()
+    layouts = [gene_index.add(gene_names) for gene_names in gene_lists]
+    return gene_index, layouts
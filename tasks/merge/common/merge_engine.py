@@ -0,0 +1,968 @@
+"""A format-agnostic engine for the merge tasks.
+
+A merge reads the input matrices as column blocks and writes them side by side
+into one output matrix. Here that is split into readers, one per input format,
+that give the shape, dtype and optionally row and column names of a file from
+its header and read any range of its columns; and writers, one per output
+format, that are created at the final shape and are handed the merged matrix in
+column blocks, in order. The engine schedules the reads once for every format:
+a pool of threads reads pieces of the inputs at most read_ahead pieces ahead of
+the writer, and the block width follows from a memory budget.
+
+Each task runs the engine as its --mode engine, next to its own merge modes,
+which stay as the baselines the benchmark compares it with. Helpers the tasks
+share otherwise are in merge_inputs.py.
+
+Readers and writers import their format's library when they are used, since
+each task's image only installs the libraries of its own format.
+
+Input paths can also be archives made by packed.py, whose members are read in
+place. Readers then get a packed.PackedMember instead of a path, and hand their
+library a file object, a zarr store or a memory map of the member.
+
+    merge_engine.merge(input_paths, output_path, "zarr", "zarr", workers=4)
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+
+import gene_alignment
+import packed
+import zarr_stores
+
+READERS = {}
+WRITERS = {}
+
+# The genes x cells copy that create_data/transpose.py adds next to the cells x
+# genes "data" of zarr and hdf5 files. Readers prefer it, as it is already in
+# the orientation of the merged matrix, once _check_gene_major has confirmed
+# that it is the transpose of "data".
+GENE_MAJOR = "data_gene_major"
+TRANSPOSE_OF = "transpose_of"
+
+
+def reader(format_):
+    """Register a reader class for a format."""
+
+    def register(cls):
+        READERS[format_] = cls
+        return cls
+    return register
+
+def writer(format_):
+    """Register a writer class for a format."""
+
+    def register(cls):
+        WRITERS[format_] = cls
+        return cls
+    return register
+
+
+def _check_gene_major(path, attrs, shape, data_shape):
+    """Raise a ValueError unless a gene-major copy is marked, and shaped, as
+    the transpose of "data".
+    """
+
+    if attrs.get(TRANSPOSE_OF) != "data":
+        raise ValueError("{} of {} isn't marked as the transpose of data, rerun "
+                         "create_data/transpose.py on it".format(GENE_MAJOR, path))
+    if tuple(shape) != tuple(data_shape)[::-1]:
+        raise ValueError("{} of {} has shape {}, not the transpose of the {} of "
+                         "data".format(GENE_MAJOR, path, tuple(shape), tuple(data_shape)))
+
+def _source(path):
+    """A file object for a packed member, or the path of a file."""
+
+    if isinstance(path, packed.PackedMember):
+        return path.open()
+    return path
+
+def _arrow_source(path):
+    """A pyarrow buffer of a packed member, mapped from the archive without a
+    copy, or the path of a file.
+    """
+
+    if not isinstance(path, packed.PackedMember):
+        return path
+    import pyarrow
+    offset, length = path.extent()
+    archive_map = pyarrow.memory_map(path.archive.path)
+    archive_map.seek(offset)
+    return pyarrow.BufferReader(archive_map.read_buffer(length))
+
+
+class Reader(object):
+    """Reads one input matrix. Subclasses set shape and dtype from the header
+    in __init__ and implement _read_columns. Reads of the same input are
+    serialized, so subclasses can cache what they opened until close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def row_names(self):
+        """The gene names of the rows, or None if the format has none."""
+        return None
+
+    def column_names(self):
+        """The cell names of the columns, or None if the format has none."""
+        return None
+
+    def read_columns(self, start, stop):
+        with self._lock:
+            return numpy.asarray(self._read_columns(start, stop))
+
+    def _read_columns(self, start, stop):
+        raise NotImplementedError
+
+    def close(self):
+        """Drop anything kept open or cached for reading."""
+        pass
+
+
+class Writer(object):
+    """Writes the output matrix, which has shape and dtype, from column
+    blocks given in order. chunk_columns is the width that blocks are rounded
+    to, if the format has a preference.
+    """
+
+    chunk_columns = 1
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        self.path = path
+        self.shape = shape
+        self.dtype = numpy.dtype(dtype)
+        self.row_names = row_names
+        self.column_names = column_names
+
+    def _column_names(self, start, stop):
+        """The names of columns start to stop, numbers if there are none."""
+
+        if self.column_names is None:
+            return [str(i) for i in range(start, stop)]
+        return [str(name) for name in self.column_names[start:stop]]
+
+    def write(self, column_offset, block):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class _SpillingWriter(Writer):
+    """A writer for formats that are written a row range at a time. Column
+    blocks go to a memory-mapped file next to the output, which is read back
+    in row blocks of at most block_rows by _write_rows on close.
+    """
+
+    block_rows = 10000
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(_SpillingWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        self._spill_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        self._spill = numpy.memmap(os.path.join(self._spill_dir, "matrix"), dtype=self.dtype,
+                                   mode="w+", shape=(max(shape[0], 1), max(shape[1], 1)))
+
+    def write(self, column_offset, block):
+        self._spill[:self.shape[0], column_offset:column_offset + block.shape[1]] = block
+
+    def close(self):
+        self._spill.flush()
+        for start in range(0, self.shape[0], self.block_rows):
+            stop = min(start + self.block_rows, self.shape[0])
+            self._write_rows(start, stop, self._spill[start:stop, :self.shape[1]])
+        self._finish()
+        del self._spill
+        shutil.rmtree(self._spill_dir)
+
+    def _write_rows(self, start, stop, rows):
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+
+def _load_npy(path):
+    """Memory-map an npy file, or a packed one where it lies in its archive."""
+
+    if not isinstance(path, packed.PackedMember):
+        return numpy.load(path, mmap_mode="r")
+    with path.open() as npy_file:
+        version = numpy.lib.format.read_magic(npy_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(npy_file)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(npy_file)
+        header_length = npy_file.tell()
+    return numpy.memmap(path.archive.path, dtype=dtype, mode="r", shape=shape,
+                        offset=path.extent()[0] + header_length,
+                        order="F" if fortran_order else "C")
+
+@reader("npy")
+class NpyReader(Reader):
+
+    def __init__(self, path):
+        super(NpyReader, self).__init__(path)
+        array = _load_npy(path)
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def _read_columns(self, start, stop):
+        return _load_npy(self.path)[:, start:stop]
+
+@writer("npy")
+class NpyWriter(Writer):
+    """Writes into a Fortran ordered memory-mapped .npy file."""
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(NpyWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        self._array = numpy.lib.format.open_memmap(
+            path, mode="w+", dtype=self.dtype, shape=shape, fortran_order=True)
+
+    def write(self, column_offset, block):
+        self._array[:, column_offset:column_offset + block.shape[1]] = block
+
+    def close(self):
+        self._array.flush()
+        del self._array
+
+
+@reader("zarr")
+class ZarrReader(Reader):
+
+    def __init__(self, path):
+        super(ZarrReader, self).__init__(path)
+        import zarr
+        if isinstance(path, packed.PackedMember):
+            self._array = zarr.open(path.store(), mode="r")
+        else:
+            self._array = zarr_stores.open_array(path)
+        if isinstance(self._array, zarr.hierarchy.Group):
+            group = self._array
+            self._array = group["data"]
+            if GENE_MAJOR in group:
+                gene_major = group[GENE_MAJOR]
+                _check_gene_major(path, gene_major.attrs, gene_major.shape, self._array.shape)
+                self._array = gene_major
+        self.shape = self._array.shape
+        self.dtype = self._array.dtype
+
+    def _read_columns(self, start, stop):
+        return self._array[:, start:stop]
+
+    def close(self):
+        zarr_stores.close_array(self._array)
+
+@writer("zarr")
+class ZarrWriter(Writer):
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None,
+                 chunks=(10000, 1000)):
+        super(ZarrWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        chunks = (min(max(shape[0], 1), chunks[0]), min(max(shape[1], 1), chunks[1]))
+        self.chunk_columns = chunks[1]
+        self._array = zarr_stores.open_array(path, mode="w", shape=shape, chunks=chunks,
+                                             dtype=self.dtype)
+
+    def write(self, column_offset, block):
+        self._array[:, column_offset:column_offset + block.shape[1]] = block
+
+    def close(self):
+        zarr_stores.close_array(self._array)
+
+
+@reader("hdf5")
+class Hdf5Reader(Reader):
+
+    dataset = "data"
+
+    def __init__(self, path):
+        super(Hdf5Reader, self).__init__(path)
+        import h5py
+        self._h5py = h5py
+        self._file = None
+        with h5py.File(_source(path), "r") as hdf5_file:
+            if GENE_MAJOR in hdf5_file:
+                gene_major = hdf5_file[GENE_MAJOR]
+                _check_gene_major(path, gene_major.attrs, gene_major.shape,
+                                  hdf5_file[self.dataset].shape)
+                self.dataset = GENE_MAJOR
+            self.shape = hdf5_file[self.dataset].shape
+            self.dtype = hdf5_file[self.dataset].dtype
+
+    def _dataset(self):
+        if self._file is None:
+            self._file = self._h5py.File(_source(self.path), "r")
+        return self._file[self.dataset]
+
+    def _read_columns(self, start, stop):
+        return self._dataset()[:, start:stop]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+@writer("hdf5")
+class Hdf5Writer(Writer):
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None, chunks=None,
+                 compression=None, compression_opts=None):
+        super(Hdf5Writer, self).__init__(path, shape, dtype, row_names, column_names)
+        import h5py
+        if chunks:
+            chunks = (min(max(shape[0], 1), chunks[0]), min(max(shape[1], 1), chunks[1]))
+            self.chunk_columns = chunks[1]
+        self._file = h5py.File(path, "w")
+        self._dataset = self._file.create_dataset(
+            "data", shape, dtype=self.dtype, chunks=chunks, compression=compression,
+            compression_opts=compression_opts)
+
+    def write(self, column_offset, block):
+        self._dataset[:, column_offset:column_offset + block.shape[1]] = block
+
+    def close(self):
+        self._file.close()
+
+
+@reader("sparse_hdf5")
+class SparseHdf5Reader(Hdf5Reader):
+    """Reads the h5sparse layout: a "data" group with data, indices and
+    indptr datasets. csc columns are read directly; a csr matrix is read
+    whole on first use and kept until close().
+
+    With a gene-major copy the file has both formats, and the columns are read
+    from whichever is compressed by cell: a csc copy, or a csr "data" whose
+    rows are the cells.
+    """
+
+    def __init__(self, path):
+        Reader.__init__(self, path)
+        import h5py
+        import scipy.sparse
+        self._h5py = h5py
+        self._scipy_sparse = scipy.sparse
+        self._file = None
+        self._matrix = None
+        with h5py.File(_source(path), "r") as hdf5_file:
+            if GENE_MAJOR in hdf5_file:
+                gene_major = hdf5_file[GENE_MAJOR]
+                _check_gene_major(path, gene_major.attrs, gene_major.attrs["h5sparse_shape"],
+                                  hdf5_file[self.dataset].attrs["h5sparse_shape"])
+                self.dataset = GENE_MAJOR
+            group = hdf5_file[self.dataset]
+            self.shape = tuple(int(n) for n in group.attrs["h5sparse_shape"])
+            self.dtype = group["data"].dtype
+            self.format_str = group.attrs["h5sparse_format"]
+            if isinstance(self.format_str, bytes):
+                self.format_str = self.format_str.decode("ascii")
+        self._transposed = self.dataset == GENE_MAJOR and self.format_str == "csr"
+        if self._transposed:
+            self.dataset = "data"
+
+    def _read_columns(self, start, stop):
+        group = self._dataset()
+        if self.format_str == "csc" or self._transposed:
+            indptr = group["indptr"][start:stop + 1]
+            values = (group["data"][indptr[0]:indptr[-1]],
+                      group["indices"][indptr[0]:indptr[-1]],
+                      indptr - indptr[0])
+            if self._transposed:
+                return self._scipy_sparse.csr_matrix(
+                    values, shape=(stop - start, self.shape[0])).toarray().T
+            return self._scipy_sparse.csc_matrix(
+                values, shape=(self.shape[0], stop - start)).toarray()
+        if self._matrix is None:
+            self._matrix = self._scipy_sparse.csr_matrix(
+                (group["data"][:], group["indices"][:], group["indptr"][:]),
+                shape=self.shape).tocsc()
+        return self._matrix[:, start:stop].toarray()
+
+    def close(self):
+        super(SparseHdf5Reader, self).close()
+        self._matrix = None
+
+@writer("sparse_hdf5")
+class SparseHdf5Writer(Writer):
+    """Writes a csc matrix in the h5sparse layout, appending the non-zero
+    values of each block to resizable datasets.
+    """
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(SparseHdf5Writer, self).__init__(path, shape, dtype, row_names, column_names)
+        import h5py
+        self._file = h5py.File(path, "w", libver="latest")
+        group = self._file.create_group("data")
+        group.attrs["h5sparse_format"] = "csc"
+        group.attrs["h5sparse_shape"] = shape
+        self._data = group.create_dataset("data", (0,), dtype=self.dtype,
+                                          maxshape=(None,), chunks=(1 << 16,))
+        self._indices = group.create_dataset(
+            "indices", (0,), dtype=numpy.min_scalar_type(max(shape[0], 1)),
+            maxshape=(None,), chunks=(1 << 16,))
+        self._indptr = group.create_dataset("indptr", (shape[1] + 1,), dtype=numpy.int64)
+        self._indptr[0] = 0
+        self._nnz = 0
+
+    def write(self, column_offset, block):
+        columns, rows = numpy.nonzero(block.T)
+        counts = numpy.bincount(columns, minlength=block.shape[1])
+        nnz = len(rows)
+        self._data.resize((self._nnz + nnz,))
+        self._indices.resize((self._nnz + nnz,))
+        self._data[self._nnz:] = block[rows, columns]
+        self._indices[self._nnz:] = rows
+        self._indptr[column_offset + 1:column_offset + block.shape[1] + 1] = \
+            self._nnz + numpy.cumsum(counts)
+        self._nnz += nnz
+
+    def close(self):
+        self._file.close()
+
+
+@reader("loom")
+class LoomReader(Hdf5Reader):
+    """Reads the loom matrix with h5py. Rows are named by the "Gene" row
+    attribute. Files without one have their rows named by number, so they are
+    aligned by row order.
+    """
+
+    dataset = "matrix"
+
+    def row_names(self):
+        with self._h5py.File(_source(self.path), "r") as loom_file:
+            if "Gene" in loom_file["row_attrs"]:
+                return loom_file["row_attrs"]["Gene"][:]
+        return numpy.arange(self.shape[0])
+
+@writer("loom")
+class LoomWriter(Writer):
+    """Creates the loom file with loompy from the first block, then grows the
+    matrix with h5py. loompy chunks the matrix 64 columns wide.
+    """
+
+    chunk_columns = 64
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(LoomWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        self._file = None
+
+    def write(self, column_offset, block):
+        if self._file is None:
+            import h5py
+            import loompy
+            row_attrs = {}
+            if self.row_names is not None:
+                row_attrs["Gene"] = numpy.asarray(self.row_names)
+            loompy.create(self.path, block.astype(self.dtype, copy=False), row_attrs, {})
+            self._file = h5py.File(self.path, "r+")
+            self._file["matrix"].resize(self.shape[1], axis=1)
+        else:
+            self._file["matrix"][:, column_offset:column_offset + block.shape[1]] = block
+
+    def close(self):
+        self._file.close()
+
+
+@reader("parquet")
+class ParquetReader(Reader):
+    """Reads the value columns of a parquet file written from pandas. Rows are
+    named by its index.
+    """
+
+    def __init__(self, path):
+        super(ParquetReader, self).__init__(path)
+        import json
+        import pyarrow.parquet
+        self._parquet = pyarrow.parquet
+        schema = pyarrow.parquet.read_schema(_arrow_source(path))
+        self._index_columns = []
+        if schema.metadata and b"pandas" in schema.metadata:
+            self._index_columns = [
+                name for name in json.loads(schema.metadata[b"pandas"].decode("utf-8"))[
+                    "index_columns"] if isinstance(name, str)]
+        self.columns = [name for name in schema.names if name not in self._index_columns]
+        self.shape = (pyarrow.parquet.read_metadata(_arrow_source(path)).num_rows,
+                      len(self.columns))
+        self.dtype = numpy.result_type(*[schema.field(name).type.to_pandas_dtype()
+                                         for name in self.columns])
+
+    def row_names(self):
+        if not self._index_columns:
+            return None
+        return self._parquet.read_table(_arrow_source(self.path),
+                                        columns=self._index_columns[:1]) \
+            .column(0).to_pylist()
+
+    def column_names(self):
+        return self.columns
+
+    def _read_columns(self, start, stop):
+        table = self._parquet.read_table(_arrow_source(self.path),
+                                         columns=self.columns[start:stop])
+        return _table_values(table, self.shape[0], self.dtype)
+
+def _table_values(table, n_rows, dtype):
+    values = numpy.empty((n_rows, table.num_columns), dtype=dtype)
+    for i in range(table.num_columns):
+        values[:, i] = table.column(i).to_pandas()
+    return values
+
+def _arrow_table(rows, column_names, row_names=None):
+    import pyarrow
+    arrays = [pyarrow.array(rows[:, i]) for i in range(rows.shape[1])]
+    names = list(column_names)
+    if row_names is not None:
+        arrays.append(pyarrow.array([str(name) for name in row_names], type=pyarrow.string()))
+        names.append("index")
+    return pyarrow.Table.from_arrays(arrays, names=names)
+
+@writer("parquet")
+class ParquetWriter(_SpillingWriter):
+    """Writes row groups of block_rows rows. Columns are named like the input
+    columns, or by number for inputs without names, and row names, if there
+    are any, go in an "index" column that pandas reads as the index.
+    """
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(ParquetWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        self._writer = None
+
+    def _write_rows(self, start, stop, rows):
+        import pandas
+        import pyarrow
+        import pyarrow.parquet
+        row_names = None if self.row_names is None else \
+            [str(name) for name in self.row_names[start:stop]]
+        dataframe = pandas.DataFrame(rows, index=row_names,
+                                     columns=self._column_names(0, rows.shape[1]))
+        dataframe.index.name = "index"
+        table = pyarrow.Table.from_pandas(dataframe, preserve_index=row_names is not None)
+        if start == 0:
+            self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def _finish(self):
+        if self._writer is None:
+            # A matrix without rows still gets a file with its columns
+            self._write_rows(0, 0, self._spill[:0, :self.shape[1]])
+        self._writer.close()
+
+
+@reader("feather")
+class FeatherReader(Reader):
+    """Reads a feather file written from pandas with reset_index(), so the
+    "index" column names the rows.
+    """
+
+    def __init__(self, path):
+        super(FeatherReader, self).__init__(path)
+        import pyarrow.feather
+        self._table = pyarrow.feather.read_table(_arrow_source(path), memory_map=True)
+        self.columns = [name for name in self._table.column_names if name != "index"]
+        self.shape = (self._table.num_rows, len(self.columns))
+        self.dtype = numpy.result_type(*[self._table.schema.field(name).type.to_pandas_dtype()
+                                         for name in self.columns])
+
+    def row_names(self):
+        if "index" not in self._table.column_names:
+            return None
+        return self._table.column("index").to_pylist()
+
+    def column_names(self):
+        return self.columns
+
+    def _read_columns(self, start, stop):
+        return _table_values(self._table.select(self.columns[start:stop]),
+                             self.shape[0], self.dtype)
+
+@writer("feather")
+class FeatherWriter(_SpillingWriter):
+    """Writes Feather v2, an Arrow IPC file, one record batch per block_rows
+    rows. Columns are named like the input columns, and row names go in an
+    "index" column, like the converters write it.
+    """
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(FeatherWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        self._writer = None
+
+    def _write_rows(self, start, stop, rows):
+        import pyarrow
+        row_names = None if self.row_names is None else self.row_names[start:stop]
+        table = _arrow_table(rows, self._column_names(0, rows.shape[1]), row_names)
+        if start == 0:
+            self._writer = pyarrow.ipc.new_file(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def _finish(self):
+        if self._writer is None:
+            # A matrix without rows still gets a file with its columns
+            self._write_rows(0, 0, self._spill[:0, :self.shape[1]])
+        self._writer.close()
+
+
+@reader("matrix_market")
+class MatrixMarketReader(Reader):
+    """Parses the whole file on first use and keeps it until close()."""
+
+    def __init__(self, path):
+        super(MatrixMarketReader, self).__init__(path)
+        import scipy.io
+        self._scipy_io = scipy.io
+        n_rows, n_columns, _, _, field, _ = scipy.io.mminfo(_source(path))
+        self.shape = (n_rows, n_columns)
+        self.dtype = numpy.dtype("int64" if field == "integer" else "float64")
+        self._matrix = None
+
+    def _read_columns(self, start, stop):
+        if self._matrix is None:
+            self._matrix = self._scipy_io.mmread(_source(self.path)).tocsc()
+        return self._matrix[:, start:stop].toarray()
+
+    def close(self):
+        self._matrix = None
+
+@writer("matrix_market")
+class MatrixMarketWriter(Writer):
+    """Writes the coordinates of the non-zero values of each block as they
+    arrive. The number of entries isn't known until the end, so the size line
+    is padded and rewritten on close.
+    """
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(MatrixMarketWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        self._field = "integer" if self.dtype.kind in "iub" else "real"
+        self._file = open(path, "wb")
+        self._file.write("%%MatrixMarket matrix coordinate {} general\n%\n".format(
+            self._field).encode("ascii"))
+        self._size_offset = self._file.tell()
+        self._file.write(self._size_line(0))
+        self._nnz = 0
+
+    def _size_line(self, nnz):
+        return "{} {} {:<20d}\n".format(self.shape[0], self.shape[1], nnz).encode("ascii")
+
+    def write(self, column_offset, block):
+        columns, rows = numpy.nonzero(block.T)
+        entries = numpy.column_stack([rows + 1, columns + column_offset + 1,
+                                      block[rows, columns]])
+        numpy.savetxt(self._file, entries,
+                      fmt="%d %d %d" if self._field == "integer" else "%d %d %.17g")
+        self._nnz += len(rows)
+
+    def close(self):
+        self._file.seek(self._size_offset)
+        self._file.write(self._size_line(self._nnz))
+        self._file.close()
+
+
+def _open_text(path):
+    """Open a file for reading lines, decompressing it if it's gzipped."""
+
+    import gzip
+    if not isinstance(path, packed.PackedMember):
+        with open(path, "rb") as raw_file:
+            gzipped = raw_file.read(2) == b"\x1f\x8b"
+        return gzip.open(path, "rt") if gzipped else open(path)
+    raw_file = path.open()
+    if raw_file.peek(2)[:2] == b"\x1f\x8b":
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=raw_file))
+    return io.TextIOWrapper(raw_file)
+
+@reader("csv")
+class CsvReader(Reader):
+    """Reads a CSV file with a header of gene names and a row per cell, named
+    in the first column, gzipped or not. The merged matrix has its transpose.
+    The cells are counted by decompressing the file without parsing it, and
+    the dtype is guessed from the first row. The file is parsed with pyarrow
+    on first use and kept until close().
+    """
+
+    def __init__(self, path):
+        super(CsvReader, self).__init__(path)
+        import csv
+        with _open_text(path) as csv_file:
+            rows = csv.reader(csv_file)
+            self._gene_names = next(rows)[1:]
+            first_row = next(rows, [])
+            self._cell_names = first_row[:1] + [
+                line.split(",", 1)[0].strip('"') for line in csv_file]
+            first_row = first_row[1:]
+        self.shape = (len(self._gene_names), len(self._cell_names))
+        self.dtype = numpy.dtype("int64")
+        if any(not value.lstrip("-").isdigit() for value in first_row):
+            self.dtype = numpy.dtype("float64")
+        self._values = None
+
+    def row_names(self):
+        return self._gene_names
+
+    def column_names(self):
+        return self._cell_names
+
+    def _read_columns(self, start, stop):
+        if self._values is None:
+            import pyarrow.csv
+            source = _arrow_source(self.path)
+            # pyarrow only tells gzip from the name of a file
+            if isinstance(self.path, packed.PackedMember) and self.path.name.endswith(".gz"):
+                source = pyarrow.CompressedInputStream(source, "gzip")
+            table = pyarrow.csv.read_csv(source)
+            self._values = _table_values(table.select(range(1, table.num_columns)),
+                                         self.shape[1], self.dtype).T
+        return self._values[:, start:stop]
+
+    def close(self):
+        self._values = None
+
+@writer("csv")
+class CsvWriter(Writer):
+    """Writes a row per cell, like the inputs, named like the input cells. The
+    blocks are transposed into record batches for pyarrow's CSV writer as they
+    arrive.
+    """
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(CsvWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        import pyarrow
+        self._pyarrow = pyarrow
+        gene_names = row_names if row_names is not None else range(shape[0])
+        self._names = [""] + [str(name) for name in gene_names]
+        self._writer = None
+
+    def write(self, column_offset, block):
+        cell_names = self._column_names(column_offset, column_offset + block.shape[1])
+        batch = self._pyarrow.RecordBatch.from_arrays(
+            [self._pyarrow.array(cell_names)]
+            + [self._pyarrow.array(block[i]) for i in range(block.shape[0])],
+            names=self._names)
+        if self._writer is None:
+            import pyarrow.csv
+            self._writer = pyarrow.csv.CSVWriter(self.path, batch.schema)
+        self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+
+
+@reader("anndata")
+class AnndataReader(Hdf5Reader):
+    """Reads the dense X of an h5ad file. X has a row per cell, so the merged
+    matrix has its transpose, with rows named by the var names.
+    """
+
+    dataset = "X"
+
+    def __init__(self, path):
+        super(AnndataReader, self).__init__(path)
+        self.shape = self.shape[::-1]
+
+    def row_names(self):
+        import anndata
+        if isinstance(self.path, packed.PackedMember):
+            raise ValueError("anndata reads var names from a file name, not from {}".format(
+                self.path))
+        adata = anndata.read_h5ad(self.path, backed="r")
+        names = list(adata.var_names)
+        adata.file.close()
+        return names
+
+    def _read_columns(self, start, stop):
+        return self._dataset()[start:stop].T
+
+@writer("anndata")
+class AnndataWriter(Writer):
+    """Writes an h5ad file with cells named like the input columns, or by
+    number, and X filled a block of cells at a time through h5py.
+    """
+
+    def __init__(self, path, shape, dtype, row_names=None, column_names=None):
+        super(AnndataWriter, self).__init__(path, shape, dtype, row_names, column_names)
+        import anndata
+        import h5py
+        import pandas
+        var_names = row_names if row_names is not None else range(shape[0])
+        anndata.AnnData(
+            obs=pandas.DataFrame(index=self._column_names(0, shape[1])),
+            var=pandas.DataFrame(index=[str(name) for name in var_names])
+        ).write(path)
+        self._file = h5py.File(path, "r+")
+        self._x = self._file.create_dataset("X", shape[::-1], dtype=self.dtype)
+        # Files written by anndata 0.8 and later label every element
+        if "encoding-type" in self._file.attrs:
+            self._x.attrs["encoding-type"] = "array"
+            self._x.attrs["encoding-version"] = "0.2.0"
+
+    def write(self, column_offset, block):
+        self._x[column_offset:column_offset + block.shape[1]] = block.T
+
+    def close(self):
+        self._file.close()
+
+
+def _column_pieces(readers, block_columns):
+    """Split the columns of each input where they cross a block boundary.
+
+    Yields (reader, first column in the input, first column in the output,
+    number of columns, whether it's the input's last piece).
+    """
+
+    output_column = 0
+    for input_reader in readers:
+        input_column = 0
+        while input_column < input_reader.shape[1]:
+            width = min(input_reader.shape[1] - input_column,
+                        block_columns - output_column % block_columns)
+            yield (input_reader, input_column, output_column, width,
+                   input_column + width == input_reader.shape[1])
+            input_column += width
+            output_column += width
+
+def _column_names(readers):
+    """The names of the merged columns, numbered for inputs without names, or
+    None if no input has any.
+    """
+
+    names = [input_reader.column_names() for input_reader in readers]
+    if all(input_names is None for input_names in names):
+        return None
+    merged = []
+    for input_reader, input_names in zip(readers, names):
+        if input_names is None:
+            input_names = range(len(merged), len(merged) + input_reader.shape[1])
+        merged.extend(str(name) for name in input_names)
+    return merged
+
+def block_columns_for(n_rows, dtype, read_ahead, memory_mb, chunk_columns=1):
+    """The widest block, in whole chunks, for which the output buffer and
+    read_ahead pieces fit in memory_mb.
+    """
+
+    column_bytes = max(n_rows, 1) * numpy.dtype(dtype).itemsize
+    columns = (memory_mb << 20) // (column_bytes * (read_ahead + 1))
+    return max(1, columns // chunk_columns) * chunk_columns
+
+def merge(input_paths, output_path, reader_format, writer_format, workers=1,
+          read_ahead=4, memory_mb=512, align_genes=False, writer_options=None):
+    """Merge the inputs column-wise into output_path.
+
+    Archives among the inputs stand for their members, in order, and are
+    closed once the merge ends.
+
+    The input headers are read first to size the output. With align_genes
+    the rows are matched by gene name through a gene_alignment.GeneIndex,
+    otherwise every input must have the same number of rows. The pieces of
+    the inputs are then read by workers threads, at most read_ahead pieces
+    ahead, copied into a buffer one block wide, and each full buffer is handed
+    to the writer.
+    """
+
+    input_paths, archives = packed.expand(input_paths)
+    with contextlib.ExitStack() as stack:
+        for archive in archives:
+            stack.callback(archive.close)
+        readers = [READERS[reader_format](path) for path in input_paths]
+        dtype = numpy.result_type(*[input_reader.dtype for input_reader in readers])
+        n_columns = sum(input_reader.shape[1] for input_reader in readers)
+
+        if align_genes:
+            gene_lists = [input_reader.row_names() for input_reader in readers]
+            if any(gene_list is None for gene_list in gene_lists):
+                raise ValueError("{} inputs have no gene names to align".format(reader_format))
+            gene_index, layouts = gene_alignment.build_gene_index(gene_lists)
+            n_rows = len(gene_index)
+            row_names = gene_index.names
+            print("Aligned", gene_index.n_layouts, "gene layouts to", n_rows, "genes")
+        else:
+            n_rows = readers[0].shape[0]
+            for input_reader in readers:
+                if input_reader.shape[0] != n_rows:
+                    raise ValueError("{} has {} rows, expected {}. Try aligning genes.".format(
+                        input_reader.path, input_reader.shape[0], n_rows))
+            layouts = [slice(0, n_rows)] * len(readers)
+            row_names = readers[0].row_names()
+        layout_of = {str(input_reader.path): layout
+                     for input_reader, layout in zip(readers, layouts)}
+        column_names = _column_names(readers)
+
+        output_writer = WRITERS[writer_format](
+            output_path, (n_rows, n_columns), dtype, row_names=row_names,
+            column_names=column_names, **(writer_options or {}))
+        block_columns = min(max(n_columns, 1), block_columns_for(
+            n_rows, dtype, read_ahead, memory_mb, output_writer.chunk_columns))
+        print("Merging", len(readers), reader_format, "inputs into", (n_rows, n_columns),
+              dtype, writer_format, "in blocks of", block_columns, "columns")
+
+        buffer = numpy.zeros((n_rows, block_columns), dtype=dtype)
+        buffer_start = 0
+        pending = collections.deque()
+
+        def write_piece(buffer_start):
+            input_reader, output_column, width, last, future = pending.popleft()
+            piece = future.result()
+            if last:
+                input_reader.close()
+            buffer[layout_of[str(input_reader.path)],
+                   output_column - buffer_start:output_column - buffer_start + width] = piece
+            buffer_end = output_column + width
+            if buffer_end - buffer_start == block_columns or buffer_end == n_columns:
+                output_writer.write(buffer_start, buffer[:, :buffer_end - buffer_start])
+                if align_genes:
+                    buffer[:] = 0
+                buffer_start = buffer_end
+            return buffer_start
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for input_reader, input_column, output_column, width, last in _column_pieces(
+                    readers, block_columns):
+                pending.append((input_reader, output_column, width, last, executor.submit(
+                    input_reader.read_columns, input_column, input_column + width)))
+                if len(pending) > read_ahead:
+                    buffer_start = write_piece(buffer_start)
+            while pending:
+                buffer_start = write_piece(buffer_start)
+        output_writer.close()
+
+
+def add_arguments(test_group, format_, read_ahead=True, align_genes=True):
+    """Add the engine's arguments to a task's test subcommand, leaving out
+    --read-ahead and --align-genes for tasks that already have them.
+    --align-genes is only added for formats whose reader has gene names.
+    """
+
+    if read_ahead:
+        test_group.add_argument(
+            "--read-ahead",
+            type=int,
+            default=4,
+            help="How many input pieces may be read ahead of the writer."
+        )
+    test_group.add_argument(
+        "--memory-mb",
+        type=int,
+        default=512,
+        help="Memory budget of the engine's block buffer and read-ahead, in MB."
+    )
+    if align_genes and READERS[format_].row_names is not Reader.row_names:
+        test_group.add_argument(
+            "--align-genes",
+            action="store_true",
+            help="Match the rows of the inputs by gene name, in engine mode."
+        )
+
+def merge_from_args(args, format_, output_path=None, writer_options=None):
+    """Run the engine with the arguments of a task's test subcommand."""
+
+    merge(args.input_paths, output_path or args.output_path, format_, format_,
+          workers=args.workers, read_ahead=args.read_ahead, memory_mb=args.memory_mb,
+          align_genes=getattr(args, "align_genes", False), writer_options=writer_options)
@@ -0,0 +1,66 @@
+"""Helpers for the inputs of the merge tasks: which inputs an appended output
+still lacks, reading inputs in order with a pool of threads, and splitting
+them between processes.
+"""
+
+import collections
+import concurrent.futures
+import os
+
+import numpy
+
+
+def new_inputs(input_paths, included):
+    """The absolute paths of the inputs that aren't included yet, in order."""
+
+    seen = set(included)
+    new_paths = []
+    for input_path in input_paths:
+        input_path = os.path.abspath(input_path)
+        if input_path not in seen:
+            seen.add(input_path)
+            new_paths.append(input_path)
+    return new_paths
+
+def read_all(paths, read, workers=1):
+    """Read every path with read, returning the results in input order.
+
+    With more than one worker the reads run in a pool of threads, which only
+    helps when read releases the GIL for most of its time, like the file I/O,
+    decompression and C decoders behind numpy, h5py and pyarrow.
+    """
+
+    if workers <= 1:
+        return [read(path) for path in paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read, paths))
+
+def read_in_order(items, read, workers=1, read_ahead=4):
+    """Yield (item, read(item)) for each item in order.
+
+    With more than one worker the reads run in a pool of threads, at most
+    read_ahead items ahead of the caller, so memory holds a few results
+    rather than all of them.
+    """
+
+    if workers <= 1:
+        for item in items:
+            yield item, read(item)
+        return
+
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append((item, executor.submit(read, item)))
+            if len(pending) > read_ahead:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+def split_ranges(count, parts):
+    """Split range(count) into at most parts contiguous (start, stop) ranges."""
+
+    bounds = numpy.linspace(0, count, min(count, parts) + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
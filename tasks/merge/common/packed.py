@@ -0,0 +1,358 @@
+"""Pack many small matrix files into one archive that is read in place.
+
+A split source like GSE84465_split is thousands of tiny files per format, and
+opening each one, and reading its metadata, costs more than reading its values.
+An archive holds the files of any format back to back, with an index at the
+end, so a merge opens one file and finds every input by offset:
+
+    member files, concatenated in input order
+    index, JSON: {"version": 1, "members": [...], "files": {name: [offset, length]}}
+    length of the index, 8 bytes little endian
+    MAGIC
+
+A member is a file, or a directory like a zarr store, whose files are indexed as
+"<member>/<path in the directory>". Members are named "<input index>/<base name>",
+since the inputs of a split source all have the same base name in directories
+of their own. Nothing is extracted: members are read through file objects over
+the archive, or a zarr store for directories. merge_engine.merge takes archives,
+recognised by their .pack suffix, among its input paths. The other merge modes
+of the tasks don't, and take the separate files.
+
+    python3 packed.py pack --input-paths /data/*/numpy_GSE84465_split.npy --output-path cells.pack
+    python3 packed.py benchmark --format npy --input-paths /data/*/numpy_GSE84465_split.npy --work-dir /tmp/bench
+"""
+
+import argparse
+import collections.abc
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import time
+
+import numpy
+
+MAGIC = b"MTXPACK1"
+INDEX_VERSION = 1
+SUFFIX = ".pack"
+
+# Index length and magic string at the very end of an archive
+_TAIL = struct.Struct("<Q8s")
+
+
+def _member_files(path, name):
+    """Yield the (indexed name, path) of every file of a member, in a fixed order."""
+
+    if not os.path.isdir(path):
+        yield name, path
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            yield name + "/" + os.path.relpath(file_path, path).replace(os.sep, "/"), file_path
+
+def pack(input_paths, archive_path):
+    """Write the inputs into one archive, keeping their order.
+
+    Members are named by their index and base name, which keeps the extension
+    that readers go by. The archive is written next to archive_path and renamed
+    into place once the index is written.
+    """
+
+    if not archive_path.endswith(SUFFIX):
+        raise ValueError("Archive path {} doesn't end with {}".format(archive_path, SUFFIX))
+    members = []
+    files = {}
+    with open(archive_path + ".part", "wb") as archive_file:
+        for index, input_path in enumerate(input_paths):
+            name = "{}/{}".format(index, os.path.basename(os.path.normpath(input_path)))
+            members.append(name)
+            for file_name, file_path in _member_files(input_path, name):
+                offset = archive_file.tell()
+                with open(file_path, "rb") as member_file:
+                    shutil.copyfileobj(member_file, archive_file, 1 << 20)
+                files[file_name] = [offset, archive_file.tell() - offset]
+        index = json.dumps({"version": INDEX_VERSION, "members": members, "files": files})
+        index = index.encode("utf-8")
+        archive_file.write(index)
+        archive_file.write(_TAIL.pack(len(index), MAGIC))
+    os.replace(archive_path + ".part", archive_path)
+    return len(members), len(files)
+
+def is_archive(path):
+    """Whether path is a file with the archive suffix that ends like an archive.
+
+    Other paths aren't opened, so checking the inputs of a merge of separate
+    files costs nothing.
+    """
+
+    if not path.endswith(SUFFIX) or not os.path.isfile(path) or os.path.getsize(path) < _TAIL.size:
+        return False
+    with open(path, "rb") as archive_file:
+        archive_file.seek(-len(MAGIC), os.SEEK_END)
+        return archive_file.read() == MAGIC
+
+
+class PackedArchive(object):
+    """An archive opened for reading. All reads are os.pread calls on one
+    descriptor, which has no position to share, so members can be read from
+    several threads at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        size = os.fstat(self._fd).st_size
+        if size < _TAIL.size:
+            raise ValueError("{} is too short to be an archive".format(path))
+        index_length, magic = _TAIL.unpack(os.pread(self._fd, _TAIL.size, size - _TAIL.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not an archive".format(path))
+        index = json.loads(os.pread(
+            self._fd, index_length, size - _TAIL.size - index_length).decode("utf-8"))
+        if index["version"] != INDEX_VERSION:
+            raise ValueError("{} has index version {}, expected {}".format(
+                path, index["version"], INDEX_VERSION))
+        self.members = index["members"]
+        self.files = index["files"]
+
+    def extent(self, name):
+        """The offset and length of a file in the archive."""
+        offset, length = self.files[name]
+        return offset, length
+
+    def read(self, name):
+        offset, length = self.extent(name)
+        return os.pread(self._fd, length, offset)
+
+    def open(self, name):
+        """A seekable, read-only file object for one file of the archive."""
+        return io.BufferedReader(_MemberFile(self._fd, *self.extent(name)))
+
+    def close(self):
+        os.close(self._fd)
+
+class _MemberFile(io.RawIOBase):
+    """The bytes of one file of an archive, as a raw file. Closing it leaves
+    the archive open.
+    """
+
+    def __init__(self, fd, offset, length):
+        super(_MemberFile, self).__init__()
+        self._fd = fd
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._length
+        self._position = max(0, position)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), self._length - self._position))
+        data = os.pread(self._fd, count, self._offset + self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+class PackedStore(collections.abc.MutableMapping):
+    """A read-only zarr store over a directory member of an archive."""
+
+    def __init__(self, archive, name):
+        self._archive = archive
+        self._prefix = name + "/"
+
+    def __getitem__(self, key):
+        try:
+            return self._archive.read(self._prefix + key)
+        except KeyError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._prefix + key in self._archive.files
+
+    def __iter__(self):
+        for name in self._archive.files:
+            if name.startswith(self._prefix):
+                yield name[len(self._prefix):]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("Archives are read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("Archives are read-only")
+
+class PackedMember(object):
+    """One member of an archive, which the merge engine's readers take in
+    place of a path.
+    """
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+
+    def open(self):
+        return self.archive.open(self.name)
+
+    def extent(self):
+        return self.archive.extent(self.name)
+
+    def store(self):
+        return PackedStore(self.archive, self.name)
+
+    def __str__(self):
+        return "{}[{}]".format(self.archive.path, self.name)
+
+def expand(input_paths):
+    """The input paths, with every archive replaced by its members in order,
+    and the archives opened for them, which the caller closes once it's done
+    with the members.
+    """
+
+    expanded = []
+    archives = []
+    try:
+        for input_path in input_paths:
+            if isinstance(input_path, str) and is_archive(input_path):
+                archives.append(PackedArchive(input_path))
+                expanded.extend(PackedMember(archives[-1], name)
+                                for name in archives[-1].members)
+            else:
+                expanded.append(input_path)
+    except Exception:
+        for archive in archives:
+            archive.close()
+        raise
+    return expanded, archives
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def _drop_caches():
+    subprocess.check_call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as drop_caches:
+        drop_caches.write("3\n")
+
+def benchmark(input_paths, format_, work_dir, repetitions=3, workers=1, drop_caches=False):
+    """Time engine merges of the inputs as files and as one archive.
+
+    The inputs are packed once, then the two merges alternate so they see
+    the same state of the page cache, unless drop_caches empties it before
+    every merge, which needs root.
+    """
+
+    import merge_engine
+
+    os.makedirs(work_dir, exist_ok=True)
+    archive_path = os.path.join(work_dir, "inputs.pack")
+    start_time = time.perf_counter()
+    n_members, n_files = pack(input_paths, archive_path)
+    print("Packed {} inputs, {} files, in {:.2f} s".format(
+        n_members, n_files, time.perf_counter() - start_time))
+
+    times = {"files": [], "packed": []}
+    sources = {"files": input_paths, "packed": [archive_path]}
+    for _ in range(repetitions):
+        for name in sorted(times):
+            output_path = os.path.join(work_dir, "merged_" + name)
+            _remove(output_path)
+            if drop_caches:
+                _drop_caches()
+            start_time = time.perf_counter()
+            merge_engine.merge(sources[name], output_path, format_, format_, workers=workers)
+            times[name].append(time.perf_counter() - start_time)
+            _remove(output_path)
+    for name in sorted(times):
+        print("{}: median {:.2f} s of {}".format(
+            name, numpy.median(times[name]), ", ".join("{:.2f}".format(t) for t in times[name])))
+    return times
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="subcommand")
+
+    pack_group = subparsers.add_parser("pack", help="Pack matrix files into an archive.")
+    list_group = subparsers.add_parser("list", help="List the members of an archive.")
+    benchmark_group = subparsers.add_parser(
+        "benchmark", help="Compare engine merges of files and of an archive of them.")
+
+    for group in (pack_group, benchmark_group):
+        group.add_argument(
+            "--input-paths",
+            required=True,
+            nargs="+",
+            help="Matrix files or directories, in merge order."
+        )
+    pack_group.add_argument(
+        "--output-path",
+        required=True,
+        help="Where to write the archive, a path ending in .pack."
+    )
+    list_group.add_argument("archive", help="Path to the archive.")
+    benchmark_group.add_argument(
+        "--format",
+        required=True,
+        help="Format of the inputs, and of the merged outputs."
+    )
+    benchmark_group.add_argument(
+        "--work-dir",
+        required=True,
+        help="Where to write the archive and the merged outputs."
+    )
+    benchmark_group.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="How many times to run each merge."
+    )
+    benchmark_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs."
+    )
+    benchmark_group.add_argument(
+        "--drop-caches",
+        action="store_true",
+        help="Empty the page cache before every merge. Needs root."
+    )
+    args = parser.parse_args()
+
+    if args.subcommand == "pack":
+        n_members, n_files = pack(args.input_paths, args.output_path)
+        print("Packed", n_members, "inputs,", n_files, "files, into", args.output_path)
+    elif args.subcommand == "list":
+        archive = PackedArchive(args.archive)
+        for name in archive.members:
+            print(name)
+        archive.close()
+    elif args.subcommand == "benchmark":
+        benchmark(args.input_paths, args.format, args.work_dir, args.repetitions,
+                  args.workers, args.drop_caches)
+
+if __name__ == "__main__":
+    main()
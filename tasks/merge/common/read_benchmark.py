@@ -0,0 +1,57 @@
+"""Time reads from a merged matrix, for the benchmark-read subcommand of the
+tasks whose outputs can be physical or virtual.
+
+The matrix can be anything sliced like a numpy array, e.g. an h5py dataset or
+a zarr array, so the same reads are timed whichever way the output was made.
+"""
+
+import time
+
+import numpy
+
+
+def add_arguments(benchmark_group):
+    """Add the arguments of time_reads to a task's benchmark-read subcommand."""
+
+    benchmark_group.add_argument(
+        "--matrix",
+        required=True,
+        help="Path to a merged matrix."
+    )
+    benchmark_group.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Number of times each read is timed."
+    )
+    benchmark_group.add_argument(
+        "--block-size",
+        type=int,
+        default=1000,
+        help="Number of rows or columns in the block reads."
+    )
+
+def time_reads(matrix, repetitions=3, block_size=1000, seed=0):
+    """Time reading the whole matrix, a block of columns and a block of rows.
+    Prints the median time and throughput of each.
+    """
+
+    n_rows, n_columns = matrix.shape
+
+    def columns(rng):
+        start = rng.randint(0, max(1, n_columns - block_size + 1))
+        return matrix[:, start:start + block_size]
+
+    def rows(rng):
+        start = rng.randint(0, max(1, n_rows - block_size + 1))
+        return matrix[start:start + block_size, :]
+
+    for name, read in [("full", lambda rng: matrix[:, :]), ("columns", columns), ("rows", rows)]:
+        rng = numpy.random.RandomState(seed)
+        times = []
+        for _ in range(repetitions):
+            start_time = time.perf_counter()
+            values = read(rng)
+            times.append(time.perf_counter() - start_time)
+        seconds = numpy.median(times)
+        print("{}\t{:.3f} s\t{:.1f} MB/s".format(name, seconds, values.nbytes / seconds / 1e6))
@@ -0,0 +1,58 @@
+"""Open a zarr matrix with the store its path suffix names.
+
+create_data writes zarr matrices to a directory, .zarr, or to a single file or
+environment: .zarr.zip for a ZipStore, .zarr.lmdb for an LMDBStore,
+.zarr.sqlite for an SQLiteStore and .zarr.dbm for a gdbm DBMStore. The merge
+tasks read and write any of them through open_array, and close_array has to
+be called after writing, or the single file stores lose their last writes.
+"""
+
+STORE_TYPES = (
+    (".zarr.zip", "ZipStore"),
+    (".zarr.lmdb", "LMDBStore"),
+    (".zarr.sqlite", "SQLiteStore"),
+    (".zarr.dbm", "DBMStore"),
+)
+
+
+def store_type(path):
+    """The name of the zarr store class for path, DirectoryStore by default."""
+
+    for suffix, type_ in STORE_TYPES:
+        if path.endswith(suffix):
+            return type_
+    return "DirectoryStore"
+
+def open_store(path, mode="r"):
+    """Open the store of path for reading ("r"), writing from scratch ("w")
+    or both ("a" or "r+").
+    """
+
+    import zarr
+    type_ = store_type(path)
+    if type_ == "ZipStore":
+        return zarr.ZipStore(path, mode={"r+": "a"}.get(mode, mode))
+    if type_ == "LMDBStore":
+        if mode == "r":
+            return zarr.LMDBStore(path, readonly=True, lock=False)
+        return zarr.LMDBStore(path)
+    if type_ == "DBMStore":
+        import dbm.gnu
+        return zarr.DBMStore(path, flag={"r": "r", "w": "n"}.get(mode, "c"),
+                             open=dbm.gnu.open)
+    return getattr(zarr, type_)(path)
+
+def open_array(path, mode="r", **kwargs):
+    """zarr.open for path in the store its suffix names."""
+
+    import zarr
+    return zarr.open(open_store(path, mode), mode=mode, **kwargs)
+
+def close_store(store):
+    """Close a store, if it's a kind that needs it."""
+
+    if hasattr(store, "close"):
+        store.close()
+
+def close_array(array):
+    close_store(array.store)
@@ -1,15 +1,68 @@
 import argparse
+import os
+import sys
 import numpy
 import yaml
 
+import anndata
+import h5py
+import pandas
 import scanpy.api as sc
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+
 def merge_anndatas(anndata_paths, output_path):
 
     first_adata = sc.read_h5ad(anndata_paths[0])
     concat_adata = first_adata.concatenate(sc.read_h5ad(a) for a in anndata_paths[1:])
     concat_adata.write(output_path)
 
+def merge_anndatas_backed(anndata_paths, output_path, block_rows=10000):
+    """Concatenate the cells of the inputs without loading their matrices.
+
+    Each input is opened in backed mode, which reads its obs and var but
+    leaves X on disk. The output is written with the concatenated obs and the
+    var of the first input and no X, then X is added at its final shape and
+    filled input by input, block_rows rows at a time, so memory holds at most
+    one block of X plus the annotations. AnnData.concatenate would also make
+    the cell names unique by appending a batch suffix; here only repeated
+    names are changed.
+    """
+
+    obs = []
+    shapes = []
+    dtypes = []
+    for anndata_path in anndata_paths:
+        adata = anndata.read_h5ad(anndata_path, backed="r")
+        if not isinstance(adata.file["X"], h5py.Dataset):
+            raise ValueError("{} has a sparse X, which isn't supported".format(anndata_path))
+        obs.append(adata.obs)
+        shapes.append(adata.shape)
+        dtypes.append(adata.file["X"].dtype)
+        if len(obs) == 1:
+            var = adata.var
+            x_attrs = dict(adata.file["X"].attrs)
+        adata.file.close()
+    shape = (sum(s[0] for s in shapes), shapes[0][1])
+    dtype = numpy.result_type(*dtypes)
+    print("Merging", len(anndata_paths), "anndatas into", shape, dtype)
+
+    merged_adata = anndata.AnnData(obs=pandas.concat(obs), var=var)
+    merged_adata.obs_names_make_unique()
+    merged_adata.write(output_path)
+
+    with h5py.File(output_path, "r+") as output_file:
+        output_x = output_file.create_dataset("X", shape, dtype=dtype)
+        output_x.attrs.update(x_attrs)
+        row = 0
+        for anndata_path in anndata_paths:
+            with h5py.File(anndata_path, "r") as anndata_file:
+                x = anndata_file["X"]
+                for start in range(0, x.shape[0], block_rows):
+                    stop = min(start + block_rows, x.shape[0])
+                    output_x[row + start:row + stop] = x[start:stop]
+                row += x.shape[0]
 
 def verify_anndata(matrix_path, test_yaml_path):
 
@@ -40,6 +93,28 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--mode",
+        choices=["concatenate", "backed", "engine"],
+        default="concatenate",
+        help=("How to merge. concatenate loads every input and uses "
+              "AnnData.concatenate, backed streams X into a pre-sized output, "
+              "engine runs the shared block engine in tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--block-rows",
+        type=int,
+        default=10000,
+        help="Rows of X copied at once, for --mode backed."
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs, for --mode engine."
+    )
+
+    merge_engine.add_arguments(test_group, "anndata")
 
     verify_group.add_argument(
         "--output-matrix",
@@ -54,7 +129,12 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_anndatas(args.input_paths, args.output_path)
+        if args.mode == "backed":
+            merge_anndatas_backed(args.input_paths, args.output_path, args.block_rows)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "anndata")
+        else:
+            merge_anndatas(args.input_paths, args.output_path)
     elif args.subcommand == "verify":
         verify_anndata(args.output_matrix, args.test_yaml)
 
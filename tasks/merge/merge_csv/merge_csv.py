@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+import numpy
+import yaml
+
+import pandas
+import pyarrow
+import pyarrow.csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
+
+# The inputs come from create_data's convert_to_csv, which writes the cells x
+# genes frames of the converters as they are: gzipped CSV with a header of gene
+# names and a row per cell, named in the first column. The output
+# keeps that layout, so cells are rows and the merge appends the rows of every
+# input. verify transposes it to the genes x cells orientation of the other
+# merge tasks.
+
+def merge_csvs(csv_paths, output_path):
+
+    dfs_to_merge = [pandas.read_csv(csv_path, index_col=0) for csv_path in csv_paths]
+    print("Opened", len(dfs_to_merge), "dataframes")
+    merged_df = pandas.concat(dfs_to_merge, axis=0)
+    print(merged_df.shape)
+    merged_df.to_csv(output_path)
+
+def _read_table(csv_path):
+    """Read a CSV file with pyarrow, decompressing it if it's gzipped.
+
+    The parser works on blocks with several threads, and both zlib and the
+    parser release the GIL, so a pool of threads reading several files at
+    once decompresses and parses them in parallel.
+    """
+
+    return pyarrow.csv.read_csv(
+        csv_path, read_options=pyarrow.csv.ReadOptions(block_size=1 << 24))
+
+def merge_csvs_arrow(csv_paths, output_path, workers=4, read_ahead=16):
+    """Merge by streaming rows through pyarrow's CSV reader and writer.
+
+    The inputs are decompressed and parsed by a pool of threads, at most
+    read_ahead inputs ahead of the writer, and each is written to the output
+    once the inputs before it have been, so memory holds a few inputs rather
+    than the merged table. Every input must have the header of the first one,
+    and its values are cast to the first one's column types.
+    """
+
+    schema = None
+    n_rows = 0
+    for csv_path, table in merge_inputs.read_in_order(
+            csv_paths, _read_table, workers, read_ahead):
+        if schema is None:
+            schema = table.schema
+            writer = pyarrow.csv.CSVWriter(output_path, schema)
+        elif table.column_names != schema.names:
+            raise ValueError("{} has a different header than {}".format(csv_path, csv_paths[0]))
+        writer.write_table(table.cast(schema))
+        n_rows += table.num_rows
+    writer.close()
+    print("Merged", len(csv_paths), "inputs into", n_rows, "rows")
+
+def verify_csvs(matrix_path, test_yaml_path):
+
+    expected_values = yaml.load(open(test_yaml_path))['expected_output']
+
+    output_matrix = pandas.read_csv(matrix_path, index_col=0).values.T
+
+    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
+    assert numpy.sum(output_matrix) == expected_values["sum"]
+    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="subcommand")
+
+    test_group = subparsers.add_parser("test", help="Run the test.")
+    verify_group = subparsers.add_parser("verify", help="Verify the test output.")
+
+    test_group.add_argument(
+        "--input-paths",
+        required=True,
+        nargs="+",
+        help="Paths to the input matrices."
+    )
+    test_group.add_argument(
+        "--output-path",
+        required=True,
+        help="Where to put the result matrix file."
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["pandas", "arrow", "engine"],
+        default="pandas",
+        help=("How to merge. pandas reads every input into a dataframe and "
+              "concatenates them, arrow streams the rows through pyarrow's CSV "
+              "reader and writer, engine runs the shared block engine in "
+              "tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads decompressing and parsing inputs, for arrow and engine."
+    )
+    test_group.add_argument(
+        "--read-ahead",
+        type=int,
+        default=16,
+        help="How many inputs may be parsed ahead of the writer, for arrow and engine."
+    )
+
+    merge_engine.add_arguments(test_group, "csv", read_ahead=False)
+
+    verify_group.add_argument(
+        "--output-matrix",
+        required=True,
+        help="Path to the matrix produced by the test."
+    )
+    verify_group.add_argument(
+        "--test-yaml",
+        required=True,
+        help="Path ."
+    )
+    args = parser.parse_args()
+
+    if args.subcommand == "test":
+        if args.mode == "arrow":
+            merge_csvs_arrow(args.input_paths, args.output_path, args.workers, args.read_ahead)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "csv")
+        else:
+            merge_csvs(args.input_paths, args.output_path)
+    elif args.subcommand == "verify":
+        verify_csvs(args.output_matrix, args.test_yaml)
+
+if __name__ == "__main__":
+    main()
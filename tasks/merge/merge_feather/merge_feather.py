@@ -1,15 +1,25 @@
 import argparse
+import os
+import sys
 import numpy
 import yaml
 
 import pandas
+import pyarrow
+import pyarrow.feather
 
-def merge_feathers(feather_paths, output_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import gene_alignment
+import merge_engine
+import merge_inputs
+
+def merge_feathers(feather_paths, output_path, workers=1):
 
-    dfs_to_merge = []
     print("Merging", feather_paths)
-    for feather_path in feather_paths:
-        dfs_to_merge.append(pandas.read_feather(feather_path).drop("index", 1))
+    dfs_to_merge = merge_inputs.read_all(
+        feather_paths,
+        lambda feather_path: pandas.read_feather(feather_path).drop("index", 1),
+        workers)
     print("Opened", len(dfs_to_merge), "dataframes")
     print(dfs_to_merge[0])
     print(dfs_to_merge[0].shape)
@@ -17,11 +27,75 @@ def merge_feathers(feather_paths, output_path):
     print(merged_df.shape)
     merged_df.to_feather(output_path)
 
+def merge_feathers_aligned(feather_paths, output_path, workers=1):
+    """Merge inputs whose "index" columns may list different genes.
+
+    Every gene of any input gets an output row, zero for the inputs that lack
+    it, and the gene names are written back to the "index" column since their
+    order can differ from the inputs'. Rows are placed with gene_alignment
+    layouts rather than a reindex of every dataframe.
+    """
+
+    dfs_to_merge = merge_inputs.read_all(
+        feather_paths,
+        lambda feather_path: pandas.read_feather(feather_path).set_index("index"),
+        workers)
+    gene_index, layouts = gene_alignment.build_gene_index([df.index for df in dfs_to_merge])
+    print("Aligning", len(dfs_to_merge), "dataframes with", gene_index.n_layouts,
+          "gene layouts to", len(gene_index), "genes")
+
+    merged_values = numpy.zeros(
+        (len(gene_index), sum(df.shape[1] for df in dfs_to_merge)),
+        dtype=numpy.result_type(*[dtype for df in dfs_to_merge for dtype in df.dtypes]))
+    column_offset = 0
+    for df, layout in zip(dfs_to_merge, layouts):
+        merged_values[layout, column_offset:column_offset + df.shape[1]] = df.values
+        column_offset += df.shape[1]
+    merged_df = pandas.DataFrame(
+        merged_values,
+        index=pandas.Index(gene_index.names, name="index"),
+        columns=[column for df in dfs_to_merge for column in df.columns])
+    # Keep the gene names, which are in a different order than in the inputs
+    merged_df.reset_index().to_feather(output_path)
+
+def merge_feathers_arrow(feather_paths, output_path, compression="uncompressed",
+                         chunk_rows=None, workers=1):
+    """Merge the Arrow tables of the inputs without converting them to pandas.
+
+    Inputs are memory-mapped, so uncompressed ones are read without copying,
+    and the merged table is assembled from their columns, which are shared and
+    not copied either. It is written as Feather v2, optionally compressed with
+    lz4 or zstd, in record batches of chunk_rows rows.
+    """
+
+    tables = merge_inputs.read_all(
+        feather_paths,
+        lambda feather_path: pyarrow.feather.read_table(feather_path, memory_map=True),
+        workers)
+    print("Opened", len(tables), "tables")
+
+    arrays = []
+    names = []
+    for feather_path, table in zip(feather_paths, tables):
+        if table.num_rows != tables[0].num_rows:
+            raise ValueError("{} has {} rows, expected {}".format(
+                feather_path, table.num_rows, tables[0].num_rows))
+        for name, column in zip(table.column_names, table.columns):
+            if name != "index":
+                names.append(name)
+                arrays.append(column)
+    merged_table = pyarrow.Table.from_arrays(arrays, names=names)
+    print(merged_table.shape)
+    pyarrow.feather.write_feather(merged_table, output_path, compression=compression,
+                                  chunksize=chunk_rows, version=2)
+
 def verify_feathers(matrix_path, test_yaml_path):
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
 
     output_matrix = pandas.read_feather(matrix_path)
+    if "index" in output_matrix.columns:
+        output_matrix = output_matrix.drop("index", 1)
 
     assert numpy.count_nonzero(output_matrix.as_matrix()) == expected_values["non_zero_count"]
     assert numpy.sum(output_matrix.as_matrix()) == expected_values["sum"]
@@ -46,6 +120,39 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs concurrently."
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["pandas", "arrow", "engine"],
+        default="pandas",
+        help=("How to merge. pandas concatenates dataframes, arrow memory-maps "
+              "the inputs and merges their Arrow tables without copying, engine "
+              "runs the shared block engine in tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--align-genes",
+        action="store_true",
+        help=("Align the rows of the inputs by gene name, for inputs with "
+              "different genes. Only for --mode pandas and engine.")
+    )
+    test_group.add_argument(
+        "--compression",
+        choices=["uncompressed", "lz4", "zstd"],
+        default="uncompressed",
+        help="Compression of the output, for --mode arrow."
+    )
+    test_group.add_argument(
+        "--chunk-rows",
+        type=int,
+        help="Rows per record batch of the output, for --mode arrow."
+    )
+
+    merge_engine.add_arguments(test_group, "feather", align_genes=False)
 
     verify_group.add_argument(
         "--output-matrix",
@@ -60,7 +167,15 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_feathers(args.input_paths, args.output_path)
+        if args.mode == "arrow":
+            merge_feathers_arrow(args.input_paths, args.output_path, args.compression,
+                                 args.chunk_rows, args.workers)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "feather")
+        elif args.align_genes:
+            merge_feathers_aligned(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_feathers(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_feathers(args.output_matrix, args.test_yaml)
 
@@ -1,14 +1,20 @@
 import argparse
+import os
+import sys
 import numpy
 import yaml
 
 import h5py
 
-def merge_hdf5s(hdf5_paths, output_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
+import read_benchmark
 
-    arrays_to_merge = []
-    for hdf5_path in hdf5_paths:
-        arrays_to_merge.append(h5py.File(hdf5_path)["data"])
+def merge_hdf5s(hdf5_paths, output_path, workers=1):
+
+    arrays_to_merge = merge_inputs.read_all(
+        hdf5_paths, lambda hdf5_path: h5py.File(hdf5_path, "r")["data"][:], workers)
     merged_array = numpy.concatenate(arrays_to_merge, axis=1)
     with h5py.File(output_path, 'w') as output_hfile:
         output_hfile.create_dataset(
@@ -16,6 +22,186 @@ def merge_hdf5s(hdf5_paths, output_path):
             data=merged_array
         )
 
+def _storage(dataset):
+    """The properties that determine how a dataset's chunks are encoded."""
+
+    return (dataset.dtype, dataset.chunks, dataset.compression, dataset.compression_opts,
+            dataset.shuffle, dataset.fletcher32, dataset.scaleoffset)
+
+def merge_hdf5s_direct_chunk(hdf5_paths, output_path):
+    """Merge by copying compressed chunks as they are wherever the grids line up.
+
+    The output takes the chunk shape and filters of the first input. An input
+    with the same dtype, chunk shape and filters whose first column falls on
+    an output chunk boundary has each of its chunks that covers whole output
+    chunk columns moved with read_direct_chunk and write_direct_chunk, so they
+    are never decompressed or recompressed. Every other column, like a partial
+    last chunk of an input followed by another input, is read and written
+    normally. Prints how many output chunks took each path.
+    """
+
+    inputs = [h5py.File(hdf5_path, "r") for hdf5_path in hdf5_paths]
+    datasets = [input_file["data"] for input_file in inputs]
+    first = datasets[0]
+    n_rows = first.shape[0]
+    n_columns = sum(dataset.shape[1] for dataset in datasets)
+    dtype = numpy.result_type(*[dataset.dtype for dataset in datasets])
+    chunks = first.chunks
+
+    direct_chunks = 0
+    decoded_chunks = 0
+    with h5py.File(output_path, "w") as output_hfile:
+        output = output_hfile.create_dataset(
+            name="data",
+            shape=(n_rows, n_columns),
+            dtype=dtype,
+            chunks=chunks,
+            compression=first.compression if chunks else None,
+            compression_opts=first.compression_opts if chunks else None,
+            shuffle=first.shuffle,
+            fletcher32=first.fletcher32,
+            scaleoffset=first.scaleoffset
+        )
+        row_chunks = -(-n_rows // chunks[0]) if chunks else 1
+
+        column_offset = 0
+        for dataset in datasets:
+            width = dataset.shape[1]
+            direct_columns = 0
+            if (chunks and _storage(dataset) == _storage(output)
+                    and column_offset % chunks[1] == 0):
+                # A partial last chunk can only be moved if nothing follows it
+                if column_offset + width == n_columns:
+                    direct_columns = width
+                else:
+                    direct_columns = width // chunks[1] * chunks[1]
+                for i in range(dataset.id.get_num_chunks()):
+                    chunk_offset = dataset.id.get_chunk_info(i).chunk_offset
+                    if chunk_offset[1] < direct_columns:
+                        filter_mask, chunk = dataset.id.read_direct_chunk(chunk_offset)
+                        output.id.write_direct_chunk(
+                            (chunk_offset[0], column_offset + chunk_offset[1]), chunk, filter_mask)
+                direct_chunks += row_chunks * -(-direct_columns // chunks[1])
+
+            if direct_columns < width:
+                start = column_offset + direct_columns
+                stop = column_offset + width
+                output[:, start:stop] = dataset[:, direct_columns:]
+                if chunks:
+                    decoded_chunks += row_chunks * ((stop - 1) // chunks[1] - start // chunks[1] + 1)
+                else:
+                    decoded_chunks += 1
+            column_offset += width
+
+    for input_file in inputs:
+        input_file.close()
+    print("Chunks copied directly:", direct_chunks)
+    print("Chunks decoded and encoded:", decoded_chunks)
+
+def merge_hdf5s_virtual(hdf5_paths, output_path):
+    """Present the inputs as one matrix with an HDF5 virtual dataset.
+
+    Nothing is copied: the output "data" dataset maps each input's column
+    range to its "data" dataset, which HDF5 reads whenever the output is read.
+    The inputs are referenced by absolute path and have to stay in place.
+    """
+
+    shapes = []
+    dtypes = []
+    for hdf5_path in hdf5_paths:
+        with h5py.File(hdf5_path, "r") as input_file:
+            shapes.append(input_file["data"].shape)
+            dtypes.append(input_file["data"].dtype)
+    n_columns = sum(shape[1] for shape in shapes)
+    layout = h5py.VirtualLayout(shape=(shapes[0][0], n_columns),
+                                dtype=numpy.result_type(*dtypes))
+
+    column_offset = 0
+    for hdf5_path, shape in zip(hdf5_paths, shapes):
+        source = h5py.VirtualSource(os.path.abspath(hdf5_path), "data", shape=shape)
+        layout[:, column_offset:column_offset + shape[1]] = source
+        column_offset += shape[1]
+
+    with h5py.File(output_path, "w", libver="latest") as output_hfile:
+        output_hfile.create_virtual_dataset("data", layout, fillvalue=0)
+
+def append_hdf5s(hdf5_paths, output_path, chunk_columns=100, compression=None, workers=1,
+                 read_ahead=4):
+    """Add inputs to a merged matrix without rewriting the columns it has.
+
+    The output's "data" dataset has an unlimited number of columns, and an
+    "inputs" dataset beside it lists the absolute paths of the inputs it
+    holds. Its "committed" attribute is the number of those inputs and of the
+    columns they fill. Listed inputs are skipped; the others are read, by a
+    pool of threads at most read_ahead inputs ahead with more than one worker,
+    and written into new columns after a single resize. The attribute is only
+    written once they are, so if an append stops part way, the next one first
+    cuts "data" and "inputs" back to what it says. A missing output is created
+    with no columns first.
+    """
+
+    with h5py.File(output_path, "a") as output_hfile:
+        if "data" in output_hfile:
+            output = output_hfile["data"]
+            if output.maxshape[1] is not None or "inputs" not in output_hfile:
+                raise ValueError("{} wasn't created by append, so it can't be appended to"
+                                 .format(output_path))
+            inputs = output_hfile["inputs"]
+            n_inputs, n_columns = (int(n) for n in inputs.attrs["committed"])
+            if output.shape[1] != n_columns or len(inputs) != n_inputs:
+                print("Cutting", output_path, "back from", output.shape[1], "to", n_columns,
+                      "columns, left by an unfinished append")
+                output.resize(n_columns, axis=1)
+                inputs.resize((n_inputs,))
+            included = [name.decode("utf-8") if isinstance(name, bytes) else name
+                        for name in inputs[:]]
+        else:
+            output = None
+            included = []
+
+        new_paths = merge_inputs.new_inputs(hdf5_paths, included)
+        print("Appending", len(new_paths), "of", len(hdf5_paths), "inputs")
+        if not new_paths:
+            return
+
+        shapes = []
+        dtypes = []
+        for hdf5_path in new_paths:
+            with h5py.File(hdf5_path, "r") as input_file:
+                shapes.append(input_file["data"].shape)
+                dtypes.append(input_file["data"].dtype)
+        if output is None:
+            n_rows = shapes[0][0]
+            output = output_hfile.create_dataset(
+                "data",
+                shape=(n_rows, 0),
+                maxshape=(n_rows, None),
+                chunks=(max(n_rows, 1), chunk_columns),
+                dtype=numpy.result_type(*dtypes),
+                compression=compression)
+            inputs = output_hfile.create_dataset(
+                "inputs", shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str))
+            inputs.attrs["committed"] = (0, 0)
+        for hdf5_path, shape, dtype in zip(new_paths, shapes, dtypes):
+            if shape[0] != output.shape[0]:
+                raise ValueError("{} has {} rows, expected {}".format(
+                    hdf5_path, shape[0], output.shape[0]))
+            if not numpy.can_cast(dtype, output.dtype):
+                raise ValueError("{} has dtype {}, which doesn't fit in the output's {}"
+                                 .format(hdf5_path, dtype, output.dtype))
+
+        column_offset = output.shape[1]
+        output.resize(column_offset + sum(shape[1] for shape in shapes), axis=1)
+        for _, values in merge_inputs.read_in_order(
+                new_paths, lambda hdf5_path: h5py.File(hdf5_path, "r")["data"][:],
+                workers, read_ahead):
+            output[:, column_offset:column_offset + values.shape[1]] = values
+            column_offset += values.shape[1]
+        inputs.resize((len(included) + len(new_paths),))
+        inputs[len(included):] = new_paths
+        inputs.attrs["committed"] = (len(inputs), output.shape[1])
+        print("Output is now", output.shape)
+
 def verify_hdf5(matrix_path, test_yaml_path):
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
@@ -33,6 +219,10 @@ def main():
 
     test_group = subparsers.add_parser("test", help="Run the test.")
     verify_group = subparsers.add_parser("verify", help="Verify the test output.")
+    append_group = subparsers.add_parser(
+        "append", help="Add new inputs to a merged matrix made by append.")
+    benchmark_group = subparsers.add_parser(
+        "benchmark-read", help="Time reads from a merged matrix, physical or virtual.")
 
     test_group.add_argument(
         "--input-paths",
@@ -45,6 +235,23 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs concurrently."
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["concatenate", "direct-chunk", "virtual", "engine"],
+        default="concatenate",
+        help=("How to merge. direct-chunk copies compressed chunks without "
+              "decoding them where the input and output chunk grids line up. "
+              "virtual writes a virtual dataset that maps to the inputs. "
+              "engine runs the shared block engine in tasks/merge/common.")
+    )
+
+    merge_engine.add_arguments(test_group, "hdf5")
 
     verify_group.add_argument(
         "--output-matrix",
@@ -56,12 +263,61 @@ def main():
         required=True,
         help="Path ."
     )
+
+    append_group.add_argument(
+        "--input-paths",
+        required=True,
+        nargs="+",
+        help="Paths to the input matrices. Inputs the output already has are skipped."
+    )
+    append_group.add_argument(
+        "--output-path",
+        required=True,
+        help="The merged matrix to add to. It's created if it doesn't exist."
+    )
+    append_group.add_argument(
+        "--chunk-columns",
+        type=int,
+        default=100,
+        help="Width of the output chunks, if the output is created."
+    )
+    append_group.add_argument(
+        "--compression",
+        help="Compression filter of the output, like gzip, if the output is created."
+    )
+    append_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the new inputs."
+    )
+    append_group.add_argument(
+        "--read-ahead",
+        type=int,
+        default=4,
+        help="How many new inputs may be read ahead of the writer."
+    )
+
+    read_benchmark.add_arguments(benchmark_group)
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_hdf5s(args.input_paths, args.output_path)
+        if args.mode == "virtual":
+            merge_hdf5s_virtual(args.input_paths, args.output_path)
+        elif args.mode == "direct-chunk":
+            merge_hdf5s_direct_chunk(args.input_paths, args.output_path)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "hdf5")
+        else:
+            merge_hdf5s(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_hdf5(args.output_matrix, args.test_yaml)
+    elif args.subcommand == "append":
+        append_hdf5s(args.input_paths, args.output_path, args.chunk_columns,
+                     args.compression, args.workers, args.read_ahead)
+    elif args.subcommand == "benchmark-read":
+        with h5py.File(args.matrix, "r") as matrix_file:
+            read_benchmark.time_reads(matrix_file["data"], args.repetitions, args.block_size)
 
 if __name__ == "__main__":
     main()
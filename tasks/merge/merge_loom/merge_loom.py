@@ -1,12 +1,181 @@
 import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 import numpy
 import yaml
 
+import h5py
 import loompy
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
+
+def _matrix_headers(loom_paths):
+    """The matrix shape of each input, and a dtype that holds all their values."""
+
+    shapes = []
+    dtypes = []
+    for loom_path in loom_paths:
+        with h5py.File(loom_path, "r") as loom_file:
+            shapes.append(loom_file["matrix"].shape)
+            dtypes.append(loom_file["matrix"].dtype)
+    return shapes, numpy.result_type(*dtypes)
+
+def _widen_matrix(loom_path, dtype):
+    """Rewrite the main matrix of a loom file with dtype, keeping its storage
+    options so that loompy can still append columns to it.
+    """
+
+    with h5py.File(loom_path, "r+") as loom_file:
+        matrix = loom_file["matrix"]
+        if matrix.dtype == dtype:
+            return
+        values = matrix[:].astype(dtype)
+        options = {"chunks": matrix.chunks, "maxshape": matrix.maxshape,
+                   "compression": matrix.compression,
+                   "compression_opts": matrix.compression_opts,
+                   "shuffle": matrix.shuffle, "fletcher32": matrix.fletcher32}
+        attrs = dict(matrix.attrs)
+        del loom_file["matrix"]
+        loom_file.create_dataset("matrix", data=values, **options).attrs.update(attrs)
+
 def merge_looms(loom_paths, output_path):
-    loompy.combine(loom_paths, output_path)
+    """Merge like loompy.combine, but with an output dtype that holds every input.
+
+    loompy.combine copies the first file and appends the rest to it, so the
+    output takes the dtype of the first input. Inputs with compact count
+    dtypes can differ, e.g. uint16 and uint32, and appending wider values to
+    a narrower matrix would clip them, so the copy of the first input is
+    widened to the common dtype before the others are appended in order.
+    """
+
+    _, dtype = _matrix_headers(loom_paths)
+    shutil.copyfile(loom_paths[0], output_path)
+    _widen_matrix(output_path, dtype)
+    with loompy.connect(output_path) as ds:
+        for loom_path in loom_paths[1:]:
+            ds.add_loom(loom_path)
+
+def _decode_into(task):
+    """Read a range of inputs into their columns of the shared output matrix.
+    Runs in a worker process, and returns the column attributes of each input.
+    """
+
+    paths, column_offsets, buffer_path, shape, dtype = task
+    matrix = numpy.memmap(buffer_path, dtype=dtype, mode="r+", shape=shape)
+    col_attrs = []
+    for path, column_offset in zip(paths, column_offsets):
+        with loompy.connect(path, "r") as ds:
+            matrix[:, column_offset:column_offset + ds.shape[1]] = ds[:, :]
+            col_attrs.append({name: ds.ca[name] for name in ds.ca.keys()})
+    matrix.flush()
+    return col_attrs
+
+def merge_looms_processes(loom_paths, output_path, processes):
+    """Merge with a pool of processes that decode disjoint ranges of inputs.
+
+    The input shapes are read first, so every input has a fixed range of
+    columns in the output. The workers write their inputs straight into a
+    memory-mapped matrix next to the output, so the matrix data isn't pickled
+    back to this process, which then writes the loom file.
+    """
+
+    shapes, dtype = _matrix_headers(loom_paths)
+    shape = (shapes[0][0], sum(s[1] for s in shapes))
+    column_offsets = numpy.cumsum([0] + [s[1] for s in shapes])
+
+    buffer_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        buffer_path = os.path.join(buffer_dir, "matrix")
+        numpy.memmap(buffer_path, dtype=dtype, mode="w+", shape=shape)
+
+        tasks = [(loom_paths[start:stop], column_offsets[start:stop], buffer_path, shape, dtype)
+                 for start, stop
+                 in merge_inputs.split_ranges(len(loom_paths), processes * 4)]
+        with multiprocessing.Pool(processes) as pool:
+            col_attrs = [attrs for task_attrs in pool.map(_decode_into, tasks)
+                         for attrs in task_attrs]
+
+        with loompy.connect(loom_paths[0], "r") as ds:
+            row_attrs = {name: ds.ra[name] for name in ds.ra.keys()}
+        merged_col_attrs = _concatenate_col_attrs(col_attrs)
+        loompy.create(output_path, numpy.memmap(buffer_path, dtype=dtype, mode="r", shape=shape),
+                      row_attrs, merged_col_attrs)
+    finally:
+        shutil.rmtree(buffer_dir)
+
+# loompy chunks the matrix 64 columns wide
+LOOM_CHUNK_COLUMNS = 64
+
+def merge_looms_batched(loom_paths, output_path, block_columns=1024, cache_mb=256):
+    """Merge by filling a pre-sized output matrix in large column blocks.
 
+    merge_looms, like loompy.combine, appends one file at a time, growing the
+    matrix and every column attribute each time. Here the input headers give
+    the final shape up front. The inputs are copied into a buffer
+    block_columns wide, rounded to whole chunks, and each full buffer is
+    written with one chunk-aligned write, with an HDF5 chunk cache of
+    cache_mb. The first block creates the file with loompy, so the output is
+    a regular loom file, and the column attributes are written once at the
+    end.
+    """
+
+    shapes, dtype = _matrix_headers(loom_paths)
+    n_rows = shapes[0][0]
+    n_columns = sum(s[1] for s in shapes)
+    block_columns = max(1, block_columns // LOOM_CHUNK_COLUMNS) * LOOM_CHUNK_COLUMNS
+    block_columns = min(block_columns, n_columns)
+    print("Merging", len(loom_paths), "looms into", (n_rows, n_columns), dtype)
+
+    with loompy.connect(loom_paths[0], "r") as ds:
+        row_attrs = {name: ds.ra[name] for name in ds.ra.keys()}
+
+    buffer = numpy.zeros((n_rows, block_columns), dtype=dtype)
+    buffer_start = 0
+    output_column = 0
+    col_attrs = []
+    output_file = None
+    for loom_path in loom_paths:
+        with loompy.connect(loom_path, "r") as ds:
+            matrix = ds[:, :]
+            col_attrs.append({name: ds.ca[name] for name in ds.ca.keys()})
+        matrix_column = 0
+        while matrix_column < matrix.shape[1]:
+            width = min(matrix.shape[1] - matrix_column,
+                        buffer_start + block_columns - output_column)
+            buffer[:, output_column - buffer_start:output_column - buffer_start + width] = \
+                matrix[:, matrix_column:matrix_column + width]
+            matrix_column += width
+            output_column += width
+            if output_column - buffer_start < block_columns and output_column < n_columns:
+                continue
+
+            block = buffer[:, :output_column - buffer_start]
+            if output_file is None:
+                merged_col_attrs = _concatenate_col_attrs(col_attrs)
+                loompy.create(output_path, block, row_attrs,
+                              {name: values[:block.shape[1]]
+                               for name, values in merged_col_attrs.items()})
+                output_file = h5py.File(output_path, "r+", rdcc_nbytes=cache_mb << 20)
+                output_file["matrix"].resize(n_columns, axis=1)
+            else:
+                output_file["matrix"][:, buffer_start:output_column] = block
+            buffer_start = output_column
+    output_file.close()
+
+    # The column attributes are still those of the first block, so the file
+    # only becomes valid once they are replaced
+    with loompy.connect(output_path, "r+", validate=False) as ds:
+        for name, values in _concatenate_col_attrs(col_attrs).items():
+            ds.ca[name] = values
+
+def _concatenate_col_attrs(col_attrs):
+    return {name: numpy.concatenate([attrs[name] for attrs in col_attrs])
+            for name in col_attrs[0]}
 
 def verify_loom(matrix_path, test_yaml_path):
 
@@ -37,6 +206,44 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--mode",
+        choices=["combine", "batched", "engine"],
+        default="combine",
+        help=("How to merge. combine copies the first input, widens its matrix to "
+              "a dtype that holds every input and appends the others with loompy's "
+              "add_loom, like loompy.combine without clipping. batched fills a "
+              "pre-sized matrix in large chunk-aligned column blocks, engine "
+              "runs the shared block engine in tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--block-columns",
+        type=int,
+        default=1024,
+        help="Columns written at once, for --mode batched."
+    )
+    test_group.add_argument(
+        "--cache-mb",
+        type=int,
+        default=256,
+        help="HDF5 chunk cache size of the output, for --mode batched."
+    )
+    test_group.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help=("Number of processes decoding the inputs. More than one writes them "
+              "into a shared memory-mapped matrix instead of appending them with "
+              "add_loom.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs, for --mode engine."
+    )
+
+    merge_engine.add_arguments(test_group, "loom")
 
     verify_group.add_argument(
         "--output-matrix",
@@ -51,7 +258,15 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_looms(args.input_paths, args.output_path)
+        if args.mode == "batched":
+            merge_looms_batched(args.input_paths, args.output_path,
+                                args.block_columns, args.cache_mb)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "loom")
+        elif args.processes > 1:
+            merge_looms_processes(args.input_paths, args.output_path, args.processes)
+        else:
+            merge_looms(args.input_paths, args.output_path)
     elif args.subcommand == "verify":
         verify_loom(args.output_matrix, args.test_yaml)
 
@@ -1,18 +1,246 @@
 import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import warnings
 import numpy
 import yaml
 
 import scipy.io
 import scipy.sparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
+
 def merge_matrix_markets(matrix_market_paths, output_path):
 
-    arrays_to_merge = []
-    for matrix_market_path in matrix_market_paths:
-        arrays_to_merge.append(scipy.io.mmread(matrix_market_path))
+    arrays_to_merge = [scipy.io.mmread(path) for path in matrix_market_paths]
     merged_array = scipy.sparse.hstack(arrays_to_merge)
     output_matrix_market = scipy.io.mmwrite(output_path, merged_array)
 
+def _decode_into(task):
+    """Parse a range of inputs and write their entries into the shared triplet
+    arrays at the precomputed offsets. Runs in a worker process.
+    """
+
+    paths, column_offsets, entry_offsets, buffer_paths, buffer_length, dtype = task
+    rows, columns, values = [
+        numpy.memmap(buffer_path, dtype=buffer_dtype, mode="r+", shape=(buffer_length,))
+        for buffer_path, buffer_dtype in zip(buffer_paths, ("int64", "int64", dtype))]
+    for path, column_offset, entry_offset in zip(paths, column_offsets, entry_offsets):
+        matrix = scipy.io.mmread(path).tocoo()
+        end = entry_offset + matrix.nnz
+        rows[entry_offset:end] = matrix.row
+        columns[entry_offset:end] = matrix.col + column_offset
+        values[entry_offset:end] = matrix.data
+    for buffer in (rows, columns, values):
+        buffer.flush()
+
+def merge_matrix_markets_processes(matrix_market_paths, output_path, processes):
+    """Merge with a pool of processes that parse disjoint ranges of inputs.
+
+    The headers give the shape and number of entries of each input, so every
+    input's entries have a fixed place in the merged coordinate arrays. The
+    workers write them straight into memory-mapped arrays next to the output,
+    so no parsed data is pickled back to this process, which then writes the
+    merged matrix.
+    """
+
+    headers = [scipy.io.mminfo(path) for path in matrix_market_paths]
+    for path, header in zip(matrix_market_paths, headers):
+        if header[3] != "coordinate" or header[5] != "general":
+            raise ValueError("{} is not a general coordinate matrix".format(path))
+    n_rows = headers[0][0]
+    column_offsets = numpy.cumsum([0] + [header[1] for header in headers])
+    entry_offsets = numpy.cumsum([0] + [header[2] for header in headers])
+    total_entries = int(entry_offsets[-1])
+    # numpy can't map an empty file
+    buffer_length = max(total_entries, 1)
+    dtype = "int64" if all(header[4] == "integer" for header in headers) else "float64"
+
+    buffer_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        buffer_paths = [os.path.join(buffer_dir, name) for name in ("rows", "columns", "values")]
+        for buffer_path, buffer_dtype in zip(buffer_paths, ("int64", "int64", dtype)):
+            numpy.memmap(buffer_path, dtype=buffer_dtype, mode="w+", shape=(buffer_length,))
+
+        tasks = [(matrix_market_paths[start:stop],
+                  column_offsets[start:stop],
+                  entry_offsets[start:stop],
+                  buffer_paths, buffer_length, dtype)
+                 for start, stop
+                 in merge_inputs.split_ranges(len(matrix_market_paths), processes * 4)]
+        with multiprocessing.Pool(processes) as pool:
+            pool.map(_decode_into, tasks)
+
+        rows, columns, values = [
+            numpy.memmap(buffer_path, dtype=buffer_dtype, mode="r",
+                         shape=(buffer_length,))[:total_entries]
+            for buffer_path, buffer_dtype in zip(buffer_paths, ("int64", "int64", dtype))]
+        merged_array = scipy.sparse.coo_matrix(
+            (values, (rows, columns)), shape=(n_rows, int(column_offsets[-1])))
+        scipy.io.mmwrite(output_path, merged_array)
+    finally:
+        shutil.rmtree(buffer_dir)
+
+# Bytes of coordinate lines parsed at a time by the streaming merge
+BLOCK_BYTES = 1 << 24
+
+def _read_header(path):
+    """The field, shape, number of entries and body offset of a coordinate
+    Matrix Market file, read without touching the entries.
+    """
+
+    with open(path, "rb") as matrix_file:
+        banner = matrix_file.readline().split()
+        if (len(banner) != 5 or banner[0].lower() != b"%%matrixmarket"
+                or banner[2].lower() != b"coordinate" or banner[4].lower() != b"general"):
+            raise ValueError("{} is not a general coordinate matrix".format(path))
+        field = banner[3].lower().decode("ascii")
+        if field not in ("integer", "real", "pattern"):
+            raise ValueError("{} has unsupported field {}".format(path, field))
+        line = matrix_file.readline()
+        while line.startswith(b"%") or not line.strip():
+            line = matrix_file.readline()
+        n_rows, n_columns, n_entries = (int(value) for value in line.split())
+        return field, n_rows, n_columns, n_entries, matrix_file.tell()
+
+def _render_integers(values, width):
+    """Right-aligned, space-padded ASCII for an integer array, as an
+    (n, width) uint8 array, built without a Python loop over the values.
+    """
+
+    chars = numpy.empty((len(values), width), dtype=numpy.uint8)
+    remaining = numpy.abs(values)
+    for position in range(width - 1, -1, -1):
+        remaining, digits = numpy.divmod(remaining, 10)
+        chars[:, position] = digits
+    chars += ord("0")
+    # Leading zeros become padding, except for the last digit
+    padding = numpy.logical_and.accumulate(chars[:, :-1] == ord("0"), axis=1)
+    chars[:, :-1][padding] = ord(" ")
+    negative = numpy.nonzero(values < 0)[0]
+    chars[negative, padding[negative].sum(axis=1) - 1] = ord("-")
+    return chars
+
+def _integer_width(values):
+    if not len(values):
+        return 1
+    return max(len(str(values.max())), len(str(values.min())))
+
+def _render_entries(entries, field, column_offset):
+    """Coordinate lines for a block of parsed (row, column[, value]) entries,
+    with the columns shifted by column_offset.
+    """
+
+    rows = entries[:, 0].astype(numpy.int64)
+    columns = entries[:, 1].astype(numpy.int64) + column_offset
+    pieces = [_render_integers(rows, _integer_width(rows)),
+              _render_integers(columns, _integer_width(columns))]
+    if field == "integer":
+        values = entries[:, 2].astype(numpy.int64)
+        pieces.append(_render_integers(values, _integer_width(values)))
+    elif field == "real":
+        # repr is the shortest text that reads back as the same double, and is
+        # formatted in C, unlike numpy.char.mod or numpy.savetxt
+        text = numpy.array([repr(value) for value in entries[:, 2].tolist()], dtype="S")
+        piece = text.view(numpy.uint8).reshape(len(text), text.itemsize).copy()
+        piece[piece == 0] = ord(" ")
+        pieces.append(piece)
+
+    separator = numpy.full((len(entries), 1), ord(" "), dtype=numpy.uint8)
+    newline = numpy.full((len(entries), 1), ord("\n"), dtype=numpy.uint8)
+    line = [pieces[0]]
+    for piece in pieces[1:]:
+        line.extend([separator, piece])
+    line.append(newline)
+    return numpy.hstack(line).tobytes()
+
+def _rewrite_body(task):
+    """Copy the entries of one input to a part file with shifted columns.
+    Runs in a worker process for parallel merges.
+    """
+
+    path, field, body_offset, n_entries, column_offset, part_path = task
+    n_fields = 2 if field == "pattern" else 3
+    parse_dtype = numpy.float64 if field == "real" else numpy.int64
+    n_parsed = 0
+    with open(path, "rb") as matrix_file, open(part_path, "wb") as part_file:
+        matrix_file.seek(body_offset)
+        leftover = b""
+        while True:
+            block = matrix_file.read(BLOCK_BYTES)
+            text = leftover + block
+            if block:
+                split = text.rfind(b"\n") + 1
+                text, leftover = text[:split], text[split:]
+            if text.strip():
+                with warnings.catch_warnings():
+                    # Older numpy only warns when a block has text it can't parse
+                    warnings.simplefilter("error", DeprecationWarning)
+                    entries = numpy.fromstring(text, dtype=parse_dtype, sep=" ")
+                entries = entries.reshape(-1, n_fields)
+                part_file.write(_render_entries(entries, field, column_offset))
+                n_parsed += len(entries)
+            if not block:
+                break
+    if n_parsed != n_entries:
+        raise ValueError("{} has {} entries, but its header says {}".format(
+            path, n_parsed, n_entries))
+    return part_path
+
+def merge_matrix_markets_streaming(matrix_market_paths, output_path, processes=1):
+    """Merge by rewriting the coordinate lines, without building a sparse matrix.
+
+    Only the headers are parsed up front, for the shapes and number of entries,
+    so the output header is written first. The entries of each input are then
+    parsed a block at a time with numpy, have their column shifted by the
+    columns before them, and are rendered back to text with vectorized integer
+    formatting. With more than one process the inputs are rewritten in
+    parallel to part files next to the output, which are appended in order.
+    """
+
+    headers = [_read_header(path) for path in matrix_market_paths]
+    fields = set(header[0] for header in headers)
+    if len(fields) != 1:
+        raise ValueError("Inputs have different fields: {}".format(fields))
+    field = fields.pop()
+    n_rows = headers[0][1]
+    column_offsets = numpy.cumsum([0] + [header[2] for header in headers])
+    n_entries = sum(header[3] for header in headers)
+
+    part_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        tasks = [(path, field, header[4], header[3], int(column_offset),
+                  os.path.join(part_dir, str(i)))
+                 for i, (path, header, column_offset)
+                 in enumerate(zip(matrix_market_paths, headers, column_offsets))]
+
+        with open(output_path, "wb") as output_file:
+            output_file.write("%%MatrixMarket matrix coordinate {} general\n%\n{} {} {}\n".format(
+                field, n_rows, int(column_offsets[-1]), n_entries).encode("ascii"))
+            if processes > 1:
+                pool = multiprocessing.Pool(processes)
+                part_paths = pool.imap(_rewrite_body, tasks)
+            else:
+                pool = None
+                part_paths = map(_rewrite_body, tasks)
+            try:
+                for part_path in part_paths:
+                    with open(part_path, "rb") as part_file:
+                        shutil.copyfileobj(part_file, output_file, BLOCK_BYTES)
+                    os.remove(part_path)
+            finally:
+                # Every part has been copied unless a worker failed, so there
+                # is nothing left to wait for either way
+                if pool is not None:
+                    pool.terminate()
+    finally:
+        shutil.rmtree(part_dir)
+
 def verify_matrix_markets(matrix_path, test_yaml_path):
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
@@ -42,6 +270,31 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=("Number of threads reading the inputs in engine mode. mmread parses "
+              "in Python and holds the GIL, so the other modes use --processes.")
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["mmread", "streaming", "engine"],
+        default="mmread",
+        help=("How to merge. mmread parses every input into a sparse matrix, "
+              "streaming rewrites the coordinate lines block by block, engine "
+              "runs the shared block engine in tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help=("Number of processes parsing the inputs. More than one writes the "
+              "parsed entries into a shared memory-mapped buffer, or with "
+              "--mode streaming rewrites the inputs in parallel.")
+    )
+
+    merge_engine.add_arguments(test_group, "matrix_market")
 
     verify_group.add_argument(
         "--output-matrix",
@@ -56,7 +309,14 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_matrix_markets(args.input_paths, args.output_path)
+        if args.mode == "streaming":
+            merge_matrix_markets_streaming(args.input_paths, args.output_path, args.processes)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "matrix_market")
+        elif args.processes > 1:
+            merge_matrix_markets_processes(args.input_paths, args.output_path, args.processes)
+        else:
+            merge_matrix_markets(args.input_paths, args.output_path)
     elif args.subcommand == "verify":
         verify_matrix_markets(args.output_matrix, args.test_yaml)
 
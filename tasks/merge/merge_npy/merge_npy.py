@@ -1,15 +1,179 @@
 import argparse
+import json
+import os
+import struct
+import sys
 import numpy
 import yaml
 
-def merge_npys(npy_paths, output_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
 
-    arrays_to_merge = []
-    for npy_path in npy_paths:
-        arrays_to_merge.append(numpy.load(npy_path))
+def merge_npys(npy_paths, output_path, workers=1):
+
+    arrays_to_merge = merge_inputs.read_all(npy_paths, numpy.load, workers)
     merged_array = numpy.concatenate(arrays_to_merge, axis=1)
     numpy.save(output_path, merged_array)
 
+def merge_npys_memmap(npy_paths, output_path):
+    """Merge through memory maps, without holding any matrix in memory.
+
+    The inputs are opened with mmap_mode="r", which only reads their headers,
+    to size the output. The output is created with open_memmap and each input
+    is copied into its column slice, so pages are read and written back by the
+    kernel as needed. The output is Fortran ordered, so each input's columns
+    are one contiguous range of the file.
+    """
+
+    arrays = [numpy.load(npy_path, mmap_mode="r") for npy_path in npy_paths]
+    shape = (arrays[0].shape[0], sum(array.shape[1] for array in arrays))
+    dtype = numpy.result_type(*arrays)
+    print("Merging", len(arrays), "arrays into", shape, dtype)
+
+    # Same name numpy.save would give it
+    merged_array = numpy.lib.format.open_memmap(
+        output_path + ".npy", mode="w+", dtype=dtype, shape=shape, fortran_order=True)
+    column_offset = 0
+    for array in arrays:
+        merged_array[:, column_offset:column_offset + array.shape[1]] = array
+        column_offset += array.shape[1]
+    merged_array.flush()
+    del merged_array
+
+# Size of the header of npy files made by append, which leaves room for the
+# number of columns to grow without moving the data
+HEADER_BYTES = 128
+
+def _fortran_header(shape, dtype, header_bytes):
+    """A version 1.0 npy header for a Fortran ordered array, padded to
+    header_bytes in all, or None if it doesn't fit.
+    """
+
+    header = "{{'descr': {!r}, 'fortran_order': True, 'shape': {!r}, }}".format(
+        numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), tuple(int(n) for n in shape))
+    # Magic string, version and header length come first
+    header_len = header_bytes - 10
+    if len(header) + 1 > header_len:
+        return None
+    return (numpy.lib.format.magic(1, 0) + struct.pack("<H", header_len)
+            + (header.ljust(header_len - 1) + "\n").encode("latin1"))
+
+def _read_header(npy_path):
+    """The version, shape, fortran_order, dtype and data offset of an npy file."""
+
+    with open(npy_path, "rb") as npy_file:
+        version = numpy.lib.format.read_magic(npy_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(npy_file)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(npy_file)
+        return version, shape, fortran_order, dtype, npy_file.tell()
+
+def _create_npy(npy_path, shape, dtype):
+    """Create a zero filled Fortran ordered npy file with room in the header."""
+
+    header = _fortran_header(shape, dtype, HEADER_BYTES)
+    with open(npy_path, "wb") as npy_file:
+        npy_file.write(header)
+        npy_file.truncate(len(header) + int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+
+def _resize_npy(matrix_path, shape, dtype, n_columns):
+    """Give a Fortran ordered npy file made by append n_columns columns, by
+    rewriting its header and truncating or extending the file. If the header
+    has no room for the new shape, the matrix is copied once into a file with
+    a roomier one.
+    """
+
+    version, _, fortran_order, _, data_offset = _read_header(matrix_path)
+    new_shape = (shape[0], n_columns)
+    header = _fortran_header(new_shape, dtype, data_offset)
+    if version == (1, 0) and fortran_order and header is not None:
+        with open(matrix_path, "r+b") as npy_file:
+            npy_file.write(header)
+            npy_file.truncate(data_offset + new_shape[0] * new_shape[1] * dtype.itemsize)
+        return
+    print("Copying", matrix_path, "into a file that can grow")
+    existing = numpy.load(matrix_path, mmap_mode="r")
+    _create_npy(matrix_path + ".part", new_shape, dtype)
+    grown = numpy.load(matrix_path + ".part", mmap_mode="r+")
+    kept = min(shape[1], n_columns)
+    grown[:, :kept] = existing[:, :kept]
+    grown.flush()
+    del grown, existing
+    os.replace(matrix_path + ".part", matrix_path)
+
+def _write_inputs(inputs_path, inputs, n_columns):
+    with open(inputs_path + ".part", "w") as inputs_file:
+        json.dump({"columns": n_columns, "inputs": inputs}, inputs_file, indent=1)
+    os.replace(inputs_path + ".part", inputs_path)
+
+def append_npys(npy_paths, output_path):
+    """Add inputs to a merged matrix by growing its file, without rewriting it.
+
+    npy files have nowhere to keep metadata, so the absolute paths of the
+    inputs a matrix holds, and the number of columns they fill, are kept in a
+    JSON file beside it, and listed inputs are skipped. The output is Fortran
+    ordered, so new columns go at the end of the file: the header is rewritten
+    in place with the new shape, the file is extended, and the new inputs are
+    copied into a memory map of their columns. The JSON file is replaced once
+    they are written, so if an append stops part way, the next one first cuts
+    the matrix back to the columns that file lists.
+    """
+
+    matrix_path = output_path + ".npy"
+    inputs_path = output_path + ".inputs.json"
+    exists = os.path.exists(matrix_path)
+    included = []
+    if exists:
+        if not os.path.exists(inputs_path):
+            raise ValueError("{} doesn't list its inputs, so it can't be appended to. "
+                             "Create it with append.".format(matrix_path))
+        with open(inputs_path) as inputs_file:
+            listed = json.load(inputs_file)
+        included = listed["inputs"]
+
+    new_paths = merge_inputs.new_inputs(npy_paths, included)
+    print("Appending", len(new_paths), "of", len(npy_paths), "inputs")
+    if not new_paths:
+        return
+    arrays = [numpy.load(npy_path, mmap_mode="r") for npy_path in new_paths]
+    new_columns = sum(array.shape[1] for array in arrays)
+
+    if exists:
+        _, shape, _, dtype, _ = _read_header(matrix_path)
+        if shape[1] != listed["columns"]:
+            print("Cutting", matrix_path, "back from", shape[1], "to", listed["columns"],
+                  "columns, left by an unfinished append")
+            shape = (shape[0], listed["columns"])
+    else:
+        shape = (arrays[0].shape[0], 0)
+        dtype = numpy.result_type(*arrays)
+    for npy_path, array in zip(new_paths, arrays):
+        if array.shape[0] != shape[0]:
+            raise ValueError("{} has {} rows, expected {}".format(
+                npy_path, array.shape[0], shape[0]))
+        if not numpy.can_cast(array.dtype, dtype):
+            raise ValueError("{} has dtype {}, which doesn't fit in the output's {}".format(
+                npy_path, array.dtype, dtype))
+    new_shape = (shape[0], shape[1] + new_columns)
+
+    if not exists:
+        _create_npy(matrix_path, shape, dtype)
+        _write_inputs(inputs_path, [], 0)
+    _resize_npy(matrix_path, _read_header(matrix_path)[1], dtype, new_shape[1])
+
+    merged_array = numpy.load(matrix_path, mmap_mode="r+")
+    column_offset = shape[1]
+    for array in arrays:
+        merged_array[:, column_offset:column_offset + array.shape[1]] = array
+        column_offset += array.shape[1]
+    merged_array.flush()
+    del merged_array
+
+    _write_inputs(inputs_path, included + new_paths, new_shape[1])
+    print("Output is now", new_shape)
+
 def verify_npys(matrix_path, test_yaml_path):
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
@@ -27,6 +191,8 @@ def main():
 
     test_group = subparsers.add_parser("test", help="Run the test.")
     verify_group = subparsers.add_parser("verify", help="Verify the test output.")
+    append_group = subparsers.add_parser(
+        "append", help="Add new inputs to a merged matrix made by append.")
 
     test_group.add_argument(
         "--input-paths",
@@ -39,6 +205,34 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs concurrently."
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["load", "memmap", "engine"],
+        default="load",
+        help=("How to merge. load reads every input into memory, memmap copies "
+              "memory-mapped inputs into a memory-mapped output, engine runs the "
+              "shared block engine in tasks/merge/common.")
+    )
+
+    merge_engine.add_arguments(test_group, "npy")
+
+    append_group.add_argument(
+        "--input-paths",
+        required=True,
+        nargs="+",
+        help="Paths to the input matrices. Inputs the output already has are skipped."
+    )
+    append_group.add_argument(
+        "--output-path",
+        required=True,
+        help="The merged matrix to add to. It's created if it doesn't exist."
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -53,9 +247,16 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_npys(args.input_paths, args.output_path)
+        if args.mode == "memmap":
+            merge_npys_memmap(args.input_paths, args.output_path)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "npy", args.output_path + ".npy")
+        else:
+            merge_npys(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_npys(args.output_matrix, args.test_yaml)
+    elif args.subcommand == "append":
+        append_npys(args.input_paths, args.output_path)
 
 if __name__ == "__main__":
     main()
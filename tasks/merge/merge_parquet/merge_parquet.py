@@ -1,14 +1,24 @@
 import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 import numpy
 import yaml
 
 import pandas
+import pyarrow.parquet
 
-def merge_parquets(parquet_paths, output_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import gene_alignment
+import merge_engine
+import merge_inputs
 
-    dfs_to_merge = []
-    for parquet_path in parquet_paths:
-        dfs_to_merge.append(pandas.read_parquet(parquet_path))
+def merge_parquets(parquet_paths, output_path, workers=1):
+
+    dfs_to_merge = merge_inputs.read_all(parquet_paths, pandas.read_parquet, workers)
     print("Opened", len(dfs_to_merge), "dataframes")
     print(dfs_to_merge[0])
     print(dfs_to_merge[0].shape)
@@ -16,11 +26,237 @@ def merge_parquets(parquet_paths, output_path):
     print(merged_df.shape)
     merged_df.to_parquet(output_path)
 
+def merge_parquets_aligned(parquet_paths, output_path, workers=1):
+    """Merge inputs whose rows may be different genes, in any order.
+
+    The output has a row for every gene of any input, in the order they are
+    first seen, and genes an input doesn't have are zero. The rows of each
+    input are placed with a gene_alignment layout instead of reindexing its
+    dataframe, and the merged values are assembled in one numpy array.
+    """
+
+    dfs_to_merge = merge_inputs.read_all(parquet_paths, pandas.read_parquet, workers)
+    gene_index, layouts = gene_alignment.build_gene_index([df.index for df in dfs_to_merge])
+    print("Aligning", len(dfs_to_merge), "dataframes with", gene_index.n_layouts,
+          "gene layouts to", len(gene_index), "genes")
+
+    merged_values = numpy.zeros(
+        (len(gene_index), sum(df.shape[1] for df in dfs_to_merge)),
+        dtype=numpy.result_type(*[dtype for df in dfs_to_merge for dtype in df.dtypes]))
+    column_offset = 0
+    for df, layout in zip(dfs_to_merge, layouts):
+        merged_values[layout, column_offset:column_offset + df.shape[1]] = df.values
+        column_offset += df.shape[1]
+    merged_df = pandas.DataFrame(
+        merged_values,
+        index=pandas.Index(gene_index.names, name=dfs_to_merge[0].index.name),
+        columns=[column for df in dfs_to_merge for column in df.columns])
+    merged_df.to_parquet(output_path)
+
+def _read_rows(parquet_path, metadata, columns, start, stop):
+    """Read rows [start, stop) of some columns, decoding only the row groups
+    that overlap them.
+    """
+
+    parquet_file = pyarrow.parquet.ParquetFile(parquet_path, metadata=metadata)
+    tables = []
+    group_start = 0
+    for i in range(metadata.num_row_groups):
+        group_stop = group_start + metadata.row_group(i).num_rows
+        if group_start < stop and group_stop > start:
+            if not tables:
+                first_start = group_start
+            tables.append(parquet_file.read_row_group(i, columns=columns))
+        group_start = group_stop
+    if not tables:
+        return parquet_file.schema_arrow.empty_table().select(columns)
+    return pyarrow.concat_tables(tables).slice(start - first_start, stop - start)
+
+def merge_parquets_arrow(parquet_paths, output_path, row_group_size=10000,
+                         compression="snappy", extra_metadata=None):
+    """Merge with pyarrow alone, writing the output a row group at a time.
+
+    Only the footers are read up front, for the value columns of each input
+    and the pandas metadata that lets pandas.read_parquet restore the index.
+    Each output row group is then assembled from the matching rows of every
+    input, reading only their value columns and the row groups that overlap,
+    and handed to a ParquetWriter without a round trip through pandas. So
+    memory holds about one row group of the merged table at a time.
+    extra_metadata is added to the key-value metadata of the output schema.
+    """
+
+    footers = [pyarrow.parquet.read_metadata(p) for p in parquet_paths]
+    n_rows = footers[0].num_rows
+    inputs = []
+    pandas_columns = []
+    for parquet_path, footer in zip(parquet_paths, footers):
+        if footer.num_rows != n_rows:
+            raise ValueError("{} has {} rows, expected {}".format(
+                parquet_path, footer.num_rows, n_rows))
+        schema = footer.schema.to_arrow_schema()
+        pandas_metadata = _pandas_metadata(schema)
+        columns = [name for name in schema.names
+                   if name not in pandas_metadata["index_columns"]]
+        inputs.append((parquet_path, footer, columns))
+        pandas_columns.extend(column for column in pandas_metadata["columns"]
+                              if column.get("field_name", column["name"]) in columns)
+
+    # The index comes from the first input, and goes after the values like
+    # pyarrow.Table.from_pandas puts it
+    first_metadata = _pandas_metadata(footers[0].schema.to_arrow_schema())
+    index_columns = [name for name in first_metadata["index_columns"]
+                     if isinstance(name, str)]
+    first_metadata["columns"] = pandas_columns + [
+        column for column in first_metadata["columns"]
+        if column.get("field_name", column["name"]) in index_columns]
+    metadata = {b"pandas": json.dumps(first_metadata).encode("utf-8")}
+    metadata.update(extra_metadata or {})
+    names = [name for _, _, columns in inputs for name in columns] + index_columns
+    print("Merging", len(inputs), "tables into", n_rows, "rows and",
+          len(names) - len(index_columns), "columns")
+
+    writer = None
+    for start in range(0, max(n_rows, 1), row_group_size):
+        stop = min(start + row_group_size, n_rows)
+        arrays = []
+        for i, (parquet_path, footer, columns) in enumerate(inputs):
+            read_columns = columns + index_columns if i == 0 else columns
+            table = _read_rows(parquet_path, footer, read_columns, start, stop)
+            arrays.extend(table.column(j) for j in range(len(columns)))
+            if i == 0:
+                index_arrays = [table.column(j) for j in range(len(columns), len(read_columns))]
+        table = pyarrow.Table.from_arrays(arrays + index_arrays, names=names)
+        table = table.replace_schema_metadata(metadata)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(output_path, table.schema,
+                                                   compression=compression)
+        writer.write_table(table, row_group_size=row_group_size)
+    writer.close()
+
+INPUTS_METADATA_KEY = b"merged_inputs"
+
+def _part_paths(dataset_path):
+    """The part files of a dataset made by append, in the order they were added."""
+
+    return [os.path.join(dataset_path, name) for name in sorted(os.listdir(dataset_path))
+            if name.startswith("part-") and name.endswith(".parquet")]
+
+def append_parquets(parquet_paths, output_path, row_group_size=10000, compression="snappy"):
+    """Add inputs to a merged dataset, reading and writing only the new inputs.
+
+    A parquet file can't gain columns in place, so the output is a directory
+    of part files. Each append merges its new inputs with merge_parquets_arrow
+    into one more part, with the same rows, so the merged matrix is the
+    columns of the parts side by side, as read_merged reads it. Each part
+    lists the absolute paths of its inputs in its schema metadata, and listed
+    inputs are skipped. A part is written beside its final name and renamed
+    once complete, so an append that stops part way adds nothing.
+    """
+
+    if os.path.exists(output_path) and not os.path.isdir(output_path):
+        raise ValueError("{} isn't a dataset made by append, so it can't be appended to"
+                         .format(output_path))
+    os.makedirs(output_path, exist_ok=True)
+    part_paths = _part_paths(output_path)
+    included = []
+    for part_path in part_paths:
+        metadata = pyarrow.parquet.read_schema(part_path).metadata or {}
+        included.extend(json.loads(metadata[INPUTS_METADATA_KEY].decode("utf-8")))
+
+    new_paths = merge_inputs.new_inputs(parquet_paths, included)
+    print("Appending", len(new_paths), "of", len(parquet_paths), "inputs")
+    if not new_paths:
+        return
+    if part_paths:
+        n_rows = pyarrow.parquet.read_metadata(part_paths[0]).num_rows
+        new_rows = pyarrow.parquet.read_metadata(new_paths[0]).num_rows
+        if new_rows != n_rows:
+            raise ValueError("{} has {} rows, expected {}".format(new_paths[0], new_rows, n_rows))
+
+    part_path = os.path.join(output_path, "part-{:05d}.parquet".format(len(part_paths)))
+    extra_metadata = {INPUTS_METADATA_KEY: json.dumps(new_paths).encode("utf-8")}
+    merge_parquets_arrow(new_paths, part_path + ".part", row_group_size, compression,
+                         extra_metadata)
+    os.replace(part_path + ".part", part_path)
+    print("Output now has", len(part_paths) + 1, "parts")
+
+def read_merged(matrix_path):
+    """Read a merged matrix, a parquet file or a dataset made by append."""
+
+    if os.path.isdir(matrix_path):
+        return pandas.concat([pandas.read_parquet(part_path)
+                              for part_path in _part_paths(matrix_path)], axis=1)
+    return pandas.read_parquet(matrix_path)
+
+def _pandas_metadata(schema):
+    """The pandas metadata stored with an arrow schema, or an empty one."""
+
+    if schema.metadata and b"pandas" in schema.metadata:
+        return json.loads(schema.metadata[b"pandas"].decode("utf-8"))
+    return {"index_columns": [], "columns": []}
+
+def _parquet_header(parquet_path):
+    """The number of rows, the value columns and their dtype, from the footer."""
+
+    parquet_file = pyarrow.parquet.ParquetFile(parquet_path)
+    schema = parquet_file.schema.to_arrow_schema()
+    index_columns = _pandas_metadata(schema)["index_columns"]
+    fields = [field for field in schema if field.name not in index_columns]
+    dtype = numpy.result_type(*[field.type.to_pandas_dtype() for field in fields])
+    return parquet_file.metadata.num_rows, [field.name for field in fields], dtype
+
+def _decode_into(task):
+    """Read a range of inputs into their columns of the shared output matrix.
+    Runs in a worker process, and returns the index of the first input.
+    """
+
+    paths, column_offsets, buffer_path, shape, dtype = task
+    matrix = numpy.memmap(buffer_path, dtype=dtype, mode="r+", shape=shape)
+    index = None
+    for path, column_offset in zip(paths, column_offsets):
+        df = pandas.read_parquet(path)
+        matrix[:, column_offset:column_offset + df.shape[1]] = df.values
+        if index is None:
+            index = df.index
+    matrix.flush()
+    return index
+
+def merge_parquets_processes(parquet_paths, output_path, processes):
+    """Merge with a pool of processes that decode disjoint ranges of inputs.
+
+    The shapes come from the parquet footers, so every input has a fixed range
+    of columns in the output. The workers write their inputs straight into a
+    memory-mapped matrix next to the output, so the values aren't pickled back
+    to this process, which then writes the merged parquet file.
+    """
+
+    headers = [_parquet_header(p) for p in parquet_paths]
+    columns = [name for _, names, _ in headers for name in names]
+    shape = (headers[0][0], len(columns))
+    dtype = numpy.result_type(*[header_dtype for _, _, header_dtype in headers])
+    column_offsets = numpy.cumsum([0] + [len(names) for _, names, _ in headers])
+
+    buffer_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        buffer_path = os.path.join(buffer_dir, "matrix")
+        numpy.memmap(buffer_path, dtype=dtype, mode="w+", shape=shape)
+
+        tasks = [(parquet_paths[start:stop], column_offsets[start:stop], buffer_path, shape, dtype)
+                 for start, stop
+                 in merge_inputs.split_ranges(len(parquet_paths), processes * 4)]
+        with multiprocessing.Pool(processes) as pool:
+            index = pool.map(_decode_into, tasks)[0]
+
+        matrix = numpy.memmap(buffer_path, dtype=dtype, mode="r", shape=shape)
+        pandas.DataFrame(matrix, index=index, columns=columns).to_parquet(output_path)
+    finally:
+        shutil.rmtree(buffer_dir)
+
 def verify_parquets(matrix_path, test_yaml_path):
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
 
-    output_matrix = pandas.read_parquet(matrix_path)
+    output_matrix = read_merged(matrix_path)
 
     assert numpy.count_nonzero(output_matrix.as_matrix()) == expected_values["non_zero_count"]
     assert numpy.sum(output_matrix.as_matrix()) == expected_values["sum"]
@@ -33,6 +269,8 @@ def main():
 
     test_group = subparsers.add_parser("test", help="Run the test.")
     verify_group = subparsers.add_parser("verify", help="Verify the test output.")
+    append_group = subparsers.add_parser(
+        "append", help="Add new inputs to a merged matrix made by append.")
 
     test_group.add_argument(
         "--input-paths",
@@ -45,6 +283,70 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs concurrently."
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["pandas", "arrow", "engine"],
+        default="pandas",
+        help=("How to merge. pandas concatenates dataframes, arrow assembles "
+              "and writes the output a row group at a time with pyarrow, engine "
+              "runs the shared block engine in tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--align-genes",
+        action="store_true",
+        help=("Align the rows of the inputs by gene name, for inputs with "
+              "different genes. Only for --mode pandas and engine.")
+    )
+    test_group.add_argument(
+        "--row-group-size",
+        type=int,
+        default=10000,
+        help="Rows per row group of the output, for --mode arrow."
+    )
+    test_group.add_argument(
+        "--compression",
+        default="snappy",
+        help="Compression codec of the output, for --mode arrow."
+    )
+    test_group.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help=("Number of processes decoding the inputs. More than one writes them "
+              "into a shared memory-mapped matrix instead of using pandas.concat.")
+    )
+
+    merge_engine.add_arguments(test_group, "parquet", align_genes=False)
+
+    append_group.add_argument(
+        "--input-paths",
+        required=True,
+        nargs="+",
+        help="Paths to the input matrices. Inputs the output already has are skipped."
+    )
+    append_group.add_argument(
+        "--output-path",
+        required=True,
+        help=("The directory of the merged dataset to add to. It's created if it "
+              "doesn't exist.")
+    )
+    append_group.add_argument(
+        "--row-group-size",
+        type=int,
+        default=10000,
+        help="Rows per row group of the output."
+    )
+    append_group.add_argument(
+        "--compression",
+        default="snappy",
+        help="Compression codec of the output."
+    )
 
     verify_group.add_argument(
         "--output-matrix",
@@ -59,9 +361,22 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_parquets(args.input_paths, args.output_path)
+        if args.mode == "arrow":
+            merge_parquets_arrow(args.input_paths, args.output_path,
+                                 args.row_group_size, args.compression)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "parquet")
+        elif args.processes > 1:
+            merge_parquets_processes(args.input_paths, args.output_path, args.processes)
+        elif args.align_genes:
+            merge_parquets_aligned(args.input_paths, args.output_path, args.workers)
+        else:
+            merge_parquets(args.input_paths, args.output_path, args.workers)
     elif args.subcommand == "verify":
         verify_parquets(args.output_matrix, args.test_yaml)
+    elif args.subcommand == "append":
+        append_parquets(args.input_paths, args.output_path, args.row_group_size,
+                        args.compression)
 
 if __name__ == "__main__":
     main()
@@ -1,28 +1,127 @@
 import argparse
+import os
+import sys
 import numpy
 import yaml
 
-import h5sparse
+import h5py
 import scipy.sparse
 
-def merge_hdf5s(hdf5_paths, output_path):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
 
-    arrays_to_merge = []
+def _format_str(group):
+    format_str = group.attrs["h5sparse_format"]
+    return format_str.decode("ascii") if isinstance(format_str, bytes) else format_str
+
+def _read_sparse(hdf5_path):
+    """The format, shape and component arrays of a sparse matrix in an h5sparse file."""
+
+    with h5py.File(hdf5_path, "r") as hdf5_file:
+        group = hdf5_file["data"]
+        return (_format_str(group), tuple(group.attrs["h5sparse_shape"]),
+                group["data"][:], group["indices"][:], group["indptr"][:])
+
+def merge_hdf5s(hdf5_paths, output_path, workers=1, read_ahead=4):
+    """Concatenate the sparse matrices column-wise without densifying them.
+
+    The shapes and number of stored values are read from every input first,
+    so the output data, indices and indptr datasets are created at their final
+    size. For csc inputs each one is then copied straight into its slice of
+    the output datasets, with its indptr shifted by the values before it. The
+    inputs are read in order, by a pool of threads at most read_ahead inputs
+    ahead with more than one worker, so only a few inputs are in memory at a
+    time. For csr inputs the values of each row come from every input, so
+    they are scattered into output arrays held in memory, which are still
+    only as large as the sparse matrix, and written at the end.
+    """
+
+    headers = []
     for hdf5_path in hdf5_paths:
-        arrays_to_merge.append(h5sparse.File(hdf5_path)["data"].value)
-    merged_array = scipy.sparse.hstack(arrays_to_merge, format="coo")
-    output_file = h5sparse.File(output_path, "w", libver="latest")
-    output_file.create_dataset("data", data=merged_array.toarray())
+        with h5py.File(hdf5_path, "r") as hdf5_file:
+            group = hdf5_file["data"]
+            headers.append((_format_str(group), tuple(group.attrs["h5sparse_shape"]),
+                            group["data"].shape[0], group["data"].dtype,
+                            group["indices"].dtype))
+
+    formats = set(header[0] for header in headers)
+    if len(formats) != 1 or formats & {"csc", "csr"} != formats:
+        raise ValueError("Inputs must all be csc or all be csr, got {}".format(formats))
+    format_str = formats.pop()
+
+    n_rows = int(headers[0][1][0])
+    n_columns = int(sum(header[1][1] for header in headers))
+    nnz_offsets = numpy.cumsum([0] + [header[2] for header in headers])
+    column_offsets = numpy.cumsum([0] + [header[1][1] for header in headers])
+    data_dtype = numpy.result_type(*[header[3] for header in headers])
+    indices_dtype = numpy.result_type(numpy.min_scalar_type(max(n_rows, n_columns)),
+                                      *[header[4] for header in headers])
+    print("Merging", len(hdf5_paths), format_str, "matrices into", (n_rows, n_columns),
+          "with", nnz_offsets[-1], "values")
+
+    output_file = h5py.File(output_path, "w", libver="latest")
+    output_group = output_file.create_group("data")
+    output_group.attrs["h5sparse_format"] = format_str
+    output_group.attrs["h5sparse_shape"] = (n_rows, n_columns)
+
+    if format_str == "csc":
+        data = output_group.create_dataset("data", (nnz_offsets[-1],), dtype=data_dtype)
+        indices = output_group.create_dataset("indices", (nnz_offsets[-1],), dtype=indices_dtype)
+        indptr = output_group.create_dataset("indptr", (n_columns + 1,), dtype=numpy.int64)
+        indptr[0] = 0
+    else:
+        data = numpy.empty(nnz_offsets[-1], dtype=data_dtype)
+        indices = numpy.empty(nnz_offsets[-1], dtype=indices_dtype)
+        indptr = numpy.zeros(n_rows + 1, dtype=numpy.int64)
+        for hdf5_path in hdf5_paths:
+            with h5py.File(hdf5_path, "r") as hdf5_file:
+                indptr[1:] += numpy.diff(hdf5_file["data"]["indptr"][:])
+        numpy.cumsum(indptr, out=indptr)
+        # Where the next value of each row goes
+        row_cursors = indptr[:-1].copy()
+
+    inputs = merge_inputs.read_in_order(hdf5_paths, _read_sparse, workers, read_ahead)
+    for i, (_, (_, _, input_data, input_indices, input_indptr)) in enumerate(inputs):
+        if format_str == "csc":
+            start, stop = nnz_offsets[i], nnz_offsets[i + 1]
+            data[start:stop] = input_data
+            indices[start:stop] = input_indices
+            indptr[column_offsets[i] + 1:column_offsets[i + 1] + 1] = input_indptr[1:] + start
+        else:
+            row_counts = numpy.diff(input_indptr)
+            entry_rows = numpy.repeat(numpy.arange(n_rows), row_counts)
+            positions = (row_cursors[entry_rows] + numpy.arange(len(input_data))
+                         - input_indptr[entry_rows])
+            data[positions] = input_data
+            indices[positions] = input_indices + column_offsets[i]
+            row_cursors += row_counts
+
+    if format_str == "csr":
+        output_group.create_dataset("data", data=data)
+        output_group.create_dataset("indices", data=indices)
+        output_group.create_dataset("indptr", data=indptr)
+    output_file.close()
 
 def verify_hdf5(matrix_path, test_yaml_path):
+    """Check the merged sparse matrix from its stored values, without densifying it."""
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
 
-    output_matrix = h5sparse.File(matrix_path)["data"].value
+    with h5py.File(matrix_path, "r") as matrix_file:
+        group = matrix_file["data"]
+        shape = tuple(group.attrs["h5sparse_shape"])
+        non_zero_count = 0
+        total = 0
+        block_size = 1 << 24
+        for start in range(0, group["data"].shape[0], block_size):
+            values = group["data"][start:start + block_size]
+            non_zero_count += numpy.count_nonzero(values)
+            total += values.sum(dtype=numpy.float64 if values.dtype.kind == "f" else numpy.int64)
 
-    assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
-    assert numpy.sum(output_matrix) == expected_values["sum"]
-    assert tuple(output_matrix.shape) == tuple(expected_values["shape"])
+    assert non_zero_count == expected_values["non_zero_count"]
+    assert total == expected_values["sum"]
+    assert shape == tuple(expected_values["shape"])
 
 def main():
 
@@ -43,6 +142,28 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading the inputs concurrently."
+    )
+    test_group.add_argument(
+        "--read-ahead",
+        type=int,
+        default=4,
+        help="How many inputs may be read ahead of the writer."
+    )
+    test_group.add_argument(
+        "--mode",
+        choices=["copy", "engine"],
+        default="copy",
+        help=("How to merge. copy joins the data, indices and indptr of the "
+              "inputs in their own format, engine runs the shared block engine "
+              "in tasks/merge/common, which writes csc.")
+    )
+
+    merge_engine.add_arguments(test_group, "sparse_hdf5", read_ahead=False)
 
     verify_group.add_argument(
         "--output-matrix",
@@ -57,7 +178,10 @@ def main():
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_hdf5s(args.input_paths, args.output_path)
+        if args.mode == "engine":
+            merge_engine.merge_from_args(args, "sparse_hdf5")
+        else:
+            merge_hdf5s(args.input_paths, args.output_path, args.workers, args.read_ahead)
     elif args.subcommand == "verify":
         verify_hdf5(args.output_matrix, args.test_yaml)
 
@@ -1,26 +1,261 @@
 import argparse
+import bisect
+import json
+import os
+import sys
 import numpy
 import yaml
 
 import zarr
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import merge_engine
+import merge_inputs
+import read_benchmark
+import zarr_stores
+
 def merge_zarrs(zarr_paths, output_path):
 
     arrays_to_merge = []
     for zarr_path in zarr_paths:
-        arrays_to_merge.append(zarr.open(zarr_path))
+        arrays_to_merge.append(zarr_stores.open_array(zarr_path))
     print("Opened", len(arrays_to_merge), "arrays")
     print(arrays_to_merge[0])
     print(arrays_to_merge[0].shape)
     merged_array = numpy.concatenate(arrays_to_merge, axis=1)
     print(merged_array.shape)
-    output_zarr = zarr.save(output_path, merged_array)
+    for array in arrays_to_merge:
+        zarr_stores.close_array(array)
+    output_store = zarr_stores.open_store(output_path, mode="w")
+    zarr.save(output_store, merged_array)
+    zarr_stores.close_store(output_store)
+
+def merge_zarrs_streaming(zarr_paths, output_path, chunk_rows=10000, chunk_columns=1000,
+                          read_ahead=16, workers=4):
+    """Merge into an output array that is created at its final shape up front.
+
+    This is the shared engine with a buffer one output chunk wide. Only the
+    input metadata is read to size the output, the inputs are read by a pool
+    of threads at most read_ahead pieces ahead of the writer, and each full
+    buffer is written as whole chunks, so memory stays at a few output chunks
+    and the reads overlap with compressing the previous block.
+    """
+
+    # With no memory budget the engine's block is a single output chunk
+    merge_engine.merge(zarr_paths, output_path, "zarr", "zarr", workers=workers,
+                       read_ahead=read_ahead, memory_mb=0,
+                       writer_options={"chunks": (chunk_rows, chunk_columns)})
+
+MANIFEST_FORMAT = "zarr-concatenation"
+
+def merge_zarrs_virtual(zarr_paths, output_path):
+    """Write a manifest that presents the inputs as one matrix, copying nothing.
+
+    The manifest is a JSON file with the merged shape and dtype, and the
+    absolute path and first output column of each input. ConcatenatedZarr
+    reads it and resolves each read to the chunks of the inputs it covers.
+    """
+
+    sources = []
+    column_offset = 0
+    dtypes = []
+    for zarr_path in zarr_paths:
+        array = zarr_stores.open_array(zarr_path)
+        sources.append({"path": os.path.abspath(zarr_path),
+                        "shape": list(array.shape),
+                        "column_offset": column_offset})
+        dtypes.append(array.dtype)
+        column_offset += array.shape[1]
+        zarr_stores.close_array(array)
+
+    with open(output_path, "w") as manifest_file:
+        json.dump({"format": MANIFEST_FORMAT,
+                   "version": 1,
+                   "shape": [sources[0]["shape"][0], column_offset],
+                   "dtype": numpy.result_type(*dtypes).str,
+                   "sources": sources},
+                  manifest_file, indent=1)
+
+class ConcatenatedZarr(object):
+    """A read-only matrix made of zarr arrays side by side, from a manifest
+    written by merge_zarrs_virtual. Supports slicing with unit steps.
+    """
+
+    def __init__(self, manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("format") != MANIFEST_FORMAT:
+            raise ValueError("{} is not a zarr concatenation manifest".format(manifest_path))
+        self.shape = tuple(manifest["shape"])
+        self.dtype = numpy.dtype(manifest["dtype"])
+        self.sources = manifest["sources"]
+        self._column_offsets = [source["column_offset"] for source in self.sources]
+        self._arrays = {}
+
+    def _array(self, i):
+        if i not in self._arrays:
+            self._arrays[i] = zarr_stores.open_array(self.sources[i]["path"])
+        return self._arrays[i]
+
+    def __getitem__(self, key):
+        if key is Ellipsis:
+            key = ()
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows, columns = key + (slice(None),) * (2 - len(key))
+        if not isinstance(rows, slice) or not isinstance(columns, slice):
+            raise TypeError("Only slices are supported, got {}".format(key))
+        start, stop, step = columns.indices(self.shape[1])
+        if step != 1 or rows.step not in (None, 1):
+            raise TypeError("Only slices with a step of 1 are supported")
+
+        pieces = []
+        i = max(0, bisect.bisect_right(self._column_offsets, start) - 1)
+        while i < len(self.sources) and self._column_offsets[i] < stop:
+            offset = self._column_offsets[i]
+            width = self.sources[i]["shape"][1]
+            if offset + width > start:
+                pieces.append(self._array(i)[
+                    rows, max(start, offset) - offset:min(stop, offset + width) - offset])
+            i += 1
+        if not pieces:
+            return numpy.empty((len(range(*rows.indices(self.shape[0]))), 0), dtype=self.dtype)
+        return numpy.concatenate(pieces, axis=1).astype(self.dtype, copy=False)
+
+    def __array__(self, dtype=None):
+        values = self[:, :]
+        return values if dtype is None else values.astype(dtype)
+
+def _is_manifest(path):
+    """Whether path is a virtual output rather than a zarr array. Zip, SQLite
+    and gdbm stores are single files too, but are named by their suffix.
+    """
+
+    return os.path.isfile(path) and zarr_stores.store_type(path) == "DirectoryStore"
+
+def open_matrix(matrix_path):
+    """Open a merged matrix, which is a zarr array in any of the stores of
+    zarr_stores or a concatenation manifest.
+    """
+
+    if _is_manifest(matrix_path):
+        return ConcatenatedZarr(matrix_path)
+    return zarr_stores.open_array(matrix_path)
+
+def _append_to_manifest(zarr_paths, manifest_path):
+    """Add inputs to a virtual output as new sources after the existing ones."""
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError("{} is not a zarr concatenation manifest".format(manifest_path))
+
+    new_paths = merge_inputs.new_inputs(
+        zarr_paths, [source["path"] for source in manifest["sources"]])
+    dtypes = [numpy.dtype(manifest["dtype"])]
+    for zarr_path in new_paths:
+        array = zarr_stores.open_array(zarr_path)
+        if array.shape[0] != manifest["shape"][0]:
+            raise ValueError("{} has {} rows, expected {}".format(
+                zarr_path, array.shape[0], manifest["shape"][0]))
+        manifest["sources"].append({"path": zarr_path,
+                                    "shape": list(array.shape),
+                                    "column_offset": manifest["shape"][1]})
+        manifest["shape"][1] += array.shape[1]
+        dtypes.append(array.dtype)
+        zarr_stores.close_array(array)
+    manifest["dtype"] = numpy.result_type(*dtypes).str
+
+    with open(manifest_path + ".part", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(manifest_path + ".part", manifest_path)
+    print("Appended", len(new_paths), "of", len(zarr_paths), "inputs, now", manifest["shape"])
+
+def append_zarrs(zarr_paths, output_path, chunk_rows=10000, chunk_columns=1000, workers=4,
+                 read_ahead=16):
+    """Add inputs to a merged array without rewriting the columns it has.
+
+    The array lists the absolute paths of its inputs in its "inputs"
+    attribute, and inputs that are listed already are skipped. The array is
+    resized once for the new inputs, which are read by a pool of threads, at
+    most read_ahead inputs ahead of the writer, and written into the new
+    columns, so only their chunks and the last partial chunk of the old
+    columns are written. The inputs are listed, with the number of columns
+    they fill in the "columns" attribute, in one update once they are
+    written, so if an append stops part way, the next one first cuts the
+    array back to the listed columns. A missing output is created with no
+    columns first. A virtual output gets the new inputs as manifest sources.
+    Zip stores can't be appended to, because a zip file can't replace the
+    chunks and metadata that change.
+    """
+
+    if _is_manifest(output_path):
+        _append_to_manifest(zarr_paths, output_path)
+        return
+    if zarr_stores.store_type(output_path) == "ZipStore":
+        raise ValueError("{} is a zip store, which can't be appended to".format(output_path))
+
+    if os.path.exists(output_path):
+        output_zarr = zarr_stores.open_array(output_path, mode="r+")
+        if "inputs" not in output_zarr.attrs:
+            raise ValueError("{} doesn't list its inputs, so it can't be appended to. "
+                             "Create it with append.".format(output_path))
+        included = output_zarr.attrs["inputs"]
+        n_columns = output_zarr.attrs["columns"]
+        if output_zarr.shape[1] != n_columns:
+            print("Cutting", output_path, "back from", output_zarr.shape[1], "to", n_columns,
+                  "columns, left by an unfinished append")
+            output_zarr.resize(output_zarr.shape[0], n_columns)
+    else:
+        output_zarr = None
+        included = []
+
+    new_paths = merge_inputs.new_inputs(zarr_paths, included)
+    print("Appending", len(new_paths), "of", len(zarr_paths), "inputs")
+    if not new_paths:
+        if output_zarr is not None:
+            zarr_stores.close_array(output_zarr)
+        return
+    arrays = [zarr_stores.open_array(zarr_path) for zarr_path in new_paths]
+
+    if output_zarr is None:
+        n_rows = arrays[0].shape[0]
+        output_zarr = zarr_stores.open_array(
+            output_path,
+            mode="w",
+            shape=(n_rows, 0),
+            chunks=(min(max(n_rows, 1), chunk_rows), chunk_columns),
+            dtype=numpy.result_type(*[array.dtype for array in arrays]))
+        output_zarr.attrs.update({"inputs": [], "columns": 0})
+    for zarr_path, array in zip(new_paths, arrays):
+        if array.shape[0] != output_zarr.shape[0]:
+            raise ValueError("{} has {} rows, expected {}".format(
+                zarr_path, array.shape[0], output_zarr.shape[0]))
+        if not numpy.can_cast(array.dtype, output_zarr.dtype):
+            raise ValueError("{} has dtype {}, which doesn't fit in the output's {}".format(
+                zarr_path, array.dtype, output_zarr.dtype))
+
+    column_offset = output_zarr.shape[1]
+    output_zarr.resize(output_zarr.shape[0],
+                       column_offset + sum(array.shape[1] for array in arrays))
+    for _, values in merge_inputs.read_in_order(
+            arrays, lambda array: array[:], workers, read_ahead):
+        output_zarr[:, column_offset:column_offset + values.shape[1]] = values
+        column_offset += values.shape[1]
+    for array in arrays:
+        zarr_stores.close_array(array)
+    # Listed in one write once the values are written, so every listed input
+    # is complete
+    output_zarr.attrs.update({"inputs": list(included) + new_paths,
+                              "columns": output_zarr.shape[1]})
+    print("Output is now", output_zarr.shape)
+    zarr_stores.close_array(output_zarr)
 
 def verify_zarrs(matrix_path, test_yaml_path):
 
     expected_values = yaml.load(open(test_yaml_path))['expected_output']
 
-    output_matrix = zarr.open(matrix_path)
+    output_matrix = open_matrix(matrix_path)
 
     assert numpy.count_nonzero(output_matrix) == expected_values["non_zero_count"]
     assert numpy.sum(output_matrix) == expected_values["sum"]
@@ -33,6 +268,10 @@ def main():
 
     test_group = subparsers.add_parser("test", help="Run the test.")
     verify_group = subparsers.add_parser("verify", help="Verify the test output.")
+    append_group = subparsers.add_parser(
+        "append", help="Add new inputs to a merged matrix made by append or --mode virtual.")
+    benchmark_group = subparsers.add_parser(
+        "benchmark-read", help="Time reads from a merged matrix, physical or virtual.")
 
     test_group.add_argument(
         "--input-paths",
@@ -45,6 +284,36 @@ def main():
         required=True,
         help="Where to put the result matrix file."
     )
+    test_group.add_argument(
+        "--mode",
+        choices=["concatenate", "streaming", "virtual", "engine"],
+        default="concatenate",
+        help=("concatenate loads every input and concatenates them in memory. "
+              "streaming writes chunk-aligned blocks into a pre-allocated output. "
+              "virtual writes a manifest that maps to the inputs' chunks. "
+              "engine runs the shared block engine in tasks/merge/common.")
+    )
+    test_group.add_argument(
+        "--chunk-columns",
+        type=int,
+        default=1000,
+        help="Width of the output chunks in streaming and engine mode."
+    )
+    test_group.add_argument(
+        "--read-ahead",
+        type=int,
+        default=16,
+        help=("How many input pieces may be read ahead of the writer in streaming "
+              "and engine mode.")
+    )
+    test_group.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads reading inputs in streaming and engine mode."
+    )
+
+    merge_engine.add_arguments(test_group, "zarr", read_ahead=False)
 
     verify_group.add_argument(
         "--output-matrix",
@@ -56,12 +325,61 @@ def main():
         required=True,
         help="Path ."
     )
+
+    append_group.add_argument(
+        "--input-paths",
+        required=True,
+        nargs="+",
+        help="Paths to the input matrices. Inputs the output already has are skipped."
+    )
+    append_group.add_argument(
+        "--output-path",
+        required=True,
+        help="The merged matrix to add to. It's created if it doesn't exist."
+    )
+    append_group.add_argument(
+        "--chunk-columns",
+        type=int,
+        default=1000,
+        help="Width of the output chunks, if the output is created."
+    )
+    append_group.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads reading the new inputs."
+    )
+    append_group.add_argument(
+        "--read-ahead",
+        type=int,
+        default=16,
+        help="How many new inputs may be read ahead of the writer."
+    )
+
+    read_benchmark.add_arguments(benchmark_group)
     args = parser.parse_args()
 
     if args.subcommand == "test":
-        merge_zarrs(args.input_paths, args.output_path)
+        if args.mode == "virtual":
+            merge_zarrs_virtual(args.input_paths, args.output_path)
+        elif args.mode == "streaming":
+            merge_zarrs_streaming(args.input_paths, args.output_path,
+                                  chunk_columns=args.chunk_columns,
+                                  read_ahead=args.read_ahead,
+                                  workers=args.workers)
+        elif args.mode == "engine":
+            merge_engine.merge_from_args(args, "zarr", writer_options={
+                "chunks": (10000, args.chunk_columns)})
+        else:
+            merge_zarrs(args.input_paths, args.output_path)
     elif args.subcommand == "verify":
         verify_zarrs(args.output_matrix, args.test_yaml)
+    elif args.subcommand == "append":
+        append_zarrs(args.input_paths, args.output_path,
+                     chunk_columns=args.chunk_columns, workers=args.workers,
+                     read_ahead=args.read_ahead)
+    elif args.subcommand == "benchmark-read":
+        read_benchmark.time_reads(open_matrix(args.matrix), args.repetitions, args.block_size)
 
 if __name__ == "__main__":
     main()
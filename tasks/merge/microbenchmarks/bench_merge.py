@@ -0,0 +1,134 @@
+"""Time the merge functions of the tasks, and the engine, on synthetic inputs.
+
+Each merge runs in this process on the inputs conftest.py writes, so a change
+to a merge function shows up in seconds, without Docker or S3. Merges whose
+task script or writer needs a library that isn't installed are skipped. The
+last output of every merge is read back with the engine's reader for its
+format and checked against the expected output of the synthetic source.
+"""
+
+import collections
+import functools
+import importlib.util
+import os
+import shutil
+
+import numpy
+import pytest
+
+import merge_engine
+import synthetic
+
+MERGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+Merge = collections.namedtuple("Merge", ["format", "script", "function", "kwargs"])
+
+MERGES = [
+    Merge("npy", "merge_npy/merge_npy.py", "merge_npys", {}),
+    Merge("npy", "merge_npy/merge_npy.py", "merge_npys_memmap", {}),
+    Merge("zarr", "merge_zarr/merge_zarr.py", "merge_zarrs", {}),
+    Merge("zarr", "merge_zarr/merge_zarr.py", "merge_zarrs_streaming", {"workers": 1}),
+    Merge("hdf5", "merge_hdf5_h5py/merge_h5py.py", "merge_hdf5s", {}),
+    Merge("hdf5", "merge_hdf5_h5py/merge_h5py.py", "merge_hdf5s_direct_chunk", {}),
+    Merge("hdf5", "merge_hdf5_h5py/merge_h5py.py", "merge_hdf5s_virtual", {}),
+    Merge("sparse_hdf5", "merge_sparse_hdf5/merge_sparse_hdf5.py", "merge_hdf5s", {}),
+    Merge("loom", "merge_loom/merge_loom.py", "merge_looms", {}),
+    Merge("loom", "merge_loom/merge_loom.py", "merge_looms_batched", {}),
+    Merge("parquet", "merge_parquet/merge_parquet.py", "merge_parquets", {}),
+    Merge("parquet", "merge_parquet/merge_parquet.py", "merge_parquets_aligned", {}),
+    Merge("parquet", "merge_parquet/merge_parquet.py", "merge_parquets_arrow", {}),
+    Merge("feather", "merge_feather/merge_feather.py", "merge_feathers", {}),
+    Merge("feather", "merge_feather/merge_feather.py", "merge_feathers_aligned", {}),
+    Merge("feather", "merge_feather/merge_feather.py", "merge_feathers_arrow", {}),
+    Merge("matrix_market", "merge_matrix_market/merge_matrix_market.py",
+          "merge_matrix_markets", {}),
+    Merge("matrix_market", "merge_matrix_market/merge_matrix_market.py",
+          "merge_matrix_markets_streaming", {}),
+    Merge("csv", "merge_csv/merge_csv.py", "merge_csvs", {}),
+    Merge("csv", "merge_csv/merge_csv.py", "merge_csvs_arrow", {}),
+    Merge("anndata", "merge_anndata/merge_anndata.py", "merge_anndatas", {}),
+    Merge("anndata", "merge_anndata/merge_anndata.py", "merge_anndatas_backed", {}),
+]
+
+ENGINE_FORMATS = sorted(merge_engine.READERS)
+
+
+def _load_script(script):
+    """Import a task script by path, skipping if it needs a missing library."""
+
+    name = os.path.splitext(os.path.basename(script))[0]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(MERGE_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as error:
+        pytest.skip("Can't import {}: {}".format(script, error))
+    return module
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+@functools.lru_cache()
+def _expected_output(case):
+    return synthetic.expected_output(case.num_files * case.cells_per_file, case.n_genes,
+                                     density=case.density, seed=0)
+
+def _check_output(format_, output_path, case):
+    """Assert that a merged matrix has the shape, sum and non-zero count of the
+    case. numpy.save and scipy.io.mmwrite add their extension to the path.
+    """
+
+    for path in (output_path, output_path + ".npy", output_path + ".mtx"):
+        if os.path.exists(path):
+            break
+    output = merge_engine.READERS[format_](path)
+    try:
+        values = output.read_columns(0, output.shape[1])
+    finally:
+        output.close()
+    expected = _expected_output(case)
+    assert list(output.shape) == expected["shape"]
+    assert values.sum() == expected["sum"]
+    assert numpy.count_nonzero(values) == expected["non_zero_count"]
+
+def _run(benchmark, request, merge_function, input_paths, output_dir, kwargs):
+    """Time merge_function over the rounds, each into a new output path.
+
+    The output of the previous round is removed in the setup, which isn't
+    timed, and the last one is returned.
+    """
+
+    outputs = []
+
+    def setup():
+        for output_path in outputs:
+            for path in (output_path, output_path + ".npy", output_path + ".mtx"):
+                _remove(path)
+        outputs.append(os.path.join(output_dir, "merged_{}".format(len(outputs))))
+        return (input_paths, outputs[-1]), kwargs
+
+    benchmark.pedantic(merge_function, setup=setup,
+                       rounds=request.config.getoption("merge_rounds"))
+    return outputs[-1]
+
+@pytest.mark.parametrize("merge", MERGES, ids=["{}-{}".format(m.format, m.function) for m in MERGES])
+def bench_task(benchmark, request, make_inputs, case, merge, tmp_path):
+    merge_function = getattr(_load_script(merge.script), merge.function)
+    input_paths = make_inputs(case, merge.format)
+    benchmark.group = "{} {}".format(merge.format, case.name)
+    benchmark.extra_info.update(case._asdict())
+    output_path = _run(benchmark, request, merge_function, input_paths, str(tmp_path),
+                       merge.kwargs)
+    _check_output(merge.format, output_path, case)
+
+@pytest.mark.parametrize("format_", ENGINE_FORMATS)
+def bench_engine(benchmark, request, make_inputs, case, format_, tmp_path):
+    input_paths = make_inputs(case, format_)
+    benchmark.group = "{} {}".format(format_, case.name)
+    benchmark.extra_info.update(case._asdict())
+    output_path = _run(benchmark, request, merge_engine.merge, input_paths, str(tmp_path),
+                       {"reader_format": format_, "writer_format": format_})
+    _check_output(format_, output_path, case)
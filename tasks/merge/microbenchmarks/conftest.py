@@ -0,0 +1,154 @@
+"""Synthetic inputs for the merge microbenchmarks.
+
+Each case is a set of files of synthetic counts from create_data/synthetic.py,
+generated once per session in a temporary directory and written in whichever
+format a benchmark asks for. Like the converters' output, the matrix of every
+file is genes x cells, except in csv and anndata files, which are cells x genes,
+so the merges concatenate them into one genes x cells matrix.
+"""
+
+import collections
+import os
+import sys
+
+import numpy
+import pytest
+
+MERGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(MERGE_DIR, "..", "..", "create_data"))
+sys.path.insert(0, os.path.join(MERGE_DIR, "common"))
+import synthetic
+
+Case = collections.namedtuple("Case", ["name", "num_files", "cells_per_file", "n_genes", "density"])
+
+CASES = [
+    # One cell per file, like GSE84465_split, where opening files dominates
+    Case("many_files", num_files=200, cells_per_file=1, n_genes=2000, density=0.1),
+    # A few larger files, where reading and writing values dominates
+    Case("large_files", num_files=8, cells_per_file=250, n_genes=5000, density=0.05),
+    Case("dense", num_files=8, cells_per_file=100, n_genes=2000, density=0.8),
+]
+
+
+def pytest_addoption(parser):
+    parser.addoption("--cases", default=",".join(case.name for case in CASES),
+                     help="Comma separated names of the cases to run, of: {}".format(
+                         ", ".join(case.name for case in CASES)))
+    parser.addoption("--merge-rounds", type=int, default=3,
+                     help="How many times to run each merge.")
+
+def pytest_generate_tests(metafunc):
+    if "case" in metafunc.fixturenames:
+        names = metafunc.config.getoption("cases").split(",")
+        unknown = set(names) - set(case.name for case in CASES)
+        if unknown:
+            raise pytest.UsageError("Unknown cases: {}".format(", ".join(sorted(unknown))))
+        cases = [case for case in CASES if case.name in names]
+        metafunc.parametrize("case", cases, ids=[case.name for case in cases])
+
+
+def _frames(case):
+    """Yield a genes x cells DataFrame for each file of a case."""
+
+    import pandas
+    genes = ["gene_{}".format(i) for i in range(case.n_genes)]
+    first_cell = 0
+    for counts in synthetic.generate_files(
+            case.num_files * case.cells_per_file, case.n_genes, case.num_files,
+            density=case.density, seed=0):
+        cells = ["cell_{}".format(first_cell + i) for i in range(counts.shape[1])]
+        first_cell += counts.shape[1]
+        yield pandas.DataFrame(counts, index=pandas.Index(genes, name="index"), columns=cells)
+
+def _write_npy(df, path):
+    numpy.save(path + ".npy", df.values)
+    return path + ".npy"
+
+def _write_zarr(df, path):
+    import zarr
+    zarr.save_array(path + ".zarr", df.values)
+    return path + ".zarr"
+
+def _write_hdf5(df, path):
+    import h5py
+    with h5py.File(path + ".h5", "w") as hdf5_file:
+        hdf5_file.create_dataset("data", data=df.values, chunks=True)
+    return path + ".h5"
+
+def _write_sparse_hdf5(df, path):
+    """A csc matrix in the h5sparse layout, written with h5py."""
+
+    import h5py
+    import scipy.sparse
+    matrix = scipy.sparse.csc_matrix(df.values)
+    with h5py.File(path + ".h5", "w") as hdf5_file:
+        group = hdf5_file.create_group("data")
+        group.attrs["h5sparse_format"] = "csc"
+        group.attrs["h5sparse_shape"] = matrix.shape
+        for name in ("data", "indices", "indptr"):
+            group.create_dataset(name, data=getattr(matrix, name))
+    return path + ".h5"
+
+def _write_loom(df, path):
+    import loompy
+    loompy.create(path + ".loom", df.values, {"gene_name": df.index.values},
+                  {"cell_name": df.columns.values})
+    return path + ".loom"
+
+def _write_parquet(df, path):
+    df.to_parquet(path + ".parquet")
+    return path + ".parquet"
+
+def _write_feather(df, path):
+    df.reset_index().to_feather(path + ".feather")
+    return path + ".feather"
+
+def _write_matrix_market(df, path):
+    import scipy.io
+    import scipy.sparse
+    scipy.io.mmwrite(path + ".mtx", scipy.sparse.coo_matrix(df.values))
+    return path + ".mtx"
+
+def _write_csv(df, path):
+    df.T.to_csv(path + ".csv.gz", compression="gzip")
+    return path + ".csv.gz"
+
+def _write_anndata(df, path):
+    import anndata
+    import pandas
+    anndata.AnnData(df.values.T, obs=pandas.DataFrame(index=df.columns),
+                    var=pandas.DataFrame(index=df.index.values)).write(path + ".h5ad")
+    return path + ".h5ad"
+
+WRITERS = {
+    "npy": _write_npy,
+    "zarr": _write_zarr,
+    "hdf5": _write_hdf5,
+    "sparse_hdf5": _write_sparse_hdf5,
+    "loom": _write_loom,
+    "parquet": _write_parquet,
+    "feather": _write_feather,
+    "matrix_market": _write_matrix_market,
+    "csv": _write_csv,
+    "anndata": _write_anndata,
+}
+
+@pytest.fixture(scope="session")
+def make_inputs(tmp_path_factory):
+    """A function that writes the files of a case in a format, once per
+    session, and returns their paths.
+    """
+
+    written = {}
+
+    def make(case, format_):
+        if (case, format_) not in written:
+            directory = str(tmp_path_factory.mktemp("{}_{}".format(case.name, format_)))
+            try:
+                written[case, format_] = [
+                    WRITERS[format_](df, os.path.join(directory, "input_{:05d}".format(i)))
+                    for i, df in enumerate(_frames(case))]
+            except ImportError as error:
+                pytest.skip("Can't write {} inputs: {}".format(format_, error))
+        return written[case, format_]
+    return make